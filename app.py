@@ -1,13 +1,41 @@
+import io
 import os
+import hmac
+import logging
+import threading
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, Response, stream_with_context, redirect
+from flask import Flask, Request, render_template, request, jsonify, Response, stream_with_context, redirect
 import json
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from utilities.anthropic_utils import search_sources, analyze_style, generate_single_article
-from utilities.content_filter import check_content_filter
+from limits import parse
+from utilities.anthropic_utils import (http_pool_stats, style_cache_stats, search_cache_stats, stage_stats,
+                                      analyze_style, API_KEY_SECRET, UsageTally)
+from utilities.google_secret_utils import prefetch_secrets
+from utilities.db import DB_SECRETS
+from utilities.prewarm import SearchPrewarmer
+from utilities.usage_writer import get_usage_writer
+from utilities.pricing import start_pricing_refresh, pricing_stats
+from utilities.ratelimit_storage import RATELIMIT_STORAGE_URI, RATELIMIT_STRATEGY
+from utilities.admission import AdmissionController, Overloaded
+from utilities.style_samples import sample_stats
+from utilities.uploads import CappedSpool, UPLOAD_MAX_BYTES, UPLOAD_MAX_FILES, LIMIT_MESSAGE, close_uploads
+from utilities.pipeline import iter_prep_stages, iter_articles, iter_article_events, STREAM_ARTICLES, ARTICLE_MODE
+from utilities.content_filter import check_content_filter, start_background_refresh, blocked_words_stats
+
+
+class UploadRequest(Request):
+    # Each uploaded file is written into a CappedSpool as it's parsed, so an
+    # oversized file is rejected mid-upload and big ones spool to disk
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return CappedSpool()
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+# The whole request body, enforced as it's read
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES
+logger = logging.getLogger(__name__)
 
 DOMAIN = "https://meish.cc"
 
@@ -18,14 +46,52 @@ def force_canonical_host():
     if host.startswith('www.'):
         return redirect(f'https://meish.cc{request.full_path}', code=301)
 
-# Rate limiter - prevents abuse and controls costs
+GENERATE_RATE_LIMIT = os.getenv('AIA_GENERATE_RATE_LIMIT', '10 per hour')
+
+# Rate limiter - prevents abuse and controls costs. Counters are shared by all
+# workers (see utilities/ratelimit_storage.py); if that storage errors, limits
+# fall back to per-process memory rather than failing the request.
 limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=["100 per hour"],  # General site limit
-    storage_uri="memory://"
+    storage_uri=RATELIMIT_STORAGE_URI,
+    strategy=RATELIMIT_STRATEGY,
+    in_memory_fallback_enabled=True
 )
 
+# /generate's own limit is checked before the form is read but only taken
+# once the request is admitted, so a request shed at capacity (503) doesn't
+# use it up. Taking it is one atomic hit() in the shared storage: concurrent
+# requests from one client can't all pass a test() and be deducted later,
+# which is what Flask-Limiter's deduct_when does.
+generate_limit = parse(GENERATE_RATE_LIMIT)
+_RATELIMIT_KEY_PREFIX = app.config.get('RATELIMIT_KEY_PREFIX', '')
+
+
+def generate_rate_key(client_ip):
+    """Key parts for /generate's limit, as Flask-Limiter builds them for the
+    endpoint ([key prefix,] remote address, endpoint), so app.py and asgi.py
+    draw on one counter per client."""
+    parts = (client_ip, 'generate')
+    return (_RATELIMIT_KEY_PREFIX, *parts) if _RATELIMIT_KEY_PREFIX else parts
+
+
+def check_generate_limit(rate_key, take=False):
+    """True if the client is under /generate's limit; take=True also uses up
+    one request. A storage error lets the request through (Flask-Limiter's
+    in-memory fallback takes over once it marks the storage down)."""
+    strategy = limiter.limiter
+    try:
+        return (strategy.hit if take else strategy.test)(generate_limit, *rate_key)
+    except Exception as e:
+        logger.warning(f"Rate limit check failed, allowing request: {e}")
+        return True
+
+
+def rate_limited_message():
+    return f"Rate limit exceeded: {GENERATE_RATE_LIMIT}"
+
 TOPICS = {
     "tech": "AI and technology news",
     "politics": "US political news",
@@ -36,8 +102,69 @@ TOPICS = {
     "entertainment": "entertainment and media news"
 }
 
+# What the topic buttons actually submit (see app.js: "Tech" -> "Tech news"),
+# so pre-warmed searches land on the same cache keys as real requests
+PRESET_TOPIC_QUERIES = [f"{key.capitalize()} news" for key in TOPICS]
+search_prewarmer = SearchPrewarmer(PRESET_TOPIC_QUERIES)
+
+# In-flight cap, per-minute spend budget and bounded queue for /generate
+admission = AdmissionController()
+
 SAMPLE_STYLE_PATH = os.path.join(os.path.dirname(__file__), 'static', 'files', 'sample.txt')
 
+
+def _load_sample_style():
+    try:
+        with open(SAMPLE_STYLE_PATH, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+SAMPLE_STYLE_CONTENT = _load_sample_style()
+
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def start_background_tasks():
+    """Kick off per-worker warm-up work. Idempotent.
+
+    Called from gunicorn's post_worker_init hook (gunicorn.conf.py) and from
+    the dev server entry point, never at import time.
+    """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+
+    # Secret Manager round trips happen here rather than on the first request;
+    # a request that arrives mid-prefetch waits on the same fetch
+    threading.Thread(target=prefetch_secrets, args=([API_KEY_SECRET, *DB_SECRETS.values()],),
+                     daemon=True).start()
+
+    def precompute_sample_style():
+        # Every "use sample style" request sends identical text, so analyze it
+        # once up front and let those requests hit the style cache
+        try:
+            analyze_style(None, SAMPLE_STYLE_CONTENT)
+            logger.info("Sample style precomputed")
+        except Exception as e:
+            logger.warning(f"Sample style precompute failed: {e}")
+
+    if SAMPLE_STYLE_CONTENT and os.getenv('AIA_PRECOMPUTE_SAMPLE_STYLE', '1') not in ('0', 'false', 'no'):
+        threading.Thread(target=precompute_sample_style, daemon=True).start()
+
+    # Fetch the full blocked word list; requests use the vendored snapshot until it lands
+    start_background_refresh()
+
+    # Load DB model pricing; cost estimates use the static rates until it lands
+    start_pricing_refresh()
+
+    # Off unless AIA_PREWARM_INTERVAL is set
+    search_prewarmer.start()
+
+
 @app.route('/')
 def home():
     return render_template('index.html', topics=TOPICS)
@@ -68,73 +195,140 @@ Sitemap: {DOMAIN}/sitemap.xml"""
 def indexnow_key():
     return Response('b4c9ebbc8faa4d7b8b2b8104b6511fee', mimetype='text/plain')
 
+def collect_stats():
+    """Process-local performance counters (connection reuse etc.)"""
+    return {
+        'http': http_pool_stats(),
+        'stages': stage_stats(),
+        'style_cache': style_cache_stats(),
+        'style_samples': sample_stats(),
+        'search_cache': search_cache_stats(),
+        'prewarm': search_prewarmer.stats(),
+        'content_filter': blocked_words_stats(),
+        'usage_writer': get_usage_writer().stats(),
+        'pricing': pricing_stats(),
+        'admission': admission.stats(),
+    }
+
+# /_stats carries internal counters and error strings: off (404) unless
+# AIA_STATS_TOKEN is set, then only with "Authorization: Bearer <token>"
+STATS_TOKEN = os.getenv('AIA_STATS_TOKEN', '')
+
+def stats_authorized(headers):
+    return bool(STATS_TOKEN) and hmac.compare_digest(headers.get('Authorization', ''), f'Bearer {STATS_TOKEN}')
+
+@app.route('/_stats')
+def stats():
+    if not stats_authorized(request.headers):
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(collect_stats())
+
 @app.route('/generate', methods=['POST'])
-@limiter.limit("10 per hour")  # Strict limit on expensive AI endpoint
+# Strict limit on expensive AI endpoint, applied in the view (see generate_limit)
+@limiter.exempt
 def generate():
     """Stream articles as they're generated using SSE
 
     Rate limited to 10 requests per hour per IP to prevent abuse
     and control API costs (~$0.12 per request)
     """
+    rate_key = generate_rate_key(get_remote_address())
+    if not check_generate_limit(rate_key):
+        return jsonify({"error": rate_limited_message()}), 429
+
     custom_topic = request.form.get('custom_topic', '').strip()
     files = request.files.getlist('files')
     use_sample_style = request.form.get('use_sample_style') == 'on'
 
     files = [f for f in files if f.filename]
 
-    if not files and not use_sample_style:
-        return jsonify({"error": "Upload writing samples or use the sample style"}), 400
-
-    if not custom_topic:
-        return jsonify({"error": "Enter a topic to write about"}), 400
+    sample_content, error = check_generate_form(custom_topic, len(files), use_sample_style)
+    if error:
+        message, status = error
+        return jsonify({"error": message}), status
 
-    # Content filter check
-    is_allowed, filter_error = check_content_filter(custom_topic)
-    if not is_allowed:
-        return jsonify({"error": filter_error}), 400
-
-    sample_content = None
-    if use_sample_style and not files:
-        try:
-            with open(SAMPLE_STYLE_PATH, 'r') as f:
-                sample_content = f.read()
-        except FileNotFoundError:
-            return jsonify({"error": "Sample style file not found"}), 500
+    # Shed load up front when even the queue is full, rather than letting the
+    # request sit on a thread until the gunicorn timeout
+    try:
+        ticket = admission.request()
+    except Overloaded as e:
+        return _busy_response(e)
+    if not check_generate_limit(rate_key, take=True):
+        ticket.release()
+        return jsonify({"error": rate_limited_message()}), 429
 
-    # Read file contents before entering generator (can't read in generator)
+    # Hand the spooled files over as-is rather than reading them; the style
+    # call streams them out and closes them (utilities/uploads.py). They're
+    # taken off the request, which closes its files when this view returns,
+    # so cleanup() closes any the style stage didn't get to.
     file_contents = []
     for f in files:
-        file_contents.append({
-            'filename': f.filename,
-            'data': f.read()
-        })
+        file_contents.append({'filename': f.filename, 'data': f.stream})
+        f.stream = io.BytesIO()
+
+    def cleanup():
+        ticket.release()
+        close_uploads(file_contents)
 
     def generate_stream():
+        try:
+            # Wait for a slot, telling the client where it is in line
+            try:
+                for position in ticket.wait():
+                    yield f"data: {json.dumps({'type': 'queued', 'position': position})}\n\n"
+            except Overloaded as e:
+                yield f"data: {json.dumps({'type': 'error', 'message': busy_message(e.retry_after), 'retry_after': e.retry_after})}\n\n"
+                return
+            yield from stream_articles()
+        finally:
+            cleanup()
+
+    def stream_articles():
         # Send initial event
         yield f"data: {json.dumps({'type': 'status', 'message': 'Searching for articles...'})}\n\n"
 
-        # Search for sources
-        sources = search_sources(custom_topic)
-        if not sources:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'No articles found for {custom_topic}'})}\n\n"
-            return
-
-        yield f"data: {json.dumps({'type': 'sources', 'count': len(sources)})}\n\n"
-        yield f"data: {json.dumps({'type': 'status', 'message': f'Found {len(sources)} sources. Analyzing your writing style...'})}\n\n"
-
-        # Analyze style
-        style = analyze_style(file_contents if file_contents else None, sample_content)
+        # Token usage of every call behind this request, reported with 'done'
+        tally = UsageTally()
 
-        yield f"data: {json.dumps({'type': 'status', 'message': 'Style analyzed. Generating articles...'})}\n\n"
+        # Search for sources and analyze style side by side, reporting each
+        # stage as it lands
+        sources, style = None, None
+        for stage, result in iter_prep_stages(custom_topic, file_contents if file_contents else None, sample_content,
+                                              tally=tally):
+            if stage == 'sources':
+                sources = result
+                if not sources:
+                    yield f"data: {json.dumps({'type': 'error', 'message': f'No articles found for {custom_topic}'})}\n\n"
+                    return
 
-        # Generate and stream each article one by one
-        for i, src in enumerate(sources):
-            yield f"data: {json.dumps({'type': 'status', 'message': f'Writing article {i+1} of {len(sources)}...'})}\n\n"
+                yield f"data: {json.dumps({'type': 'sources', 'count': len(sources)})}\n\n"
+                next_step = 'Generating articles...' if style is not None else 'Analyzing your writing style...'
+                yield f"data: {json.dumps({'type': 'status', 'message': f'Found {len(sources)} sources. {next_step}'})}\n\n"
+            else:
+                style = result
+                next_step = 'Generating articles...' if sources is not None else 'Still searching for articles...'
+                yield f"data: {json.dumps({'type': 'status', 'message': f'Style analyzed. {next_step}'})}\n\n"
 
-            article = generate_single_article(src, style, i)
-            yield f"data: {json.dumps({'type': 'article', 'index': i, 'article': article})}\n\n"
+        # Generate articles concurrently and stream them as they're written.
+        # Closing this generator (client disconnect) cancels the rest.
+        yield f"data: {json.dumps({'type': 'status', 'message': f'Writing article 1 of {len(sources)}...'})}\n\n"
+        if STREAM_ARTICLES:
+            done = 0
+            for kind, i, payload in iter_article_events(sources, style, tally=tally):
+                if kind == 'delta':
+                    yield f"data: {json.dumps({'type': 'article_delta', 'index': i, 'text': payload})}\n\n"
+                    continue
+                done += 1
+                yield f"data: {json.dumps({'type': 'article_done', 'index': i, 'article': payload})}\n\n"
+                if done < len(sources):
+                    yield f"data: {json.dumps({'type': 'status', 'message': f'Writing article {done+1} of {len(sources)}...'})}\n\n"
+        else:
+            for done, (i, article) in enumerate(iter_articles(sources, style, tally=tally), 1):
+                yield f"data: {json.dumps({'type': 'article', 'index': i, 'article': article})}\n\n"
+                if done < len(sources):
+                    yield f"data: {json.dumps({'type': 'status', 'message': f'Writing article {done+1} of {len(sources)}...'})}\n\n"
 
-        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+        yield f"data: {json.dumps({'type': 'done', 'article_mode': ARTICLE_MODE, 'usage': tally.report()})}\n\n"
 
     response = Response(
         stream_with_context(generate_stream()),
@@ -145,7 +339,52 @@ def generate():
             'Connection': 'keep-alive',
         }
     )
+    # generate_stream releases the slot and closes the uploads when it ends;
+    # this covers a client that disconnects before the stream ever starts
+    response.call_on_close(cleanup)
+    return response
+
+
+def check_generate_form(custom_topic, file_count, use_sample_style):
+    """Validate a /generate submission (shared with asgi.py).
+    Returns (sample_content, None), or (None, (error message, status))."""
+    if not file_count and not use_sample_style:
+        return None, ("Upload writing samples or use the sample style", 400)
+
+    if file_count > UPLOAD_MAX_FILES:
+        return None, (f"Upload at most {UPLOAD_MAX_FILES} writing samples", 400)
+
+    if not custom_topic:
+        return None, ("Enter a topic to write about", 400)
+
+    # Content filter check
+    is_allowed, filter_error = check_content_filter(custom_topic)
+    if not is_allowed:
+        return None, (filter_error, 400)
+
+    sample_content = None
+    if use_sample_style and not file_count:
+        sample_content = SAMPLE_STYLE_CONTENT
+        if sample_content is None:
+            return None, ("Sample style file not found", 500)
+    return sample_content, None
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": LIMIT_MESSAGE}), 413
+
+
+def busy_message(retry_after):
+    return f"We're at capacity right now. Please try again in about {retry_after} seconds."
+
+
+def _busy_response(e):
+    response = jsonify({"error": busy_message(e.retry_after), "retry_after": e.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
     return response
 
 if __name__ == '__main__':
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
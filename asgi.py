@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for Me-ish (meish.cc): /generate on asyncio
+
+Under gunicorn's threaded worker every /generate stream pins a thread for the
+30-60s it mostly spends waiting on the Anthropic API, so an instance serves
+as many generations as it has threads. Here /generate is an async generator
+on one event loop, built from the async variants in
+utilities/anthropic_async.py (same prompts, caches, routing and usage logging),
+and an open stream costs a coroutine rather than a thread. Every other route
+is the Flask app, mounted as WSGI.
+
+The rest of the request handling matches app.py: same rate limit (one
+counter per client, shared with app.generate), form
+checks, upload caps and spooling, SSE events, and admission control, with the
+in-flight cap raised to AIA_ASGI_MAX_INFLIGHT.
+
+Run:
+    uvicorn asgi:app --port 8080
+On App Engine (app.yaml):
+    entrypoint: uvicorn asgi:app --host 0.0.0.0 --port $PORT --timeout-keep-alive 75
+Requires starlette, uvicorn, httpx, python-multipart and a2wsgi.
+"""
+
+import os
+import json
+import asyncio
+import logging
+from contextlib import asynccontextmanager, aclosing
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.formparsers import MultiPartParser
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as flask_app
+from utilities.admission import AdmissionController, Overloaded
+from utilities.anthropic_utils import UsageTally
+from utilities.anthropic_async import aclose_client, async_http_stats
+from utilities.pipeline import STREAM_ARTICLES, ARTICLE_MODE
+from utilities.pipeline_async import aiter_prep_stages, aiter_article_events
+from utilities.uploads import UploadTooLarge, UPLOAD_MAX_BYTES, UPLOAD_MAX_FILE_BYTES, UPLOAD_SPOOL_BYTES, LIMIT_MESSAGE
+from utilities.usage_writer import shutdown_usage_writer
+
+logger = logging.getLogger(__name__)
+
+ASGI_MAX_INFLIGHT = int(os.getenv('AIA_ASGI_MAX_INFLIGHT', '200'))
+ASGI_ADMISSION_QUEUE = int(os.getenv('AIA_ASGI_ADMISSION_QUEUE', '100'))
+
+admission = AdmissionController(max_inflight=ASGI_MAX_INFLIGHT, max_queue=ASGI_ADMISSION_QUEUE)
+
+
+def _sse(event):
+    return f"data: {json.dumps(event)}\n\n"
+
+
+def _error(message, status, headers=None):
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+
+class _UploadParser(MultiPartParser):
+    """Starlette's multipart parser with app.py's upload caps: files spool
+    past AIA_UPLOAD_SPOOL_BYTES and one over AIA_UPLOAD_MAX_FILE_BYTES is
+    rejected as it arrives."""
+
+    spool_max_size = UPLOAD_SPOOL_BYTES
+
+    def on_part_begin(self):
+        super().on_part_begin()
+        self._part_bytes = 0
+
+    def on_part_data(self, data, start, end):
+        if self._current_part.file is not None:
+            self._part_bytes += end - start
+            if self._part_bytes > UPLOAD_MAX_FILE_BYTES:
+                raise UploadTooLarge()
+        super().on_part_data(data, start, end)
+
+
+async def _capped_stream(request):
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > UPLOAD_MAX_BYTES:
+            raise UploadTooLarge()
+        yield chunk
+
+
+async def _read_form(request):
+    """request.form(), with the request and per-file caps enforced while the
+    body is read (app.py gets the same from MAX_CONTENT_LENGTH and CappedSpool)"""
+    if int(request.headers.get('content-length') or 0) > UPLOAD_MAX_BYTES:
+        raise UploadTooLarge()
+    if not request.headers.get('content-type', '').startswith('multipart/form-data'):
+        return await request.form()
+    return await _UploadParser(request.headers, _capped_stream(request)).parse()
+
+
+async def generate(request):
+    """Async /generate: the same SSE stream as app.generate"""
+    client_ip = request.client.host if request.client else '127.0.0.1'
+    rate_key = flask_app.generate_rate_key(client_ip)
+    # Checked here, deducted only once the request is admitted (a 503 is free)
+    if not flask_app.check_generate_limit(rate_key):
+        return _error(flask_app.rate_limited_message(), 429)
+
+    try:
+        form = await _read_form(request)
+    except UploadTooLarge:
+        return _error(LIMIT_MESSAGE, 413)
+    custom_topic = (form.get('custom_topic') or '').strip()
+    files = [f for f in form.getlist('files') if getattr(f, 'filename', None)]
+    use_sample_style = form.get('use_sample_style') == 'on'
+
+    sample_content, error = flask_app.check_generate_form(custom_topic, len(files), use_sample_style)
+    if error:
+        await form.close()
+        return _error(*error)
+
+    # The spooled files themselves; the style call streams them out and closes them
+    file_contents = [{'filename': f.filename, 'data': f.file} for f in files]
+
+    try:
+        ticket = admission.request()
+    except Overloaded as e:
+        await form.close()
+        return _error(flask_app.busy_message(e.retry_after), 503, {'Retry-After': str(e.retry_after)})
+    if not flask_app.check_generate_limit(rate_key, take=True):
+        ticket.release()
+        await form.close()
+        return _error(flask_app.rate_limited_message(), 429)
+
+    async def generate_stream():
+        try:
+            try:
+                async for position in ticket.wait_async():
+                    yield _sse({'type': 'queued', 'position': position})
+            except Overloaded as e:
+                yield _sse({'type': 'error', 'message': flask_app.busy_message(e.retry_after),
+                            'retry_after': e.retry_after})
+                return
+            async with aclosing(stream_articles()) as events:
+                async for event in events:
+                    yield event
+        finally:
+            ticket.release()
+
+    async def stream_articles():
+        yield _sse({'type': 'status', 'message': 'Searching for articles...'})
+        tally = UsageTally()
+
+        sources, style = None, None
+        async with aclosing(aiter_prep_stages(custom_topic, file_contents or None, sample_content,
+                                              tally=tally)) as stages:
+            async for stage, result in stages:
+                if stage == 'sources':
+                    sources = result
+                    if not sources:
+                        yield _sse({'type': 'error', 'message': f'No articles found for {custom_topic}'})
+                        return
+                    yield _sse({'type': 'sources', 'count': len(sources)})
+                    next_step = 'Generating articles...' if style is not None else 'Analyzing your writing style...'
+                    yield _sse({'type': 'status', 'message': f'Found {len(sources)} sources. {next_step}'})
+                else:
+                    style = result
+                    next_step = 'Generating articles...' if sources is not None else 'Still searching for articles...'
+                    yield _sse({'type': 'status', 'message': f'Style analyzed. {next_step}'})
+
+        yield _sse({'type': 'status', 'message': f'Writing article 1 of {len(sources)}...'})
+        done = 0
+        async with aclosing(aiter_article_events(sources, style, tally=tally, stream=STREAM_ARTICLES)) as events:
+            async for kind, i, payload in events:
+                if kind == 'delta':
+                    yield _sse({'type': 'article_delta', 'index': i, 'text': payload})
+                    continue
+                done += 1
+                yield _sse({'type': 'article_done' if STREAM_ARTICLES else 'article', 'index': i, 'article': payload})
+                if done < len(sources):
+                    yield _sse({'type': 'status', 'message': f'Writing article {done+1} of {len(sources)}...'})
+
+        yield _sse({'type': 'done', 'article_mode': ARTICLE_MODE, 'usage': tally.report()})
+
+    async def cleanup():
+        ticket.release()
+        await form.close()
+
+    # generate_stream releases the slot when it ends; the background task
+    # covers a stream that never starts, and closes any upload the style
+    # stage didn't get to
+    return StreamingResponse(generate_stream(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache, no-transform',
+        'X-Accel-Buffering': 'no',
+    }, background=BackgroundTask(cleanup))
+
+
+async def stats(request):
+    if not flask_app.stats_authorized(request.headers):
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    return JSONResponse({**flask_app.collect_stats(), 'admission': admission.stats(),
+                         'async_http': async_http_stats()})
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    flask_app.start_background_tasks()
+    yield
+    await aclose_client()
+    await asyncio.to_thread(shutdown_usage_writer)
+
+
+app = Starlette(
+    routes=[
+        Route('/generate', generate, methods=['POST']),
+        Route('/_stats', stats),
+        Mount('/', app=WSGIMiddleware(flask_app.app)),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('PORT', '8080')))
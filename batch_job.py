@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Offline bulk generation for Me-ish (meish.cc) via the Message Batches API
+
+For scheduled campaigns where cost matters and latency doesn't: sources and
+style guides are prepared with the app's own search_sources / analyze_style
+(both cached), then every article request - built exactly like
+generate_single_article's - goes out as one Message Batch at half the token
+price. Results land in a JSONL file, one line per article.
+
+Resumable: prepared jobs, the requests already submitted and the batches
+still pending are kept in a state file next to the output, and the output
+file records which results are done. Re-running the same command after a
+crash or Ctrl-C picks up where it stopped - it won't re-run prep that
+finished, re-submit a request that was accepted, or re-write / re-log results
+already in the output. Jobs added to the campaign later go out in a new batch
+on the next run.
+
+Campaign file: JSONL, one job per line:
+    {"id": "ai-weekly", "topic": "AI in healthcare"}
+    {"id": "cloud", "topic": "Cloud costs", "style_files": ["samples/post1.txt"]}
+Jobs without style_files use the app's sample style.
+
+Usage:
+    python batch_job.py campaign.jsonl                       # -> campaign.out.jsonl
+    python batch_job.py campaign.jsonl --out results.jsonl --poll 120
+
+Offline against the mock server:
+    python mock_anthropic_server.py &
+    AIA_ANTHROPIC_BASE_URL=http://127.0.0.1:8765 AIA_SECRET_KUMORI_ANTHROPIC_API_KEY=test \\
+        python batch_job.py campaign.jsonl --poll 1
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+from utilities.anthropic_utils import (API_BASE, HTTP_CONNECT_TIMEOUT, _get_session, _get_headers, _article_body,
+                                       search_sources, analyze_style, log_api_usage)
+from utilities.usage_writer import shutdown_usage_writer
+
+BATCHES_URL = f"{API_BASE}/v1/messages/batches"
+BATCH_FEATURE = 'generate_batch_api'
+SAMPLE_STYLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'files', 'sample.txt')
+
+# Colors for output
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+BLUE = '\033[94m'
+RESET = '\033[0m'
+
+
+def print_step(msg):
+    print(f"\n{BLUE}[BATCH]{RESET} {msg}")
+
+
+def print_ok(msg):
+    print(f"  {GREEN}✓{RESET} {msg}")
+
+
+def print_fail(msg):
+    print(f"  {RED}✗{RESET} {msg}")
+
+
+# --- State ---
+
+def load_state(path):
+    """jobs: prepared jobs by id; submitted: custom_ids sent in any batch;
+    batches: ids of batches whose results aren't all written yet."""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {'jobs': {}, 'submitted': [], 'batches': []}
+    state.setdefault('submitted', [])
+    state.setdefault('batches', [])
+    batch_id = state.pop('batch_id', None)
+    if batch_id:
+        # Older state files kept one batch id; it covered every job prepared then
+        state['batches'].append(batch_id)
+        state['submitted'] = [r['custom_id'] for r in batch_requests(state)]
+    return state
+
+
+def handled_ids(out_path):
+    """custom_ids already in the output file. The output itself is the record
+    of what's done, so a result is never written twice."""
+    try:
+        with open(out_path) as f:
+            return {f"{row['job_id']}-{row['index']}" for row in map(json.loads, filter(str.strip, f))}
+    except FileNotFoundError:
+        return set()
+
+
+def save_state(path, state):
+    # Write-then-rename so a crash mid-write never leaves a truncated file
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+# --- Prep: sources + style per job (real-time, cached) ---
+
+def load_campaign(path):
+    jobs = []
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if not job.get('id') or not job.get('topic'):
+                raise ValueError(f"{path}:{n}: every job needs an 'id' and a 'topic'")
+            # custom_id allows [a-zA-Z0-9_-]{1,64}, with room left for the article index
+            job['id'] = re.sub(r'[^a-zA-Z0-9_-]', '_', str(job['id']))[:56]
+            jobs.append(job)
+    return jobs
+
+
+def prepare_job(job):
+    sources = search_sources(job['topic'])
+    if job.get('style_files'):
+        file_contents = []
+        for path in job['style_files']:
+            with open(path, 'rb') as f:
+                file_contents.append({'filename': os.path.basename(path), 'data': f.read()})
+        style = analyze_style(file_contents=file_contents)
+    else:
+        with open(SAMPLE_STYLE_PATH) as f:
+            style = analyze_style(sample_content=f.read())
+    return {'topic': job['topic'], 'sources': sources, 'style': style}
+
+
+def batch_requests(state):
+    requests = []
+    for job_id, job in state['jobs'].items():
+        for i, src in enumerate(job['sources']):
+            requests.append({'custom_id': f"{job_id}-{i}", 'params': _article_body(src, job['style'], i)})
+    return requests
+
+
+# --- Message Batches API ---
+
+def _api(method, url, **kwargs):
+    r = _get_session().request(method, url, headers=_get_headers(), timeout=(HTTP_CONNECT_TIMEOUT, 120), **kwargs)
+    r.raise_for_status()
+    return r
+
+
+def submit_batch(requests):
+    return _api('POST', BATCHES_URL, json={'requests': requests}).json()
+
+
+def wait_for_batch(batch_id, poll):
+    while True:
+        batch = _api('GET', f"{BATCHES_URL}/{batch_id}").json()
+        counts = batch.get('request_counts', {})
+        if batch['processing_status'] == 'ended':
+            return batch
+        print_ok(f"{batch['processing_status']}: {counts.get('succeeded', 0)} succeeded, "
+                 f"{counts.get('processing', 0)} processing")
+        time.sleep(poll)
+
+
+def iter_results(batch):
+    r = _api('GET', batch['results_url'], stream=True)
+    for line in r.iter_lines():
+        if line:
+            yield json.loads(line)
+
+
+# --- Main ---
+
+def run(campaign_path, out_path, state_path, poll):
+    state = load_state(state_path)
+
+    print_step(f"Preparing sources and style guides ({campaign_path})")
+    for job in load_campaign(campaign_path):
+        if job['id'] in state['jobs']:
+            continue
+        try:
+            state['jobs'][job['id']] = prepare_job(job)
+        except Exception as e:
+            # Not recorded, so the next run retries it
+            print_fail(f"{job['id']}: prep failed, skipping this run: {e}")
+            continue
+        save_state(state_path, state)
+        print_ok(f"{job['id']}: {len(state['jobs'][job['id']]['sources'])} sources")
+
+    # Anything prepared but never sent (jobs added since the last batch) goes
+    # out as a new batch
+    submitted = set(state['submitted'])
+    requests = [r for r in batch_requests(state) if r['custom_id'] not in submitted]
+    if requests:
+        print_step(f"Submitting {len(requests)} article requests")
+        batch = submit_batch(requests)
+        state['batches'].append(batch['id'])
+        state['submitted'].extend(r['custom_id'] for r in requests)
+        save_state(state_path, state)
+        print_ok(f"Batch {batch['id']} accepted")
+    elif not state['batches']:
+        if not submitted:
+            print_fail("Nothing to submit (no sources found for any job)")
+            return 1
+        print_ok("Nothing new to submit; every batch's results are already written")
+        return 0
+
+    handled = handled_ids(out_path)
+    written = failed = 0
+    for batch_id in list(state['batches']):
+        print_step(f"Waiting for batch {batch_id}")
+        batch = wait_for_batch(batch_id, poll)
+
+        print_step(f"Writing results to {out_path}")
+        with open(out_path, 'a') as out:
+            for result in iter_results(batch):
+                custom_id = result['custom_id']
+                if custom_id in handled:
+                    continue
+                job_id, _, index = custom_id.rpartition('-')
+                job, index = state['jobs'][job_id], int(index)
+                line = {'job_id': job_id, 'topic': job['topic'], 'index': index, 'source': job['sources'][index]}
+                if result['result']['type'] == 'succeeded':
+                    message = result['result']['message']
+                    line['content'] = message['content'][0]['text']
+                    log_api_usage(message.get('model', 'unknown'), message.get('usage', {}), feature=BATCH_FEATURE,
+                                  user_id='system:aia-batch', batch=True)
+                    written += 1
+                else:
+                    line['error'] = result['result']
+                    failed += 1
+                out.write(json.dumps(line) + '\n')
+                out.flush()
+                handled.add(custom_id)
+        # Every result is in the output now; don't wait on this batch again
+        state['batches'].remove(batch_id)
+        save_state(state_path, state)
+    shutdown_usage_writer()
+
+    print_ok(f"{written} articles written, {failed} failed")
+    return 0 if not failed else 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('campaign', help="campaign JSONL (one {id, topic, style_files?} per line)")
+    parser.add_argument('--out', help="output JSONL (default: <campaign>.out.jsonl)")
+    parser.add_argument('--state', help="state file (default: <out>.state.json)")
+    parser.add_argument('--poll', type=float, default=60, help="seconds between batch status checks")
+    args = parser.parse_args()
+
+    out_path = args.out or f"{os.path.splitext(args.campaign)[0]}.out.jsonl"
+    state_path = args.state or f"{out_path}.state.json"
+    try:
+        sys.exit(run(args.campaign, out_path, state_path, args.poll))
+    except KeyboardInterrupt:
+        print(f"\n{YELLOW}Interrupted - re-run the same command to resume{RESET}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
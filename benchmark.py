@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for Me-ish (meish.cc)
+
+Offline - no network, no API calls (asgi_load talks to
+mock_anthropic_server.py). Each benchmark compares the old code path against
+the current one. import_time and ratelimit also check a budget
+(AIA_IMPORT_BUDGET_MS, AIA_RATELIMIT_BUDGET_US) and exit non-zero when it's over.
+
+Usage:
+    python benchmark.py                     # Run all benchmarks
+    python benchmark.py content_filter      # Run one benchmark
+"""
+
+import os
+import sys
+import time
+import json
+import subprocess
+import random
+import string
+
+# Colors for output
+BLUE = '\033[94m'
+GREEN = '\033[92m'
+RED = '\033[91m'
+RESET = '\033[0m'
+
+IMPORT_BUDGET_MS = float(os.getenv('AIA_IMPORT_BUDGET_MS', '400'))
+RATELIMIT_BUDGET_US = float(os.getenv('AIA_RATELIMIT_BUDGET_US', '1000'))
+# Loaded on first use (or by start_background_tasks), never by `import app`
+DEFERRED_MODULES = ('requests', 'psycopg2', 'google.cloud.secretmanager', 'pypdf')
+
+
+def print_bench(name):
+    print(f"\n{BLUE}[BENCH]{RESET} {name}")
+
+
+def print_row(msg):
+    print(f"  {GREEN}•{RESET} {msg}")
+
+
+def print_fail(msg):
+    print(f"  {RED}✗{RESET} {msg}")
+
+
+def per_call_us(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def bench_content_filter():
+    """Per-check latency of the blocked-word scan vs the Aho-Corasick matcher"""
+    from utilities.content_filter import PhraseMatcher
+
+    print_bench("Content filter: linear substring scan vs PhraseMatcher")
+    rng = random.Random(42)
+    message = "latest developments in enterprise ai adoption and cloud migration trends"
+
+    for size in (100, 500, 2000, 10000):
+        words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+                 for _ in range(size)]
+        matcher = PhraseMatcher(words)
+
+        def linear():
+            for phrase in words:
+                if phrase and phrase in message:
+                    return False
+            return True
+
+        linear_us = per_call_us(linear, 200)
+        matcher_us = per_call_us(lambda: matcher.search(message), 200)
+        print_row(f"{size:>6} words: linear {linear_us:8.1f}us   matcher {matcher_us:6.1f}us")
+
+
+def _legacy_caller_site(this_file):
+    """anthropic_logger._caller_site as it was, built on inspect.stack()"""
+    import os
+    import inspect
+    for frame in inspect.stack()[1:]:
+        try:
+            fn = os.path.abspath(frame.filename)
+        except Exception:
+            continue
+        if fn == this_file or fn.endswith('anthropic_logger.py'):
+            continue
+        return fn, frame.lineno, frame.function
+    return ('unknown', 0, 'unknown')
+
+
+def bench_caller_site():
+    """Cost of finding the caller of a traced messages.create()"""
+    try:
+        from utilities import anthropic_logger
+    except ImportError as e:
+        print(f"  skipped: {e}")
+        return
+
+    print_bench("Trace caller site: inspect.stack() vs sys._getframe walk")
+
+    # A Flask request under gunicorn, through the SSE generator and the
+    # article pool, sits roughly 40-60 frames deep
+    for depth in (10, 40, 80):
+        def nested(n):
+            if n:
+                return nested(n - 1)
+            legacy_us = per_call_us(lambda: _legacy_caller_site(anthropic_logger._THIS_FILE), 200)
+            current_us = per_call_us(anthropic_logger._caller_site, 2000)
+            return legacy_us, current_us
+
+        legacy_us, current_us = nested(depth)
+        print_row(f"{depth:>3} frames deep: inspect.stack {legacy_us:9.1f}us   _getframe {current_us:5.2f}us")
+
+
+def bench_pricing():
+    """Model -> rate resolution: substring scans vs the memoized PricingIndex"""
+    from utilities.pricing import MODEL_PRICING, PricingIndex
+
+    print_bench("Pricing lookup: linear DB + static scan vs PricingIndex")
+    model = 'claude-sonnet-4-20250514'
+
+    # kumori_model_pricing mirrors LiteLLM, which lists a few hundred models
+    for size in (20, 200, 1000):
+        db = {f"vendor-model-{n}-20250101": {'input': 0.000001, 'output': 0.000002} for n in range(size)}
+        index = PricingIndex(MODEL_PRICING, db)
+
+        def linear():
+            m = model.lower()
+            if m in db:
+                return db[m]
+            for mid, p in db.items():
+                if mid in m or m in mid:
+                    return p
+            for key, p in MODEL_PRICING.items():
+                if key in m:
+                    return p
+            return MODEL_PRICING['default']
+
+        linear_us = per_call_us(linear, 2000)
+        index_us = per_call_us(lambda: index.lookup(model), 2000)
+        print_row(f"{size:>5} DB models: linear {linear_us:7.2f}us   index {index_us:5.2f}us")
+
+
+def _import_profile():
+    """Run `import app` in a fresh interpreter under -X importtime.
+    Returns {module: (self_us, cumulative_us)}."""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'import app failed')
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def bench_import_time():
+    """Cold-start import cost, per top-level package, against the budget"""
+    print_bench(f"Cold start: import app (budget {IMPORT_BUDGET_MS:.0f}ms, AIA_IMPORT_BUDGET_MS)")
+    try:
+        # Best of three; the first run also pays for cold .pyc/disk caches
+        profile = min((_import_profile() for _ in range(3)), key=lambda m: m['app'][1])
+    except RuntimeError as e:
+        print_fail(f"import app failed: {e}")
+        return False
+
+    by_package = {}
+    for name, (self_us, _) in profile.items():
+        root = name.split('.')[0]
+        by_package[root] = by_package.get(root, 0) + self_us
+    for root, us in sorted(by_package.items(), key=lambda kv: -kv[1])[:10]:
+        print_row(f"{root:<24} {us / 1000:7.1f}ms")
+
+    ok = True
+    for name in DEFERRED_MODULES:
+        if name in profile:
+            print_fail(f"{name} is imported by `import app`; it should load on first use")
+            ok = False
+
+    total_ms = profile['app'][1] / 1000
+    if total_ms > IMPORT_BUDGET_MS:
+        print_fail(f"import app: {total_ms:.0f}ms, over the {IMPORT_BUDGET_MS:.0f}ms budget")
+        ok = False
+    else:
+        print_row(f"import app: {total_ms:.0f}ms (budget {IMPORT_BUDGET_MS:.0f}ms)")
+    return ok
+
+
+def _ratelimit_hits(uri, strategy, n):
+    """Per-hit microseconds for n hits against a 10-per-hour limit"""
+    import utilities.ratelimit_storage  # noqa: F401 - registers sqlite://
+    from limits import parse, strategies
+    from limits.storage import storage_from_string
+    limiter = strategies.STRATEGIES[strategy](storage_from_string(uri))
+    item = parse('10/hour')
+    # Spread over many keys (client IPs), most of them already over the limit
+    return per_call_us(lambda: limiter.hit(item, f"10.0.{random.randrange(200)}.1", '/generate'), n)
+
+
+def _ratelimit_worker(uri, strategy, n, out):
+    out.put(_ratelimit_hits(uri, strategy, n))
+
+
+def bench_ratelimit():
+    """Per-check overhead of the rate limiter storage, alone and with several
+    worker processes hitting the same SQLite file"""
+    import tempfile
+    import multiprocessing
+
+    print_bench(f"Rate limiter: memory:// vs shared sqlite:// (budget {RATELIMIT_BUDGET_US:.0f}us per check)")
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for strategy in ('fixed-window', 'sliding-window-counter'):
+            uri = f"sqlite://{tmp}/{strategy}.sqlite"
+            memory_us = _ratelimit_hits('memory://', strategy, 5000)
+            sqlite_us = _ratelimit_hits(uri, strategy, 5000)
+
+            # gunicorn workers on one instance: 4 processes sharing the file
+            out = multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=_ratelimit_worker, args=(uri, strategy, 2000, out))
+                     for _ in range(4)]
+            for p in procs:
+                p.start()
+            shared_us = max(out.get() for _ in procs)
+            for p in procs:
+                p.join()
+
+            print_row(f"{strategy:<24} memory {memory_us:6.1f}us   sqlite {sqlite_us:6.1f}us   "
+                      f"sqlite x4 procs {shared_us:6.1f}us")
+            if max(sqlite_us, shared_us) > RATELIMIT_BUDGET_US:
+                print_fail(f"{strategy}: over the {RATELIMIT_BUDGET_US:.0f}us budget")
+                ok = False
+    return ok
+
+
+def _free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _tree_usage(pid):
+    """(RSS MB, threads) of a process and its children, from /proc"""
+    rss_kb = threads = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss_kb += int(line.split()[1])
+                    elif line.startswith('Threads:'):
+                        threads += int(line.split()[1])
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pids.extend(int(c) for c in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return rss_kb / 1024, threads
+
+
+def _wait_for_port(port, proc, timeout=20):
+    import socket
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+async def _load(port, concurrency, server_pid):
+    """Open `concurrency` /generate streams at once, sampling the server's
+    memory while they run. Returns (completed, seconds, peak RSS MB, peak threads)."""
+    import asyncio
+    import httpx
+
+    peak = [0.0, 0]
+
+    async def sample():
+        while True:
+            rss, threads = _tree_usage(server_pid)
+            peak[0], peak[1] = max(peak[0], rss), max(peak[1], threads)
+            await asyncio.sleep(0.1)
+
+    async def one(client, n):
+        form = {'custom_topic': f"load test topic {n % 20}", 'use_sample_style': 'on'}
+        async with client.stream('POST', f"http://127.0.0.1:{port}/generate", data=form) as r:
+            async for line in r.aiter_lines():
+                if line.startswith('data: ') and json.loads(line[6:])['type'] == 'done':
+                    return True
+        return False
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    sampler = asyncio.ensure_future(sample())
+    start = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        results = await asyncio.gather(*(one(client, n) for n in range(concurrency)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    return sum(r is True for r in results), elapsed, peak[0], peak[1]
+
+
+def bench_asgi_load():
+    """Concurrent /generate streams against server memory: threaded gunicorn
+    (a thread per stream) vs the ASGI entry point (a coroutine per stream),
+    both calling mock_anthropic_server.py"""
+    import asyncio
+    import tempfile
+    try:
+        import httpx, uvicorn, starlette, a2wsgi  # noqa: F401,E401
+    except ImportError as e:
+        print(f"  skipped: {e}")
+        return
+
+    levels = [int(n) for n in os.getenv('AIA_LOAD_LEVELS', '10,100,300').split(',')]
+    print_bench(f"Load: concurrent /generate streams vs server memory ({', '.join(map(str, levels))} clients)")
+    here = os.path.dirname(os.path.abspath(__file__))
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        mock_port = _free_port()
+        # Each request: a 0.5s search, then three 2s article streams
+        mock = subprocess.Popen([sys.executable, os.path.join(here, 'mock_anthropic_server.py'), '--port',
+                                 str(mock_port), '--latency', '0.5', '--stream-seconds', '2'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_for_port(mock_port, mock)
+            for concurrency in levels:
+                port = _free_port()
+                env = {**os.environ,
+                       'AIA_ANTHROPIC_BASE_URL': f"http://127.0.0.1:{mock_port}",
+                       'AIA_SECRET_KUMORI_ANTHROPIC_API_KEY': 'test',
+                       'AIA_RATELIMIT_STORAGE_URI': 'memory://',
+                       'AIA_GENERATE_RATE_LIMIT': '100000 per hour',
+                       'AIA_MAX_INFLIGHT': str(concurrency), 'AIA_ASGI_MAX_INFLIGHT': str(concurrency),
+                       'AIA_HTTP_POOL_SIZE': str(3 * concurrency), 'AIA_ASYNC_HTTP_POOL_SIZE': str(3 * concurrency),
+                       'AIA_USAGE_SPOOL_PATH': os.path.join(tmp, f"spool-{port}.sqlite")}
+                servers = {
+                    'threads': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app',
+                                '-b', f"127.0.0.1:{port}", '--workers', '1', '--threads', str(concurrency),
+                                '--timeout', '300', '--log-level', 'warning'],
+                    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port),
+                             '--log-level', 'warning'],
+                }
+                for mode, cmd in servers.items():
+                    server = subprocess.Popen(cmd, cwd=here, env=env,
+                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    try:
+                        _wait_for_port(port, server)
+                        idle_rss, _ = _tree_usage(server.pid)
+                        completed, elapsed, rss, threads = asyncio.run(_load(port, concurrency, server.pid))
+                    finally:
+                        server.terminate()
+                        server.wait(timeout=30)
+                    print_row(f"{mode:<8} {concurrency:>4} streams: {completed:>4} done in {elapsed:5.1f}s   "
+                              f"RSS {idle_rss:5.0f} -> {rss:5.0f}MB   {threads:>4} threads")
+                    if completed < concurrency:
+                        print_fail(f"{mode}: {concurrency - completed} of {concurrency} streams didn't finish")
+                        ok = False
+        finally:
+            mock.terminate()
+            mock.wait(timeout=30)
+    return ok
+
+
+def _upload_environ(path, mb):
+    """WSGI environ for a /generate POST of one mb MB PDF, written to path in
+    chunks so the body never sits in this process's memory"""
+    from werkzeug.test import EnvironBuilder
+    head = (b'--BENCH\r\nContent-Disposition: form-data; name="custom_topic"\r\n\r\nai\r\n'
+            b'--BENCH\r\nContent-Disposition: form-data; name="files"; filename="sample.pdf"\r\n'
+            b'Content-Type: application/pdf\r\n\r\n')
+    with open(path, 'wb') as f:
+        f.write(head)
+        for _ in range(mb):
+            f.write(os.urandom(1024 * 1024))
+        f.write(b'\r\n--BENCH--\r\n')
+    return EnvironBuilder(path='/generate', method='POST', input_stream=open(path, 'rb'),
+                          content_length=os.path.getsize(path),
+                          content_type='multipart/form-data; boundary=BENCH').get_environ()
+
+
+def _upload_request_peak(variant, mb, tmp):
+    """In a fresh interpreter: parse one mb MB upload and send its style call
+    to a sink, the 'legacy' way (read whole, base64 it, json.dumps the body)
+    or the 'streamed' way. Returns the peak RSS the request added, in MB."""
+    import base64
+    import resource
+    import app
+    from flask import request
+    from utilities import anthropic_utils as U
+    from utilities.uploads import close_uploads
+
+    class Sink:
+        def post(self, url, headers=None, data=None, timeout=None, **kwargs):
+            for _ in ([data] if isinstance(data, bytes) else data):
+                pass
+            return self
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {'content': [{'type': 'text', 'text': 'style ' * 100}]}
+
+    U._get_session = Sink
+    U._style_cache.get = lambda key: None
+
+    def run(mb):
+        with app.app.request_context(_upload_environ(os.path.join(tmp, f"{variant}-{mb}.body"), mb)):
+            f = request.files['files']
+            if variant == 'legacy':
+                data = f.read()
+                body = {'max_tokens': 1500, 'system': [U._prompt_block(U.STYLE_INSTRUCTIONS, U.STAGE_MODELS['style'])],
+                        'messages': [{'role': 'user', 'content': [
+                            {'type': 'document', 'source': {'type': 'base64', 'media_type': 'application/pdf',
+                                                            'data': base64.b64encode(data).decode()}},
+                            {'type': 'text', 'text': 'Write the style guide for the author of these samples.'}]}]}
+                Sink().post(U.API_URL, data=json.dumps(body).encode())
+            else:
+                file_contents = [{'filename': f.filename, 'data': f.stream}]
+                U.analyze_style(file_contents)
+                close_uploads(file_contents)
+
+    run(0)  # load everything the request path imports lazily
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run(mb)
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+
+
+def bench_upload_memory():
+    """Peak RSS added by one /generate request with a PDF upload: the whole
+    file read, base64'd and JSON-encoded in memory vs spooled and encoded as
+    the style call is sent"""
+    import tempfile
+
+    sizes = [int(n) for n in os.getenv('AIA_UPLOAD_BENCH_MB', '1,5,10').split(',')]
+    print_bench(f"Uploads: peak RSS per request, read whole vs streamed ({', '.join(map(str, sizes))} MB PDF)")
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ,
+               'AIA_SECRET_KUMORI_ANTHROPIC_API_KEY': 'test',
+               'AIA_RATELIMIT_STORAGE_URI': 'memory://',
+               'AIA_UPLOAD_MAX_FILE_BYTES': str((max(sizes) + 1) * 1024 * 1024),
+               'AIA_UPLOAD_MAX_BYTES': str((max(sizes) + 2) * 1024 * 1024)}
+        for mb in sizes:
+            peaks = {}
+            for variant in ('legacy', 'streamed'):
+                code = (f"import json, benchmark; "
+                        f"print(json.dumps(benchmark._upload_request_peak({variant!r}, {mb}, {tmp!r})))")
+                proc = subprocess.run([sys.executable, '-c', code], cwd=here, env=env, capture_output=True, text=True)
+                if proc.returncode != 0:
+                    print_fail(f"{variant} {mb}MB: {proc.stderr.strip().splitlines()[-1]}")
+                    return False
+                peaks[variant] = json.loads(proc.stdout.strip().splitlines()[-1])
+            print_row(f"{mb:>3} MB PDF: read whole +{peaks['legacy']:6.1f}MB   streamed +{peaks['streamed']:5.1f}MB")
+
+
+def _post_archive(rng, posts):
+    """A writer's post archive: short posts, each signed off the same way"""
+    words = ("we shipped the new model and learned that customers care about latency more than accuracy "
+             "here is what i would tell my younger self about hiring building teams and saying no").split()
+    out = []
+    for _ in range(posts):
+        paragraphs = [' '.join(rng.choice(words) for _ in range(rng.randint(8, 60))).capitalize() + '.'
+                      for _ in range(rng.randint(3, 7))]
+        out.append('\n\n'.join(paragraphs + ["Thanks for reading!\nFollow me for more on building AI products."]))
+    return '\n\n'.join(out)
+
+
+def bench_style_samples():
+    """Input tokens of the style call's sample text: sent whole vs extracted,
+    deduplicated and sampled locally (utilities/style_samples.py)"""
+    import io
+    import zipfile
+    from utilities.style_samples import prepare_samples, estimate_tokens, STYLE_SAMPLE_TOKENS
+
+    print_bench(f"Style samples: whole text vs local dedupe + sampling (budget {STYLE_SAMPLE_TOKENS} tokens)")
+    rng = random.Random(42)
+    for posts in (20, 100, 400):
+        archive = _post_archive(rng, posts)
+        doc = io.BytesIO()
+        with zipfile.ZipFile(doc, 'w') as z:
+            body = ''.join(f"<w:p><w:r><w:t>{p}</w:t></w:r></w:p>" for p in archive.split('\n\n'))
+            z.writestr('word/document.xml', '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+                                            f'wordprocessingml/2006/main"><w:body>{body}</w:body></w:document>')
+        files = [{'filename': 'posts.txt', 'data': archive.encode()},
+                 {'filename': 'posts.docx', 'data': doc.getvalue()}]
+        start = time.perf_counter()
+        samples = prepare_samples(files)
+        prep_ms = (time.perf_counter() - start) * 1000
+        # Before: the text file verbatim, the .docx decoded as if it were text
+        whole = estimate_tokens(archive) + estimate_tokens(doc.getvalue().decode('utf-8', errors='ignore'))
+        sent = sum(estimate_tokens(f['text']) for f in samples)
+        print_row(f"{posts:>4} posts (txt + docx): whole {whole:>7} tokens   sampled {sent:>5} tokens   "
+                  f"prep {prep_ms:6.1f}ms")
+
+
+BENCHMARKS = {
+    'content_filter': bench_content_filter,
+    'caller_site': bench_caller_site,
+    'pricing': bench_pricing,
+    'import_time': bench_import_time,
+    'ratelimit': bench_ratelimit,
+    'asgi_load': bench_asgi_load,
+    'upload_memory': bench_upload_memory,
+    'style_samples': bench_style_samples,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark {name!r}. Choose from: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+    # Benchmarks that enforce a budget return False when it's blown
+    failed = [name for name in names if BENCHMARKS[name]() is False]
+    sys.exit(1 if failed else 0)
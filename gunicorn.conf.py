@@ -0,0 +1,13 @@
+# Gunicorn server hooks. Command-line flags (bind, workers, threads, timeout)
+# stay in app.yaml's entrypoint; this file only wires per-worker lifecycle.
+
+
+def post_worker_init(worker):
+    from app import start_background_tasks
+    start_background_tasks()
+
+
+def worker_exit(server, worker):
+    # Flush batched kumori_api_usage rows before the worker goes away
+    from utilities.usage_writer import shutdown_usage_writer
+    shutdown_usage_writer()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Anthropic API, for offline runs of batch_job.py
+
+Serves just enough of the API for the app and the batch job:
+    POST /v1/messages                       canned sources (web search) or text
+    POST /v1/messages/batches               accepts a batch
+    GET  /v1/messages/batches/<id>          in_progress for --batch-seconds, then ended
+    GET  /v1/messages/batches/<id>/results  one JSONL result per request
+
+Request ids containing "fail" come back errored, to exercise error handling.
+State lives in memory; restart the server and old batch ids are gone.
+"stream": true requests get the text back as SSE deltas spread over
+--stream-seconds; --latency delays every /v1/messages response, so load tests
+see realistic long-lived calls.
+
+Usage:
+    python mock_anthropic_server.py                      # 127.0.0.1:8765
+    python mock_anthropic_server.py --port 9000 --batch-seconds 5
+    python mock_anthropic_server.py --latency 1 --stream-seconds 3     # load testing
+Then point the app or batch job at it:
+    AIA_ANTHROPIC_BASE_URL=http://127.0.0.1:8765 AIA_SECRET_KUMORI_ANTHROPIC_API_KEY=test ...
+"""
+
+import re
+import json
+import time
+import uuid
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODEL = 'claude-sonnet-4-20250514'
+_batches = {}
+_lock = threading.Lock()
+
+
+def _usage(body):
+    return {'input_tokens': len(json.dumps(body)) // 4, 'output_tokens': 200,
+            'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+
+
+def _message(body):
+    if body.get('tools') and any(t.get('name') == 'web_search' for t in body['tools']):
+        topic = re.search(r'news articles about: (.*)', json.dumps(body))
+        topic = topic.group(1).split('\\n')[0] if topic else 'the topic'
+        text = json.dumps([{'title': f"{topic} - story {n}", 'url': f"https://example.com/{n}",
+                            'summary': f"Mock summary {n} about {topic}."} for n in range(1, 4)])
+    elif 'Write the style guide for the author' in json.dumps(body):
+        # Long enough to pass the app's style check, so it gets cached like a real guide
+        text = "Mock style guide. " + " ".join(
+            f"Rule {n}: short declarative sentences, first person, one concrete example per point."
+            for n in range(1, 9))
+    else:
+        title = re.search(r'Title: ([^\\]*?)\\n', json.dumps(body))
+        text = f"Mock post about {title.group(1) if title else 'the samples'}."
+    return {'id': f"msg_{uuid.uuid4().hex[:12]}", 'type': 'message', 'role': 'assistant', 'model': MODEL,
+            'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn', 'usage': _usage(body)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    batch_seconds = 3.0
+    latency = 0.0
+    stream_seconds = 0.0
+
+    def _send(self, status, payload, content_type='application/json'):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _batch_view(self, batch):
+        ended = time.time() - batch['created'] >= self.batch_seconds
+        n = len(batch['requests'])
+        failed = sum(1 for r in batch['requests'] if 'fail' in r['custom_id'])
+        base = f"http://{self.headers['Host']}/v1/messages/batches/{batch['id']}"
+        return {'id': batch['id'], 'type': 'message_batch',
+                'processing_status': 'ended' if ended else 'in_progress',
+                'request_counts': {'processing': 0 if ended else n, 'succeeded': n - failed if ended else 0,
+                                   'errored': failed if ended else 0, 'canceled': 0, 'expired': 0},
+                'results_url': f"{base}/results" if ended else None}
+
+    def _stream(self, message):
+        # No Content-Length: the stream ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        words = message['content'][0]['text'].split(' ')
+        usage = message['usage']
+
+        def event(data):
+            self.wfile.write(f"event: {data['type']}\ndata: {json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+
+        event({'type': 'message_start', 'message': {**message, 'content': [], 'usage': {**usage, 'output_tokens': 1}}})
+        event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+        for n, word in enumerate(words):
+            time.sleep(self.stream_seconds / len(words))
+            event({'type': 'content_block_delta', 'index': 0,
+                   'delta': {'type': 'text_delta', 'text': word if n == 0 else f" {word}"}})
+        event({'type': 'content_block_stop', 'index': 0})
+        event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+               'usage': {'output_tokens': usage['output_tokens']}})
+        event({'type': 'message_stop'})
+        self.close_connection = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path == '/v1/messages':
+            time.sleep(self.latency)
+            if body.get('stream'):
+                return self._stream(_message(body))
+            return self._send(200, _message(body))
+        if self.path == '/v1/messages/batches':
+            batch = {'id': f"msgbatch_{uuid.uuid4().hex[:16]}", 'created': time.time(), 'requests': body['requests']}
+            with _lock:
+                _batches[batch['id']] = batch
+            return self._send(200, self._batch_view(batch))
+        self._send(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': self.path}})
+
+    def do_GET(self):
+        m = re.fullmatch(r'/v1/messages/batches/([\w-]+)(/results)?', self.path)
+        batch = _batches.get(m.group(1)) if m else None
+        if batch is None:
+            return self._send(404, {'type': 'error', 'error': {'type': 'not_found_error', 'message': self.path}})
+        view = self._batch_view(batch)
+        if not m.group(2):
+            return self._send(200, view)
+        if view['processing_status'] != 'ended':
+            return self._send(409, {'type': 'error', 'error': {'type': 'invalid_request_error',
+                                                               'message': 'batch still processing'}})
+        lines = []
+        for r in batch['requests']:
+            if 'fail' in r['custom_id']:
+                result = {'type': 'errored', 'error': {'type': 'api_error', 'message': 'mock failure'}}
+            else:
+                result = {'type': 'succeeded', 'message': _message(r['params'])}
+            lines.append(json.dumps({'custom_id': r['custom_id'], 'result': result}))
+        self._send(200, ('\n'.join(lines) + '\n').encode(), 'application/x-jsonl')
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # load tests open hundreds of connections at once
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the Anthropic Messages + Message Batches API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--batch-seconds', type=float, default=3.0, help="how long a batch stays in_progress")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds before each /v1/messages response")
+    parser.add_argument('--stream-seconds', type=float, default=0.0, help="seconds a streamed response takes")
+    args = parser.parse_args()
+
+    Handler.batch_seconds = args.batch_seconds
+    Handler.latency = args.latency
+    Handler.stream_seconds = args.stream_seconds
+    server = Server((args.host, args.port), Handler)
+    print(f"Mock Anthropic API on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
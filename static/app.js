@@ -15,6 +15,7 @@ const useSampleStyle = $('useSampleStyle');
 
 let hasFiles = false;
 let sourceCount = 0;
+let articlesDone = 0;
 
 // Topic quick-select buttons
 document.querySelectorAll('.topic-btn').forEach(btn => {
@@ -169,6 +170,7 @@ form.addEventListener('submit', async e => {
 
     // Reset state
     sourceCount = 0;
+    articlesDone = 0;
     step1.classList.add('hidden');
     loadingState.classList.remove('hidden');
     errorState.classList.add('hidden');
@@ -191,8 +193,11 @@ form.addEventListener('submit', async e => {
         });
 
         if (!response.ok) {
-            const errorData = await response.json();
-            throw new Error(errorData.error || 'Request failed');
+            // 503 = at capacity; the message includes when to retry (Retry-After)
+            const errorData = await response.json().catch(() => ({}));
+            throw new Error(errorData.error || (response.status === 503
+                ? 'We\'re at capacity right now. Please try again in a minute.'
+                : 'Request failed'));
         }
 
         const reader = response.body.getReader();
@@ -231,6 +236,14 @@ form.addEventListener('submit', async e => {
 
 function handleStreamEvent(data) {
     switch (data.type) {
+        case 'queued':
+            // At capacity - waiting for a free slot before the search starts
+            loadingTitle.textContent = 'Waiting for a free slot...';
+            loadingDesc.textContent = data.position === 1
+                ? "You're next in line - starting as soon as a slot frees up"
+                : `You're #${data.position} in line - starting as soon as a slot frees up`;
+            break;
+
         case 'status':
             updateLoadingStatus(data.message);
             break;
@@ -248,6 +261,15 @@ function handleStreamEvent(data) {
             replaceSkeletonWithArticle(data.article, data.index);
             break;
 
+        case 'article_delta':
+            // Streamed text - swap the skeleton for a card on the first delta
+            appendArticleDelta(data.text, data.index);
+            break;
+
+        case 'article_done':
+            replaceSkeletonWithArticle(data.article, data.index);
+            break;
+
         case 'error':
             loadingState.classList.add('hidden');
             resultsState.classList.add('hidden');
@@ -265,7 +287,15 @@ function handleStreamEvent(data) {
 function updateLoadingStatus(message) {
     const lowerMsg = message.toLowerCase();
 
-    if (lowerMsg.includes('searching')) {
+    // Search and style analysis run side by side, so "Style analyzed" can
+    // arrive before the sources do; check it first
+    if (lowerMsg.includes('style analyzed')) {
+        loadingTitle.textContent = 'Style captured!';
+        loadingDesc.textContent = message;
+        $('step-analyze').classList.remove('active');
+        $('step-analyze').classList.add('completed');
+        document.querySelectorAll('.progress-connector')[1].classList.add('active');
+    } else if (lowerMsg.includes('searching')) {
         loadingTitle.textContent = 'Searching for articles...';
         loadingDesc.textContent = 'Finding relevant sources on your topic (~10-15 seconds)';
         setProgressStep('search');
@@ -281,12 +311,6 @@ function updateLoadingStatus(message) {
         loadingTitle.textContent = 'Analyzing your style...';
         loadingDesc.textContent = 'Learning your unique writing voice (~10-15 seconds)';
         setProgressStep('analyze');
-    } else if (lowerMsg.includes('style analyzed')) {
-        loadingTitle.textContent = 'Style captured!';
-        loadingDesc.textContent = 'Ready to write in your voice';
-        $('step-analyze').classList.remove('active');
-        $('step-analyze').classList.add('completed');
-        document.querySelectorAll('.progress-connector')[1].classList.add('active');
     } else if (lowerMsg.includes('writing article')) {
         // Extract article number from message like "Writing article 1 of 3..."
         const match = message.match(/article (\d+) of (\d+)/i);
@@ -297,27 +321,51 @@ function updateLoadingStatus(message) {
     }
 }
 
+function sourceLinkHtml(source) {
+    return `<a href="${source.url}" target="_blank" rel="noopener">Source: ${escapeHtml(source.title)}</a>`;
+}
+
+function articleCardHtml(index, content, source) {
+    const footer = source ? sourceLinkHtml(source) : '';
+    return `
+        <div class="article-card article-animate" id="card-${index}">
+            <div class="article-header">
+                <span class="article-label">Article ${index + 1}</span>
+                <button type="button" class="copy-btn" onclick="copyText(this, 'article${index}')">Copy</button>
+            </div>
+            <div class="article-body" id="article${index}">${escapeHtml(content)}</div>
+            <div class="article-footer">${footer}</div>
+        </div>
+    `;
+}
+
+function appendArticleDelta(text, index) {
+    const skeleton = $(`skeleton-${index}`);
+    if (skeleton) {
+        skeleton.outerHTML = articleCardHtml(index, '', null);
+    }
+    const body = $(`article${index}`);
+    if (body) {
+        body.appendChild(document.createTextNode(text));
+    }
+}
+
 function replaceSkeletonWithArticle(article, index) {
     const skeleton = $(`skeleton-${index}`);
+    const card = $(`card-${index}`);
     if (skeleton) {
-        const articleHtml = `
-            <div class="article-card article-animate">
-                <div class="article-header">
-                    <span class="article-label">Article ${index + 1}</span>
-                    <button type="button" class="copy-btn" onclick="copyText(this, 'article${index}')">Copy</button>
-                </div>
-                <div class="article-body" id="article${index}">${escapeHtml(article.content)}</div>
-                <div class="article-footer">
-                    <a href="${article.source.url}" target="_blank" rel="noopener">Source: ${escapeHtml(article.source.title)}</a>
-                </div>
-            </div>
-        `;
-        skeleton.outerHTML = articleHtml;
+        skeleton.outerHTML = articleCardHtml(index, article.content, article.source);
+    } else if (card) {
+        // Already streamed in - settle the final text and add the source link
+        $(`article${index}`).textContent = article.content;
+        card.querySelector('.article-footer').innerHTML = sourceLinkHtml(article.source);
     }
 
-    // Update writing indicator for next article
-    if (index < sourceCount - 1) {
-        showWritingIndicator(index + 2, sourceCount);
+    // Articles can finish in any order, so count completions rather than
+    // trusting the index when updating the writing indicator
+    articlesDone++;
+    if (articlesDone < sourceCount) {
+        showWritingIndicator(articlesDone + 1, sourceCount);
     }
 }
 
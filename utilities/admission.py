@@ -0,0 +1,247 @@
+"""Admission control for /generate.
+
+One /generate holds a gunicorn thread for up to a minute or more and fans out
+several paid LLM calls, so a burst of users used to mean a burst of spend and
+requests silently stuck behind busy threads. AdmissionController sits in front
+of the SSE stream:
+
+  - at most AIA_MAX_INFLIGHT requests generate at once
+  - while the API spend of the last minute (every call logged through
+    log_api_usage, prewarm included) is over AIA_TOKENS_PER_MINUTE or
+    AIA_COST_PER_MINUTE_USD, nothing new starts
+  - requests that can't start wait in a FIFO queue of AIA_ADMISSION_QUEUE
+    places, for up to AIA_ADMISSION_MAX_WAIT seconds, and are told their
+    position while they wait
+  - with the queue full (or the wait used up) the request is shed with a
+    Retry-After estimate instead of hanging until the gunicorn timeout
+
+State is per process, like the rest of /_stats; with one worker per instance
+that is the whole instance. Queued requests hold a gunicorn thread while they
+wait, so --threads needs room for AIA_MAX_INFLIGHT + AIA_ADMISSION_QUEUE plus
+a couple for the other routes.
+"""
+import os
+import time
+import math
+import threading
+from collections import deque
+
+MAX_INFLIGHT = int(os.getenv('AIA_MAX_INFLIGHT', '4'))
+ADMISSION_QUEUE = int(os.getenv('AIA_ADMISSION_QUEUE', '6'))
+ADMISSION_MAX_WAIT = float(os.getenv('AIA_ADMISSION_MAX_WAIT', '90'))
+TOKENS_PER_MINUTE = int(os.getenv('AIA_TOKENS_PER_MINUTE', '0'))         # 0 = no token budget
+COST_PER_MINUTE_USD = float(os.getenv('AIA_COST_PER_MINUTE_USD', '0'))   # 0 = no cost budget
+
+_WINDOW = 60.0
+_POLL = 1.0                # budget frees up as spend ages out; nothing signals it
+_KEEPALIVE = 10.0          # re-send an unchanged queue position this often
+_ASYNC_POLL = 0.25         # wait_async() has no condition to sleep on
+_DEFAULT_DURATION = 60.0   # seconds per request until some have been timed
+
+
+class Overloaded(Exception):
+    """No room now; try again in retry_after seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SpendWindow:
+    """Tokens and USD spent over the last minute."""
+
+    def __init__(self, window=_WINDOW):
+        self.window = window
+        self._events = deque()  # (time, tokens, cost)
+        self._tokens = 0
+        self._cost = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, tokens, cost):
+        with self._lock:
+            self._events.append((time.monotonic(), tokens, cost))
+            self._tokens += tokens
+            self._cost += cost
+
+    def totals(self):
+        """(tokens, cost, seconds until the oldest spend ages out)"""
+        now = time.monotonic()
+        with self._lock:
+            while self._events and self._events[0][0] <= now - self.window:
+                _, tokens, cost = self._events.popleft()
+                self._tokens -= tokens
+                self._cost -= cost
+            next_expiry = self._events[0][0] + self.window - now if self._events else 0.0
+            return self._tokens, max(self._cost, 0.0), next_expiry
+
+
+spend = SpendWindow()
+
+
+def record_spend(tokens, cost):
+    """Called for every logged API call (anthropic_utils.log_api_usage)."""
+    spend.add(tokens, cost)
+
+
+class Ticket:
+    """One request's place in line. Release it exactly once when the request
+    ends; release() is idempotent, so it's safe from several cleanup paths."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.created = time.monotonic()
+        self.admitted = False
+        self.released = False
+        self.admitted_at = None
+
+    def _position(self):
+        """None once admitted, else the current queue position. Raises
+        Overloaded once the wait has run past max_wait."""
+        c = self.controller
+        with c._cond:
+            if c._try_admit(self):
+                return None
+            if time.monotonic() >= self.created + c.max_wait:
+                c._drop(self)
+                c._counts['timed_out'] += 1
+                raise Overloaded('queue wait timed out', c._retry_after())
+            return c._queue.index(self) + 1
+
+    def _report(self, position, last):
+        """Whether to send position to the client: on change, or as a keepalive."""
+        now = time.monotonic()
+        if position != last[0] or now - last[1] >= _KEEPALIVE:
+            last[:] = [position, now]
+            return True
+        return False
+
+    def wait(self):
+        """Block until admitted, yielding the queue position (1 = next) each
+        time it changes and every few seconds as a keepalive. Raises
+        Overloaded if the wait runs past max_wait."""
+        c = self.controller
+        last = [None, 0.0]
+        while True:
+            position = self._position()
+            if position is None:
+                return
+            if self._report(position, last):
+                yield position
+            with c._cond:
+                if not self.admitted:
+                    c._cond.wait(min(_POLL, max(self.created + c.max_wait - time.monotonic(), 0)))
+
+    async def wait_async(self):
+        """wait() for the asyncio path (asgi.py): same positions, but polled
+        so the event loop is never blocked on the condition."""
+        import asyncio  # only the ASGI path pays for it
+        last = [None, 0.0]
+        while True:
+            position = self._position()
+            if position is None:
+                return
+            if self._report(position, last):
+                yield position
+            await asyncio.sleep(_ASYNC_POLL)
+
+    def release(self):
+        c = self.controller
+        with c._cond:
+            if self.released:
+                return
+            self.released = True
+            if self.admitted:
+                c._inflight -= 1
+                c._durations.append(time.monotonic() - self.admitted_at)
+            else:
+                c._drop(self)
+            c._cond.notify_all()
+
+
+class AdmissionController:
+    def __init__(self, max_inflight=MAX_INFLIGHT, max_queue=ADMISSION_QUEUE, max_wait=ADMISSION_MAX_WAIT,
+                 tokens_per_minute=TOKENS_PER_MINUTE, cost_per_minute=COST_PER_MINUTE_USD, spend_window=spend):
+        self.max_inflight = max(1, max_inflight)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.tokens_per_minute = tokens_per_minute
+        self.cost_per_minute = cost_per_minute
+        self.spend = spend_window
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._queue = deque()
+        self._durations = deque(maxlen=50)
+        self._counts = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0, 'budget_waits': 0}
+
+    def _budget_wait(self):
+        """Seconds until the per-minute budget has room again; 0 = it has room now."""
+        tokens, cost, next_expiry = self.spend.totals()
+        over = ((self.tokens_per_minute and tokens >= self.tokens_per_minute)
+                or (self.cost_per_minute and cost >= self.cost_per_minute))
+        return max(next_expiry, _POLL) if over else 0.0
+
+    def _retry_after(self):
+        budget_wait = self._budget_wait()
+        if budget_wait:
+            return math.ceil(budget_wait)
+        # Everyone ahead has to finish, max_inflight at a time
+        avg = sum(self._durations) / len(self._durations) if self._durations else _DEFAULT_DURATION
+        rounds = (len(self._queue) + self._inflight + 1) / self.max_inflight
+        return max(1, math.ceil(avg * rounds))
+
+    def _admit(self, ticket):
+        ticket.admitted = True
+        ticket.admitted_at = time.monotonic()
+        self._inflight += 1
+        self._counts['admitted'] += 1
+
+    def _try_admit(self, ticket):
+        if ticket.admitted:
+            return True
+        if not self._queue or self._queue[0] is not ticket or self._inflight >= self.max_inflight:
+            return False
+        if self._budget_wait():
+            return False
+        self._queue.popleft()
+        self._admit(ticket)
+        self._cond.notify_all()
+        return True
+
+    def _drop(self, ticket):
+        try:
+            self._queue.remove(ticket)
+        except ValueError:
+            pass
+
+    def request(self):
+        """A Ticket, already admitted if there's room now, otherwise queued
+        (call ticket.wait()). Raises Overloaded if the queue is full."""
+        ticket = Ticket(self)
+        with self._cond:
+            budget_wait = self._budget_wait()
+            if budget_wait:
+                self._counts['budget_waits'] += 1
+            if not self._queue and self._inflight < self.max_inflight and not budget_wait:
+                self._admit(ticket)
+                return ticket
+            if len(self._queue) >= self.max_queue:
+                self._counts['rejected'] += 1
+                raise Overloaded('queue full', self._retry_after())
+            self._queue.append(ticket)
+            self._counts['queued'] += 1
+            return ticket
+
+    def stats(self):
+        tokens, cost, _ = self.spend.totals()
+        with self._cond:
+            stats = dict(self._counts)
+            stats.update({
+                'inflight': self._inflight, 'max_inflight': self.max_inflight,
+                'queued_now': len(self._queue), 'max_queue': self.max_queue,
+                'tokens_last_minute': tokens, 'tokens_per_minute': self.tokens_per_minute,
+                'cost_last_minute_usd': round(cost, 6), 'cost_per_minute_usd': self.cost_per_minute,
+                'avg_request_sec': (round(sum(self._durations) / len(self._durations), 1)
+                                    if self._durations else None),
+            })
+        return stats
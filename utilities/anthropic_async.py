@@ -0,0 +1,186 @@
+"""asyncio variants of the anthropic_utils calls, for the ASGI entry point (asgi.py).
+
+Same request bodies, caches, model routing, usage logging and stage stats as
+the threaded path; only the transport differs. One shared httpx.AsyncClient
+per process means an open /generate stream costs a coroutine and a pooled
+connection rather than a thread, so one worker can hold hundreds of them.
+httpx is imported on first use, like requests is on the threaded path.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import aclosing
+
+from . import anthropic_utils as U
+from .uploads import encode_body
+from .anthropic_utils import (HTTP_CONNECT_TIMEOUT, STAGE_MODELS, FALLBACK_MODEL, BATCHED_FEATURE, DEFAULT_STYLE,
+                              _search_cache, _style_cache, _normalize_topic, _style_cache_key, _search_body,
+                              _style_body, _article_body, _batched_articles_body, _parse_sources, _check_style,
+                              _parse_batched_articles, _stream_event, _log_call, _stage_stats, _stage_lock)
+
+logger = logging.getLogger(__name__)
+
+# Connections to the API shared by every stream in the process. Size it for
+# AIA_ASGI_MAX_INFLIGHT requests times the per-request fan-out (200 x 3 by
+# default); a smaller pool queues article streams behind each other.
+ASYNC_HTTP_POOL_SIZE = int(os.getenv('AIA_ASYNC_HTTP_POOL_SIZE', '600'))
+
+_client = None
+_search_flights = {}  # normalized topic -> task of the search in flight
+_stats = {'requests': 0, 'streams_open': 0, 'streams_peak': 0, 'search_coalesced': 0}
+
+
+def _get_client():
+    global _client
+    if _client is None:
+        import httpx
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_HTTP_POOL_SIZE, max_keepalive_connections=ASYNC_HTTP_POOL_SIZE),
+            timeout=httpx.Timeout(60, connect=HTTP_CONNECT_TIMEOUT))
+    return _client
+
+
+async def aclose_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def async_http_stats():
+    return {**_stats, 'pool_size': ASYNC_HTTP_POOL_SIZE}
+
+
+async def _headers():
+    # get_secret is a dict hit once the key is cached, but the first read (or a
+    # Secret Manager refresh) blocks, so keep it off the event loop
+    return await asyncio.to_thread(U._get_headers)
+
+
+def _timeout(read):
+    import httpx
+    return httpx.Timeout(read, connect=HTTP_CONNECT_TIMEOUT)
+
+
+async def _acall_claude(body, timeout=60, user_id=None, tally=None, feature=None, stage=None):
+    start = time.time()
+    payload = encode_body(body)
+    headers = {**await _headers(), 'content-length': str(len(payload))}
+    r = await _get_client().post(U.API_URL, headers=headers, timeout=_timeout(timeout),
+                                 content=payload if isinstance(payload, bytes) else payload.aiter())
+    _stats['requests'] += 1
+    r.raise_for_status()
+    data = r.json()
+    if 'usage' in data:
+        _log_call(body, data['usage'], int((time.time() - start) * 1000), user_id=user_id, tally=tally,
+                  feature=feature, stage=stage)
+    return data
+
+
+async def _astream_claude(body, timeout=60, user_id=None, tally=None, stage=None, on_start=None):
+    """Async _stream_claude: yields text deltas; usage is logged when the
+    stream ends, is closed early, or is cancelled."""
+    start = time.time()
+    usage = {}
+    headers = await _headers()
+    _stats['requests'] += 1
+    _stats['streams_open'] += 1
+    _stats['streams_peak'] = max(_stats['streams_peak'], _stats['streams_open'])
+    try:
+        async with _get_client().stream('POST', U.API_URL, headers=headers, json={**body, 'stream': True},
+                                        timeout=_timeout(timeout)) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                event = json.loads(line[5:])
+                text = _stream_event(event, usage)
+                if on_start and event.get('type') == 'message_start':
+                    on_start()
+                if text:
+                    yield text
+    finally:
+        _stats['streams_open'] -= 1
+        if usage:
+            _log_call(body, usage, int((time.time() - start) * 1000), user_id=user_id, streaming=True, tally=tally,
+                      stage=stage)
+
+
+async def _acall_routed(stage, body, check, **kwargs):
+    """Async _call_routed: the stage's model, retried once on FALLBACK_MODEL
+    if its output fails check. Returns the last (value, ok)."""
+    model = STAGE_MODELS[stage]
+    with _stage_lock: _stage_stats[stage]['routed'] += 1
+    value, ok = check(await _acall_claude({**body, 'model': model}, stage=stage, **kwargs))
+    if not ok and model != FALLBACK_MODEL:
+        with _stage_lock: _stage_stats[stage]['fallbacks'] += 1
+        logger.warning(f"{stage}: {model} output failed its check, retrying on {FALLBACK_MODEL}")
+        value, ok = check(await _acall_claude({**body, 'model': FALLBACK_MODEL}, stage=stage, **kwargs))
+    return value, ok
+
+
+async def _search_uncached(key, topic, tally):
+    try:
+        sources, _ = await _acall_routed('search', _search_body(topic), _parse_sources, tally=tally)
+        if sources:
+            _search_cache.set(key, sources)
+        return sources
+    finally:
+        _search_flights.pop(key, None)
+
+
+async def asearch_sources(topic, refresh=False, tally=None):
+    """Async search_sources, on the same cache. Concurrent misses for a topic
+    share one search; a caller that goes away doesn't cancel it for the rest."""
+    key = _normalize_topic(topic)
+    if not refresh:
+        sources = _search_cache.get(key)
+        if sources is not None:
+            return sources
+    task = _search_flights.get(key)
+    if task is None:
+        task = _search_flights[key] = asyncio.ensure_future(_search_uncached(key, topic, tally))
+    else:
+        _stats['search_coalesced'] += 1
+    return await asyncio.shield(task)
+
+
+async def aanalyze_style(file_contents=None, sample_content=None, tally=None):
+    """Async analyze_style, on the same style cache."""
+    if not sample_content and not file_contents:
+        return DEFAULT_STYLE
+    # Hashing the uploads (up to the upload cap), text extraction, sampling
+    # and the SQLite tier all block; keep them off the event loop
+    key = await asyncio.to_thread(_style_cache_key, file_contents, sample_content)
+    style = await asyncio.to_thread(_style_cache.get, key)
+    if style is None:
+        body = await asyncio.to_thread(_style_body, file_contents, sample_content)
+        if body is None:
+            return DEFAULT_STYLE
+        style, ok = await _acall_routed('style', body, _check_style, tally=tally)
+        if not ok:
+            logger.warning("Style analysis failed its check on every model; using it uncached")
+        else:
+            await asyncio.to_thread(_style_cache.set, key, style)
+    return style
+
+
+async def agenerate_single_article(source, style, index, tally=None, cache=True):
+    data = await _acall_claude(_article_body(source, style, index, cache), tally=tally, stage='article')
+    return {"content": data['content'][0]['text'], "source": source}
+
+
+async def agenerate_single_article_stream(source, style, index, tally=None, on_start=None):
+    async with aclosing(_astream_claude(_article_body(source, style, index), tally=tally, stage='article',
+                                        on_start=on_start)) as stream:
+        async for text in stream:
+            yield text
+
+
+async def agenerate_articles_batched(sources, style, tally=None):
+    data = await _acall_claude(_batched_articles_body(sources, style), timeout=120, tally=tally,
+                               feature=BATCHED_FEATURE, stage='article')
+    posts = _parse_batched_articles(data, len(sources))
+    return {i: {"content": text, "source": sources[i]} for i, text in posts.items()}
@@ -17,18 +17,21 @@ Public API:
 
 Key source: kumori-404602/KUMORI_ANTHROPIC_API_KEY (cross-project read).
 DB target:  kumori-404602 Postgres, table kumori_api_usage.
+Pricing:    utilities/pricing.py when the host app ships it, else the inline table.
 
 Both reads require the consuming project's service account to have
 roles/secretmanager.secretAccessor on kumori-404602 — every App Engine SA
 already has this grant per the kumori-infrastructure skill.
 
-All logging is fire-and-forget in a daemon thread. Never blocks the Anthropic
-call path. Never raises. Any DB write failure is swallowed with a log warning.
+All logging is fire-and-forget on a background thread (the host app's batched
+usage writer when it ships one). Never blocks the Anthropic call path. Never
+raises. Any DB write failure is swallowed with a log warning.
 """
 from __future__ import annotations
 
 import os
 import re
+import sys
 import time
 import logging
 import threading
@@ -40,144 +43,174 @@ from anthropic import Anthropic, APIError, APIStatusError, APIConnectionError, A
 logger = logging.getLogger("anthropic_logger")
 
 # ─── Model pricing (per token) ────────────────────────────────────────────────
-# Ported from scatterbrain/utilities/claude_utils.py MODEL_PRICING on 2026-04-23.
-# Update here when rates change or new models ship. Single source.
-
-MODEL_PRICING = {
-    # Claude 4.7 / 4.6 flagship Opus — $5/$25 per 1M (verified 2026-05-07
-    # against LiteLLM upstream; was incorrectly $15/$75 prior to that, which
-    # is what caused the kumori_api_usage drift on opus-4-7 traffic).
-    'claude-opus-4-7':         {'input': 0.000005,    'output': 0.000025},
-    'claude-opus-4-6':         {'input': 0.000005,    'output': 0.000025},
-    'claude-sonnet-4-6':       {'input': 0.000003,    'output': 0.000015},    # $3  / $15
-
-    # Claude 4.5
-    'claude-sonnet-4-5':       {'input': 0.000003,    'output': 0.000015},
-    'claude-haiku-4-5':        {'input': 0.0000010,   'output': 0.000005},    # $1  / $5  per 1M
-
-    # Claude 4.1 / 4
-    'claude-opus-4-1':         {'input': 0.000020,    'output': 0.000080},
-    'claude-opus-4':           {'input': 0.000015,    'output': 0.000075},
-    'claude-sonnet-4':         {'input': 0.000003,    'output': 0.000015},
-
-    # Claude 3.x
-    'claude-3-7-sonnet':       {'input': 0.000003,    'output': 0.000015},
-    'claude-3-5-sonnet':       {'input': 0.000003,    'output': 0.000015},
-    'claude-3-5-haiku':        {'input': 0.00000025,  'output': 0.00000125},
-    'claude-3-haiku':          {'input': 0.00000025,  'output': 0.00000125},
-
-    # Fallback (Sonnet-tier pricing)
-    'default':                 {'input': 0.000003,    'output': 0.000015},
-}
-
-CACHE_WRITE_MULT = 1.25  # cache creation costs 1.25x input rate
-CACHE_READ_MULT  = 0.10  # cache read costs 0.10x input rate
-WEB_SEARCH_COST  = 0.01  # flat per web search request
-
-
-# ─── DB-backed pricing (auto-refreshed daily from LiteLLM upstream JSON) ──────
-# kumori_model_pricing table is populated by kumori's /cron/anthropic-pricing-refresh.
-# We read with a 5-min in-process TTL cache. Any DB miss/error → static dict above.
-
-_DB_PRICING_CACHE: dict | None = None
-_DB_PRICING_FETCHED_AT: float = 0.0
-_DB_PRICING_TTL_SEC = 300
-
-
-def _load_db_pricing() -> dict:
-    """Return {model_id: {input, output, cache_write_abs, cache_read_abs}}.
-    Empty dict on any error — caller falls back to MODEL_PRICING."""
-    global _DB_PRICING_CACHE, _DB_PRICING_FETCHED_AT
-    now = time.time()
-    if _DB_PRICING_CACHE is not None and (now - _DB_PRICING_FETCHED_AT) < _DB_PRICING_TTL_SEC:
-        return _DB_PRICING_CACHE
-    try:
-        import psycopg2
-        creds = _get_db_creds()
-        is_gcp = os.environ.get('GAE_ENV', '').startswith('standard') or os.path.exists('/cloudsql')
-        if is_gcp:
-            socket_dir = os.environ.get('DB_SOCKET_DIR', '/cloudsql')
-            host = f"{socket_dir}/{creds['connection_name']}"
-        else:
-            host = creds['host']
-        conn = psycopg2.connect(
-            host=host, dbname=creds['dbname'], user=creds['user'],
-            password=creds['password'], connect_timeout=5,
-            options='-c statement_timeout=5000',
-        )
+# Host apps that ship utilities/pricing.py share its rates, kumori_model_pricing
+# overlay and model → rate index with their own usage logging, so the two can't
+# drift. Dropped in on its own, this file falls back to the inline table below.
+
+try:
+    from utilities.pricing import (
+        MODEL_PRICING, CACHE_WRITE_MULT, CACHE_READ_MULT, WEB_SEARCH_COST,
+        pricing_for as _pricing_for, compute_cost, canonical_model_id as _canonical_model_id,
+    )
+except ImportError:
+    MODEL_PRICING = {
+        # Claude 4.7 / 4.6 flagship Opus — $5/$25 per 1M (verified 2026-05-07
+        # against LiteLLM upstream; was incorrectly $15/$75 prior to that, which
+        # is what caused the kumori_api_usage drift on opus-4-7 traffic).
+        'claude-opus-4-7':         {'input': 0.000005,    'output': 0.000025},
+        'claude-opus-4-6':         {'input': 0.000005,    'output': 0.000025},
+        'claude-sonnet-4-6':       {'input': 0.000003,    'output': 0.000015},    # $3  / $15
+
+        # Claude 4.5
+        'claude-sonnet-4-5':       {'input': 0.000003,    'output': 0.000015},
+        'claude-haiku-4-5':        {'input': 0.0000010,   'output': 0.000005},    # $1  / $5  per 1M
+
+        # Claude 4.1 / 4
+        'claude-opus-4-1':         {'input': 0.000020,    'output': 0.000080},
+        'claude-opus-4':           {'input': 0.000015,    'output': 0.000075},
+        'claude-sonnet-4':         {'input': 0.000003,    'output': 0.000015},
+
+        # Claude 3.x
+        'claude-3-7-sonnet':       {'input': 0.000003,    'output': 0.000015},
+        'claude-3-5-sonnet':       {'input': 0.000003,    'output': 0.000015},
+        'claude-3-5-haiku':        {'input': 0.00000025,  'output': 0.00000125},
+        'claude-3-haiku':          {'input': 0.00000025,  'output': 0.00000125},
+
+        # Fallback (Sonnet-tier pricing)
+        'default':                 {'input': 0.000003,    'output': 0.000015},
+    }
+
+    CACHE_WRITE_MULT = 1.25  # cache creation costs 1.25x input rate
+    CACHE_READ_MULT  = 0.10  # cache read costs 0.10x input rate
+    WEB_SEARCH_COST  = 0.01  # flat per web search request
+
+    # kumori_model_pricing is populated by kumori's /cron/anthropic-pricing-refresh.
+    # Read with a 5-min in-process TTL cache. Any DB miss/error → static dict above.
+    _DB_PRICING_CACHE: dict | None = None
+    _DB_PRICING_FETCHED_AT: float = 0.0
+    _DB_PRICING_TTL_SEC = 300
+
+    def _load_db_pricing() -> dict:
+        """Return {model_id: {input, output, cache_write_abs, cache_read_abs}}.
+        Empty dict on any error — caller falls back to MODEL_PRICING."""
+        global _DB_PRICING_CACHE, _DB_PRICING_FETCHED_AT
+        now = time.time()
+        if _DB_PRICING_CACHE is not None and (now - _DB_PRICING_FETCHED_AT) < _DB_PRICING_TTL_SEC:
+            return _DB_PRICING_CACHE
         try:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT model_id,
-                       input_cost_per_token::float,
-                       output_cost_per_token::float,
-                       cache_write_cost_per_token::float,
-                       cache_read_cost_per_token::float
-                FROM kumori_model_pricing
-            """)
-            out = {}
-            for mid, inp, outp, cw, cr in cur.fetchall():
-                d = {'input': float(inp or 0), 'output': float(outp or 0)}
-                if cw is not None:
-                    d['cache_write_abs'] = float(cw)
-                if cr is not None:
-                    d['cache_read_abs'] = float(cr)
-                out[mid.lower()] = d
-            _DB_PRICING_CACHE = out
+            import psycopg2
+            creds = _get_db_creds()
+            is_gcp = os.environ.get('GAE_ENV', '').startswith('standard') or os.path.exists('/cloudsql')
+            if is_gcp:
+                socket_dir = os.environ.get('DB_SOCKET_DIR', '/cloudsql')
+                host = f"{socket_dir}/{creds['connection_name']}"
+            else:
+                host = creds['host']
+            conn = psycopg2.connect(
+                host=host, dbname=creds['dbname'], user=creds['user'],
+                password=creds['password'], connect_timeout=5,
+                options='-c statement_timeout=5000',
+            )
+            try:
+                cur = conn.cursor()
+                cur.execute("""
+                    SELECT model_id,
+                           input_cost_per_token::float,
+                           output_cost_per_token::float,
+                           cache_write_cost_per_token::float,
+                           cache_read_cost_per_token::float
+                    FROM kumori_model_pricing
+                """)
+                out = {}
+                for mid, inp, outp, cw, cr in cur.fetchall():
+                    d = {'input': float(inp or 0), 'output': float(outp or 0)}
+                    if cw is not None:
+                        d['cache_write_abs'] = float(cw)
+                    if cr is not None:
+                        d['cache_read_abs'] = float(cr)
+                    out[mid.lower()] = d
+                _DB_PRICING_CACHE = out
+                _DB_PRICING_FETCHED_AT = now
+                return out
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"anthropic_logger: DB pricing fetch failed, using static fallback: {e}")
+            # Cache the empty dict for the TTL so we don't hammer the DB on every call.
+            _DB_PRICING_CACHE = {}
             _DB_PRICING_FETCHED_AT = now
-            return out
-        finally:
-            conn.close()
-    except Exception as e:
-        logger.warning(f"anthropic_logger: DB pricing fetch failed, using static fallback: {e}")
-        # Cache the empty dict for the TTL so we don't hammer the DB on every call.
-        _DB_PRICING_CACHE = {}
-        _DB_PRICING_FETCHED_AT = now
-        return {}
-
-
-def _pricing_for(model: str) -> dict:
-    m = (model or '').lower()
+            return {}
+
+    def _pricing_for(model: str) -> dict:
+        m = (model or '').lower()
+        # 1. DB first — exact match wins, then substring containment.
+        db = _load_db_pricing()
+        if m in db:
+            return db[m]
+        for mid, p in db.items():
+            if mid in m or m in mid:
+                return p
+        # 2. Static dict fallback (substring match preserves legacy behavior).
+        for key, p in MODEL_PRICING.items():
+            if key in m:
+                return p
+        return MODEL_PRICING['default']
+
+    def compute_cost(model, input_tokens=0, output_tokens=0, cache_creation_tokens=0,
+                     cache_read_tokens=0, thinking_tokens=0, web_search_requests=0) -> float:
+        p = _pricing_for(model)
+        cache_write_rate = p.get('cache_write_abs', p['input'] * CACHE_WRITE_MULT)
+        cache_read_rate  = p.get('cache_read_abs',  p['input'] * CACHE_READ_MULT)
+        return (
+            input_tokens * p['input']
+            + output_tokens * p['output']
+            + cache_creation_tokens * cache_write_rate
+            + cache_read_tokens * cache_read_rate
+            + thinking_tokens * p['output']
+            + web_search_requests * WEB_SEARCH_COST
+        )
 
-    # 1. Try DB first — exact match wins, then substring containment.
-    db = _load_db_pricing()
-    if m in db:
-        return db[m]
-    for mid, p in db.items():
-        if mid in m or m in mid:
-            return p
+    _DATED_MODEL_RE = re.compile(r'-(\d{8})$')
 
-    # 2. Static dict fallback (substring match preserves legacy behavior).
-    for key, p in MODEL_PRICING.items():
-        if key in m:
-            return p
-    return MODEL_PRICING['default']
+    def _canonical_model_id(model: str) -> str:
+        """Strip Anthropic dated suffix (-YYYYMMDD) so the kumori_api_usage
+        model column matches the admin usage_report's canonical rows."""
+        if not model:
+            return model
+        return _DATED_MODEL_RE.sub('', model)
 
 
 # ─── Secret Manager + Anthropic client (cached module-level) ──────────────────
 
-_KEY_CACHE = None
 _CLIENT = None
 _KUMORI_PROJECT = 'kumori-404602'
 
+# Host apps that ship utilities/google_secret_utils.py share its cached,
+# rotated secrets. Without it we read Secret Manager directly, once per secret.
+try:
+    from utilities.google_secret_utils import get_secret
+except ImportError:
+    _SECRET_CACHE: dict = {}
+
+    def get_secret(name: str, project: str = _KUMORI_PROJECT) -> str:
+        key = f"{project}:{name}"
+        if key not in _SECRET_CACHE:
+            from google.cloud import secretmanager
+            client = secretmanager.SecretManagerServiceClient()
+            path = f"projects/{project}/secrets/{name}/versions/latest"
+            _SECRET_CACHE[key] = client.access_secret_version(request={"name": path}).payload.data.decode("UTF-8")
+        return _SECRET_CACHE[key]
+
 
 def _get_api_key() -> str:
     """Fetch KUMORI_ANTHROPIC_API_KEY from kumori-404602 Secret Manager.
-    Cached after first call. Falls back to ANTHROPIC_API_KEY env var for local dev."""
-    global _KEY_CACHE
-    if _KEY_CACHE:
-        return _KEY_CACHE
+    Cached (and rotated) by utilities.google_secret_utils. Falls back to
+    ANTHROPIC_API_KEY env var for local dev."""
     env_key = os.environ.get('ANTHROPIC_API_KEY')
     if env_key and env_key.startswith('sk-ant-api'):
-        _KEY_CACHE = env_key
-        return _KEY_CACHE
+        return env_key
     try:
-        from google.cloud import secretmanager
-        client = secretmanager.SecretManagerServiceClient()
-        name = f"projects/{_KUMORI_PROJECT}/secrets/KUMORI_ANTHROPIC_API_KEY/versions/latest"
-        resp = client.access_secret_version(request={"name": name})
-        _KEY_CACHE = resp.payload.data.decode("UTF-8")
-        return _KEY_CACHE
+        return get_secret('KUMORI_ANTHROPIC_API_KEY', _KUMORI_PROJECT)
     except Exception as e:
         raise RuntimeError(
             f"anthropic_logger: could not fetch KUMORI_ANTHROPIC_API_KEY from "
@@ -216,25 +249,41 @@ def new_client(**kwargs) -> Anthropic:
 #     SELECT * FROM kumori_anthropic_call_trace WHERE model = '...' AND created_at >= '<leak hour>'
 # returns the exact set of calls that bypass kumori_api_usage. Independent
 # table — never affects reconciliation, only forensics.
-import inspect
-
 _skip_trace_local = threading.local()
 _THIS_FILE = os.path.abspath(__file__)
 _TRACE_TABLE_READY = False
 
+# code object -> (abs filename, is this module). Resolving a frame's file is
+# the expensive part and never changes for a given code object, so it's done
+# once per function rather than once per call.
+_CODE_SITE_CACHE: dict = {}
 
-def _caller_site() -> tuple[str, int, str]:
-    """First stack frame outside this module."""
-    for frame in inspect.stack()[1:]:
+
+def _code_site(code) -> tuple[str | None, bool]:
+    site = _CODE_SITE_CACHE.get(code)
+    if site is None:
         try:
-            fn = os.path.abspath(frame.filename)
+            fn = os.path.abspath(code.co_filename)
+            internal = fn == _THIS_FILE or fn.endswith('anthropic_logger.py')
         except Exception:
-            continue
-        if fn == _THIS_FILE:
-            continue
-        if fn.endswith('anthropic_logger.py'):
-            continue
-        return fn, frame.lineno, frame.function
+            fn, internal = None, True
+        site = _CODE_SITE_CACHE[code] = (fn, internal)
+    return site
+
+
+def _caller_site() -> tuple[str, int, str]:
+    """First stack frame outside this module.
+
+    Walks frames lazily via sys._getframe and stops at the first foreign one.
+    inspect.stack() would build FrameInfo (with source context read from
+    disk) for the entire stack on every traced call."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        fn, internal = _code_site(code)
+        if not internal:
+            return fn, frame.f_lineno, code.co_name
+        frame = frame.f_back
     return ('unknown', 0, 'unknown')
 
 
@@ -391,28 +440,25 @@ def _wrap_for_trace(real_client):
 
 # ─── DB logging (fire-and-forget) ─────────────────────────────────────────────
 
-_DB_CREDS_CACHE = None
-
-
-def _get_db_creds() -> dict:
-    global _DB_CREDS_CACHE
-    if _DB_CREDS_CACHE:
+# Same creds (and secret cache) as the host app's utilities.db when it ships
+# one; otherwise the five secrets fetched one by one.
+try:
+    from utilities.db import get_db_creds as _get_db_creds
+except ImportError:
+    _DB_CREDS_CACHE = None
+
+    def _get_db_creds() -> dict:
+        global _DB_CREDS_CACHE
+        if _DB_CREDS_CACHE:
+            return _DB_CREDS_CACHE
+        _DB_CREDS_CACHE = {
+            'host': get_secret('KUMORI_POSTGRES_IP'),
+            'dbname': get_secret('KUMORI_POSTGRES_DB_NAME'),
+            'user': get_secret('KUMORI_POSTGRES_USERNAME'),
+            'password': get_secret('KUMORI_POSTGRES_PASSWORD'),
+            'connection_name': get_secret('KUMORI_POSTGRES_CONNECTION_NAME'),
+        }
         return _DB_CREDS_CACHE
-    from google.cloud import secretmanager
-    client = secretmanager.SecretManagerServiceClient()
-
-    def fetch(name: str) -> str:
-        path = f"projects/{_KUMORI_PROJECT}/secrets/{name}/versions/latest"
-        return client.access_secret_version(request={"name": path}).payload.data.decode("UTF-8")
-
-    _DB_CREDS_CACHE = {
-        'host': fetch('KUMORI_POSTGRES_IP'),
-        'dbname': fetch('KUMORI_POSTGRES_DB_NAME'),
-        'user': fetch('KUMORI_POSTGRES_USERNAME'),
-        'password': fetch('KUMORI_POSTGRES_PASSWORD'),
-        'connection_name': fetch('KUMORI_POSTGRES_CONNECTION_NAME'),
-    }
-    return _DB_CREDS_CACHE
 
 
 def _usage_field(usage: Any, key: str, default: int = 0) -> int:
@@ -427,53 +473,43 @@ def _usage_field(usage: Any, key: str, default: int = 0) -> int:
     return default
 
 
-def _compute_cost(model: str, usage: Any) -> float:
-    p = _pricing_for(model)
+# Host apps that ship utilities/usage_writer.py get one long-lived writer per
+# process (pooled connections, multi-row batches). Without it we fall back to
+# a connection per row.
+try:
+    from utilities.usage_writer import get_usage_writer
+except ImportError:
+    get_usage_writer = None
+
+
+def _usage_row(*, app_name: str, model: str, usage: Any,
+               feature: Optional[str], user_id: Optional[str],
+               duration_ms: Optional[int], streaming: bool,
+               image_count: int) -> tuple:
+    """kumori_api_usage column values, in INSERT order."""
     i = _usage_field(usage, 'input_tokens')
     o = _usage_field(usage, 'output_tokens')
     cc = _usage_field(usage, 'cache_creation_input_tokens')
     cr = _usage_field(usage, 'cache_read_input_tokens')
     th = _usage_field(usage, 'thinking_tokens')
 
-    # server-side tool usage lives in usage.server_tool_use
     server = getattr(usage, 'server_tool_use', None) or (
         usage.get('server_tool_use', {}) if isinstance(usage, dict) else {}
     ) or {}
     ws = _usage_field(server, 'web_search_requests')
+    wf = _usage_field(server, 'web_fetch_requests')
+    ce = _usage_field(server, 'code_execution_requests')
 
-    cache_write_rate = p.get('cache_write_abs', p['input'] * CACHE_WRITE_MULT)
-    cache_read_rate  = p.get('cache_read_abs',  p['input'] * CACHE_READ_MULT)
-
-    return (
-        i * p['input']
-        + o * p['output']
-        + cc * cache_write_rate
-        + cr * cache_read_rate
-        + th * p['output']
-        + ws * WEB_SEARCH_COST
-    )
-
-
-_DATED_MODEL_RE = re.compile(r'-(\d{8})$')
-
+    model = _canonical_model_id(model)
+    cost = compute_cost(model, i, o, cc, cr, th, ws)
 
-def _canonical_model_id(model: str) -> str:
-    """Strip Anthropic dated suffix (-YYYYMMDD) so e.g.
-    claude-haiku-4-5-20251001 → claude-haiku-4-5. Anthropic's admin usage_report
-    always returns the dated form; the API accepts both. If we let the dated
-    form into kumori_api_usage, the hourly reconciler sees the same hour's
-    traffic split across two model rows and fires a false-positive leak alert.
-    Apply this at the write boundary so the column is always canonical."""
-    if not model:
-        return model
-    return _DATED_MODEL_RE.sub('', model)
+    return (app_name, feature, model, i, o, cc, cr, th,
+            ws, wf, ce, image_count, cost, streaming, user_id, duration_ms)
 
 
-def _insert_usage_row(*, app_name: str, model: str, usage: Any,
-                      feature: Optional[str], user_id: Optional[str],
-                      duration_ms: Optional[int], streaming: bool,
-                      image_count: int):
-    """Blocking INSERT into kumori_api_usage. Called from daemon thread."""
+def _insert_usage_row(**row_kwargs):
+    """Blocking single-row INSERT into kumori_api_usage. Fallback path when
+    there's no shared usage writer; called from daemon thread."""
     import psycopg2
     creds = _get_db_creds()
 
@@ -484,21 +520,7 @@ def _insert_usage_row(*, app_name: str, model: str, usage: Any,
     else:
         host = creds['host']
 
-    i = _usage_field(usage, 'input_tokens')
-    o = _usage_field(usage, 'output_tokens')
-    cc = _usage_field(usage, 'cache_creation_input_tokens')
-    cr = _usage_field(usage, 'cache_read_input_tokens')
-    th = _usage_field(usage, 'thinking_tokens')
-
-    server = getattr(usage, 'server_tool_use', None) or (
-        usage.get('server_tool_use', {}) if isinstance(usage, dict) else {}
-    ) or {}
-    ws = _usage_field(server, 'web_search_requests')
-    wf = _usage_field(server, 'web_fetch_requests')
-    ce = _usage_field(server, 'code_execution_requests')
-
-    model = _canonical_model_id(model)
-    cost = _compute_cost(model, usage)
+    row = _usage_row(**row_kwargs)
 
     conn = psycopg2.connect(
         host=host, dbname=creds['dbname'], user=creds['user'],
@@ -514,8 +536,7 @@ def _insert_usage_row(*, app_name: str, model: str, usage: Any,
              web_search_requests, web_fetch_requests, code_execution_requests,
              image_count, estimated_cost_usd, streaming, user_id, duration_ms)
             VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (app_name, feature, model, i, o, cc, cr, th,
-              ws, wf, ce, image_count, cost, streaming, user_id, duration_ms))
+        """, row)
         conn.commit()
     finally:
         conn.close()
@@ -527,8 +548,9 @@ def log_usage_async(*, app_name: str, model: str, usage: Any,
                     image_count: int = 0) -> None:
     """Log to kumori_api_usage.
 
-    In long-running environments (App Engine, local) this spawns a daemon thread
-    and returns immediately — fire-and-forget, never blocks.
+    In long-running environments (App Engine, local) this hands the row to the
+    process's batched usage writer (or, without one, a daemon thread) and
+    returns immediately — fire-and-forget, never blocks.
 
     In Cloud Run (detected via K_SERVICE env var) the log is done SYNCHRONOUSLY
     before returning, because Cloud Run aggressively scales containers down
@@ -536,7 +558,8 @@ def log_usage_async(*, app_name: str, model: str, usage: Any,
     Waiting for the INSERT adds ~50-200ms to the request — acceptable for the
     guarantee that every call lands a row.
 
-    Never raises. DB failures are swallowed with a logger.warning.
+    Never raises. DB failures are swallowed with a logger.warning; the shared
+    usage writer also spools the row locally and replays it later.
     Can be forced with ANTHROPIC_LOGGER_SYNC=1 / ANTHROPIC_LOGGER_SYNC=0.
     """
     sync_override = os.environ.get('ANTHROPIC_LOGGER_SYNC', '').strip()
@@ -548,6 +571,20 @@ def log_usage_async(*, app_name: str, model: str, usage: Any,
         # Default: sync on Cloud Run, async elsewhere
         sync = bool(os.environ.get('K_SERVICE'))
 
+    if get_usage_writer is not None:
+        try:
+            writer = get_usage_writer()
+            writer.submit(_usage_row(
+                app_name=app_name, model=model, usage=usage,
+                feature=feature, user_id=user_id, duration_ms=duration_ms,
+                streaming=streaming, image_count=image_count,
+            ))
+            if sync:
+                writer.flush()
+        except Exception as e:
+            logger.warning(f"anthropic_logger: kumori_api_usage enqueue failed: {e}")
+        return
+
     def _do():
         try:
             _insert_usage_row(
@@ -1,144 +1,369 @@
-import json,re,base64,logging,time,os,requests as _requests
-import psycopg2
+import json,re,hashlib,logging,time,os,threading
+from collections import deque
 from .google_secret_utils import get_secret
+from .cache import TTLCache, SQLiteCache, TieredCache, SingleFlight
+from .usage_writer import get_usage_writer
+from .pricing import compute_cost, canonical_model_id
+from .admission import record_spend
+from .uploads import Base64Upload, encode_body, data_size, iter_data, read_data
+from .style_samples import prepare_samples, estimate_tokens, IMAGE_EXTS, STYLE_EXTRACT, STYLE_SAMPLE_TOKENS
 
 logger = logging.getLogger(__name__)
 
-API_URL = "https://api.anthropic.com/v1/messages"
-_api_key = None
+# Point at a local stand-in (e.g. mock_anthropic_server.py) for offline runs
+API_BASE = os.getenv('AIA_ANTHROPIC_BASE_URL', 'https://api.anthropic.com').rstrip('/')
+API_URL = f"{API_BASE}/v1/messages"
+API_KEY_SECRET = 'KUMORI_ANTHROPIC_API_KEY'
+
+# --- Pooled keep-alive session ---
+# One session per process so the calls behind each /generate reuse warm TLS
+# connections to api.anthropic.com instead of handshaking every time. Size the
+# pool for AIA_MAX_INFLIGHT generating requests times the per-request fan-out (4 x 3 by default).
+HTTP_POOL_SIZE = int(os.getenv('AIA_HTTP_POOL_SIZE', '12'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('AIA_HTTP_CONNECT_TIMEOUT', '5'))
+_session = None
+_session_lock = threading.Lock()
+_http_stats = {'requests': 0, 'new_connections': 0}
+_http_stats_lock = threading.Lock()
+
+def _count_http(key):
+    with _http_stats_lock: _http_stats[key] += 1
+
+def _pooled_adapter():
+    # requests/urllib3 are imported on first use, off the cold-start path
+    from requests.adapters import HTTPAdapter
+    from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+
+    # Count every fresh TCP (+TLS) connection so reuse can be measured; both
+    # schemes, since AIA_ANTHROPIC_BASE_URL may point at a plain-http proxy
+    class _CountingHTTPPool(HTTPConnectionPool):
+        def _new_conn(self):
+            _count_http('new_connections')
+            return super()._new_conn()
+
+    class _CountingHTTPSPool(HTTPSConnectionPool):
+        def _new_conn(self):
+            _count_http('new_connections')
+            return super()._new_conn()
+
+    class _PooledAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {**self.poolmanager.pool_classes_by_scheme,
+                                                       'http': _CountingHTTPPool, 'https': _CountingHTTPSPool}
+
+    # pool_block=True: wait for a free connection rather than open a
+    # throwaway one past the pool size
+    return _PooledAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                s = requests.Session()
+                adapter = _pooled_adapter()
+                s.mount('https://', adapter)
+                s.mount('http://', adapter)
+                _session = s
+    return _session
+
+def http_pool_stats():
+    """Requests sent vs connections opened on the shared session."""
+    with _http_stats_lock:
+        stats = dict(_http_stats)
+    stats['reused_connections'] = max(0, stats['requests'] - stats['new_connections'])
+    stats['pool_size'] = HTTP_POOL_SIZE
+    return stats
 
 def _get_headers():
-    global _api_key
-    if not _api_key: _api_key = get_secret('KUMORI_ANTHROPIC_API_KEY')
-    return {'x-api-key': _api_key, 'anthropic-version': '2023-06-01', 'content-type': 'application/json'}
+    # get_secret caches (and rotates) the key; no module-level copy to go stale
+    return {'x-api-key': get_secret(API_KEY_SECRET), 'anthropic-version': '2023-06-01', 'content-type': 'application/json'}
 
 # --- API usage tracking ---
 APP_NAME = 'aia'
-_PRICING = {
-    'haiku-4-5': {'input': 0.0000008, 'output': 0.000004},   # $0.80/$4 per million
-    'sonnet-4-5': {'input': 0.000003, 'output': 0.000015},   # $3/$15 per million
-    'sonnet-4': {'input': 0.000003, 'output': 0.000015},     # $3/$15 per million
-    'opus-4-6': {'input': 0.000015, 'output': 0.000075},     # $15/$75 per million
-    'opus-4-5': {'input': 0.000015, 'output': 0.000075},     # $15/$75 per million
-}
-
-def _get_pricing(model):
-    m = model.lower()
-    for k, v in _PRICING.items():
-        if k in m: return v
-    return {'input': 0.000003, 'output': 0.000015}
-
 def log_api_usage(model, usage, feature=None, streaming=False,
-                  image_count=0, user_id=None, duration_ms=None):
-    """Log an API call to kumori_api_usage in a background thread.
+                  image_count=0, user_id=None, duration_ms=None, batch=False):
+    """Queue an API call for kumori_api_usage on the shared batched writer.
     Never blocks the caller. Never raises."""
-    import threading
-
-    def _do_log():
-        try:
-            pricing = _get_pricing(model)
-            input_tokens = usage.get('input_tokens', 0) if isinstance(usage, dict) else 0
-            output_tokens = usage.get('output_tokens', 0) if isinstance(usage, dict) else 0
-            cache_creation = usage.get('cache_creation_input_tokens', 0) if isinstance(usage, dict) else 0
-            cache_read = usage.get('cache_read_input_tokens', 0) if isinstance(usage, dict) else 0
-            thinking = usage.get('thinking_tokens', 0) if isinstance(usage, dict) else 0
-            server_tools = usage.get('server_tool_use') if isinstance(usage, dict) else None
-            server_tools = server_tools or {}
-            web_searches = server_tools.get('web_search_requests', 0) if isinstance(server_tools, dict) else 0
-            web_fetches = server_tools.get('web_fetch_requests', 0) if isinstance(server_tools, dict) else 0
-            code_exec = server_tools.get('code_execution_requests', 0) if isinstance(server_tools, dict) else 0
-            cost = (input_tokens * pricing['input'] + output_tokens * pricing['output']
-                    + cache_creation * pricing['input'] * 1.25 + cache_read * pricing['input'] * 0.1
-                    + thinking * pricing['output'] + web_searches * 0.01)
-            is_gcp = os.environ.get('GAE_ENV', '').startswith('standard')
-            host = f"/cloudsql/{get_secret('KUMORI_POSTGRES_CONNECTION_NAME')}" if is_gcp else get_secret('KUMORI_POSTGRES_IP')
-            conn = psycopg2.connect(host=host,
-                database=get_secret('KUMORI_POSTGRES_DB_NAME'),
-                user=get_secret('KUMORI_POSTGRES_USERNAME'),
-                password=get_secret('KUMORI_POSTGRES_PASSWORD'),
-                connect_timeout=5)
-            try:
-                cur = conn.cursor()
-                cur.execute("""INSERT INTO kumori_api_usage
-                    (app_name, feature, model, input_tokens, output_tokens,
-                     cache_creation_tokens, cache_read_tokens, thinking_tokens,
-                     web_search_requests, web_fetch_requests, code_execution_requests,
-                     image_count, estimated_cost_usd, streaming, user_id, duration_ms)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)""",
-                    (APP_NAME, feature, model, input_tokens, output_tokens,
-                     cache_creation, cache_read, thinking, web_searches, web_fetches,
-                     code_exec, image_count, cost, streaming, user_id, duration_ms))
-                conn.commit()
-                cur.close()
-            finally:
-                conn.close()
-        except Exception as e:
-            logger.warning(f"Failed to log API usage: {e}")
-
-    threading.Thread(target=_do_log, daemon=True).start()
-
-def _call_claude(body, timeout=60, user_id=None):
+    try:
+        input_tokens = usage.get('input_tokens', 0) if isinstance(usage, dict) else 0
+        output_tokens = usage.get('output_tokens', 0) if isinstance(usage, dict) else 0
+        cache_creation = usage.get('cache_creation_input_tokens', 0) if isinstance(usage, dict) else 0
+        cache_read = usage.get('cache_read_input_tokens', 0) if isinstance(usage, dict) else 0
+        thinking = usage.get('thinking_tokens', 0) if isinstance(usage, dict) else 0
+        server_tools = usage.get('server_tool_use') if isinstance(usage, dict) else None
+        server_tools = server_tools or {}
+        web_searches = server_tools.get('web_search_requests', 0) if isinstance(server_tools, dict) else 0
+        web_fetches = server_tools.get('web_fetch_requests', 0) if isinstance(server_tools, dict) else 0
+        code_exec = server_tools.get('code_execution_requests', 0) if isinstance(server_tools, dict) else 0
+        model = canonical_model_id(model)
+        cost = compute_cost(model, input_tokens, output_tokens, cache_creation, cache_read, thinking, web_searches,
+                            batch=batch)
+        # Feeds the per-minute budget in front of /generate
+        record_spend(input_tokens + cache_creation + output_tokens + thinking, cost)
+        get_usage_writer().submit(
+            (APP_NAME, feature, model, input_tokens, output_tokens,
+             cache_creation, cache_read, thinking, web_searches, web_fetches,
+             code_exec, image_count, cost, streaming, user_id, duration_ms))
+    except Exception as e:
+        logger.warning(f"Failed to log API usage: {e}")
+
+def _web_searches(usage):
+    return (usage.get('server_tool_use') or {}).get('web_search_requests') or 0
+
+class UsageTally:
+    """Token totals across the calls behind one /generate request, for the
+    client-facing cache report. Calls run on several threads, hence the lock."""
+    _FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.totals = dict.fromkeys(self._FIELDS, 0)
+        self.web_searches = 0
+        self.cost = 0.0
+
+    def add(self, model, usage):
+        counts = {k: usage.get(k) or 0 for k in self._FIELDS}
+        web_searches = _web_searches(usage)
+        cost = compute_cost(model, *counts.values(), web_search_requests=web_searches)
+        with self._lock:
+            self.calls += 1
+            for k, v in counts.items(): self.totals[k] += v
+            self.web_searches += web_searches
+            self.cost += cost
+
+    def report(self):
+        with self._lock:
+            t = dict(self.totals); calls = self.calls; web_searches = self.web_searches; cost = self.cost
+        prompt = t['input_tokens'] + t['cache_creation_input_tokens'] + t['cache_read_input_tokens']
+        return {'calls': calls, 'input_tokens': t['input_tokens'], 'output_tokens': t['output_tokens'],
+                'cache_write_tokens': t['cache_creation_input_tokens'], 'cache_read_tokens': t['cache_read_input_tokens'],
+                'cache_hit_rate': round(t['cache_read_input_tokens'] / prompt, 3) if prompt else 0.0,
+                'web_search_requests': web_searches, 'estimated_cost_usd': round(cost, 6)}
+
+# --- Model routing ---
+# Each stage's model comes from config, so the stages with easily checked
+# output (search returns a short JSON array, style a guide of some length) can
+# run on a cheaper, faster model. If that model's output fails its check, the
+# call is retried once on AIA_MODEL_FALLBACK. Everything defaults to Sonnet.
+DEFAULT_MODEL = os.getenv('AIA_MODEL_DEFAULT', 'claude-sonnet-4-20250514')
+FALLBACK_MODEL = os.getenv('AIA_MODEL_FALLBACK', DEFAULT_MODEL)
+STAGE_MODELS = {stage: os.getenv(f'AIA_MODEL_{stage.upper()}', DEFAULT_MODEL) for stage in ('search', 'style', 'article')}
+STYLE_MIN_CHARS = int(os.getenv('AIA_STYLE_MIN_CHARS', '400'))
+_stage_stats = {stage: {'calls': 0, 'routed': 0, 'fallbacks': 0, 'cost_usd': 0.0, 'models': {}, 'latency_ms': deque(maxlen=500)}
+                for stage in STAGE_MODELS}
+_stage_lock = threading.Lock()
+
+def _record_stage(stage, model, elapsed_ms, usage):
+    cost = compute_cost(model, *(usage.get(k) or 0 for k in UsageTally._FIELDS),
+                        web_search_requests=_web_searches(usage))
+    with _stage_lock:
+        st = _stage_stats[stage]
+        st['calls'] += 1; st['cost_usd'] += cost
+        st['models'][model] = st['models'].get(model, 0) + 1
+        st['latency_ms'].append(elapsed_ms)
+
+def stage_stats():
+    """Per stage: calls, fallback rate, cost and latency of recent calls."""
+    out = {}
+    with _stage_lock:
+        for stage, st in _stage_stats.items():
+            lat = sorted(st['latency_ms'])
+            out[stage] = {'model': STAGE_MODELS[stage], 'calls': st['calls'], 'fallbacks': st['fallbacks'],
+                          'fallback_rate': round(st['fallbacks'] / st['routed'], 3) if st['routed'] else 0.0,
+                          'cost_usd': round(st['cost_usd'], 6), 'models': dict(st['models']),
+                          'latency_ms_p50': lat[len(lat) // 2] if lat else None,
+                          'latency_ms_p95': lat[int(len(lat) * 0.95)] if lat else None}
+    return out
+
+def _call_routed(stage, body, check, **kwargs):
+    """_call_claude on the stage's model. check(data) returns (value, ok); on
+    not ok the call is retried once on FALLBACK_MODEL. Returns the last
+    (value, ok), so callers can leave a result that failed both unused."""
+    model = STAGE_MODELS[stage]
+    with _stage_lock: _stage_stats[stage]['routed'] += 1
+    value, ok = check(_call_claude({**body, 'model': model}, stage=stage, **kwargs))
+    if not ok and model != FALLBACK_MODEL:
+        with _stage_lock: _stage_stats[stage]['fallbacks'] += 1
+        logger.warning(f"{stage}: {model} output failed its check, retrying on {FALLBACK_MODEL}")
+        value, ok = check(_call_claude({**body, 'model': FALLBACK_MODEL}, stage=stage, **kwargs))
+    return value, ok
+
+def _log_call(body, usage, elapsed_ms, user_id=None, streaming=False, tally=None, feature=None, stage=None):
+    feature = feature or ('search' if body.get('tools') else 'generate')
+    image_count = sum(1 for m in body.get('messages', [])
+                     for c in (m.get('content', []) if isinstance(m.get('content'), list) else [])
+                     if isinstance(c, dict) and c.get('type') in ('image', 'document'))
+    log_api_usage(body.get('model', 'unknown'), usage,
+                  feature=feature, streaming=streaming, image_count=image_count,
+                  duration_ms=elapsed_ms, user_id=user_id or 'system:aia')
+    if tally is not None: tally.add(body.get('model', 'unknown'), usage)
+    if stage is not None: _record_stage(stage, body.get('model', 'unknown'), elapsed_ms, usage)
+
+def _call_claude(body, timeout=60, user_id=None, tally=None, feature=None, stage=None):
     start = time.time()
-    r = _requests.post(API_URL, headers=_get_headers(), json=body, timeout=timeout)
+    # Uploads in the body are base64-encoded as it's sent (see uploads.encode_body)
+    payload = encode_body(body)
+    r = _get_session().post(API_URL, headers={**_get_headers(), 'content-length': str(len(payload))}, data=payload,
+                            timeout=(HTTP_CONNECT_TIMEOUT, timeout))
+    _count_http('requests')
     r.raise_for_status()
     data = r.json()
     elapsed_ms = int((time.time() - start) * 1000)
     if 'usage' in data:
-        feature = 'search' if body.get('tools') else 'generate'
-        image_count = sum(1 for m in body.get('messages', [])
-                         for c in (m.get('content', []) if isinstance(m.get('content'), list) else [])
-                         if isinstance(c, dict) and c.get('type') in ('image', 'document'))
-        log_api_usage(body.get('model', 'unknown'), data['usage'],
-                      feature=feature, image_count=image_count, duration_ms=elapsed_ms,
-                      user_id=user_id or 'system:aia')
+        _log_call(body, data['usage'], elapsed_ms, user_id=user_id, tally=tally, feature=feature, stage=stage)
     return data
 
-def search_sources(topic):
-    """Search for 3 articles on topic, return list of {title, url, summary}"""
-    data = _call_claude({
-        'model': "claude-sonnet-4-20250514", 'max_tokens': 2000,
-        'tools': [{"type": "web_search_20250305", "name": "web_search"}],
-        'messages': [{"role": "user", "content": f"""Search for 3 recent news articles about: {topic}
-
-Return ONLY valid JSON array, no other text:
-[{{"title": "...", "url": "https://...", "summary": "2-3 sentence summary"}}]
-
-Only include articles with real URLs. If you can't find 3, return fewer."""}]})
+def _stream_claude(body, timeout=60, user_id=None, tally=None, stage=None, on_start=None):
+    """Streaming _call_claude: yields text deltas as they arrive. on_start,
+    if given, is called on message_start (the response has begun).
 
+    Usage comes in two parts (input/cache counts on message_start, cumulative
+    output_tokens on message_delta) and is merged and logged once the stream
+    ends, including when the consumer stops early."""
+    start = time.time()
+    usage = {}
+    r = _get_session().post(API_URL, headers=_get_headers(), json={**body, 'stream': True},
+                            timeout=(HTTP_CONNECT_TIMEOUT, timeout), stream=True)
+    _count_http('requests')
+    try:
+        r.raise_for_status()
+        # chunk_size=None hands over each chunk as it arrives instead of
+        # waiting to fill a buffer
+        for line in r.iter_lines(chunk_size=None):
+            if not line.startswith(b'data:'): continue
+            event = json.loads(line[5:])
+            text = _stream_event(event, usage)
+            if on_start and event.get('type') == 'message_start': on_start()
+            if text: yield text
+    finally:
+        r.close()
+        if usage:
+            _log_call(body, usage, int((time.time() - start) * 1000), user_id=user_id, streaming=True, tally=tally,
+                      stage=stage)
+
+def _stream_event(event, usage):
+    """Fold one streaming event's usage into usage; return its text delta, if any."""
+    etype = event.get('type')
+    if etype == 'message_start':
+        usage.update({k: v for k, v in event['message'].get('usage', {}).items() if v is not None})
+    elif etype == 'message_delta':
+        usage.update({k: v for k, v in (event.get('usage') or {}).items() if v is not None})
+    elif etype == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+        return event['delta']['text']
+    elif etype == 'error':
+        raise RuntimeError(f"Anthropic stream error: {event.get('error')}")
+    return None
+
+# --- Source search cache ---
+# Every search is a paid web_search call, and most traffic asks about the same
+# handful of topics, so results are cached per normalized topic for a short
+# TTL and concurrent misses for the same topic share one in-flight search.
+_search_cache = TieredCache(
+    TTLCache(maxsize=int(os.getenv('AIA_SEARCH_CACHE_SIZE', '512')),
+             ttl=int(os.getenv('AIA_SEARCH_CACHE_TTL', '900'))),
+    SQLiteCache(os.environ['AIA_SEARCH_CACHE_DB'], ttl=int(os.getenv('AIA_SEARCH_CACHE_TTL', '900')),
+                table='search_cache') if os.getenv('AIA_SEARCH_CACHE_DB') else None,
+    name='search_cache')
+_search_flight = SingleFlight()
+
+def _normalize_topic(topic):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', topic.lower()).split())
+
+def search_cache_stats():
+    stats = _search_cache.stats()
+    stats['coalesced'] = _search_flight.coalesced
+    return stats
+
+def search_sources(topic, refresh=False, tally=None):
+    """Search for 3 articles on topic, return list of {title, url, summary}
+
+    Cached per normalized topic; empty results are not cached.
+    refresh=True skips the cache read and replaces the entry (pre-warming)."""
+    key = _normalize_topic(topic)
+    if not refresh:
+        sources = _search_cache.get(key)
+        if sources is not None: return sources
+    sources, shared = _search_flight.do(key, lambda: _search_sources_uncached(topic, tally))
+    if sources and not shared: _search_cache.set(key, sources)
+    return sources
+
+def _parse_sources(data):
+    """(sources, ok). Not ok when there's no parseable JSON array, or it had
+    entries but none with a real URL; an honest empty array is fine."""
     text = ''.join(b['text'] for b in data['content'] if b.get('type') == 'text')
     match = re.search(r'\[.*\]', text, re.DOTALL)
-    if not match: return []
+    if not match: return [], False
     try:
         sources = json.loads(match.group())
-        return [s for s in sources if s.get('url', '').startswith('http')]
-    except: return []
+        valid = [s for s in sources if isinstance(s, dict) and str(s.get('url', '')).startswith('http')]
+    except (ValueError, TypeError): return [], False
+    return valid, bool(valid) or not sources
 
-def analyze_style(file_contents=None, sample_content=None):
-    """Analyze writing style from file contents or sample content
+def _search_sources_uncached(topic, tally=None):
+    sources, _ = _call_routed('search', _search_body(topic), _parse_sources, tally=tally)
+    return sources
 
-    file_contents: list of dicts with 'filename' and 'data' (bytes)
-    sample_content: string of sample text
-    """
-    content = []
+def _search_body(topic):
+    return {
+        'max_tokens': 2000,
+        'tools': [{"type": "web_search_20250305", "name": "web_search"}],
+        'messages': [{"role": "user", "content": f"""Search for 3 recent news articles about: {topic}
 
-    if sample_content:
-        content.append({"type": "text", "text": f"<doc name='sample.txt'>\n{sample_content}\n</doc>"})
-    elif file_contents:
-        for f in file_contents:
-            data = f['data']
-            filename = f['filename']
-            ext = filename.split('.')[-1].lower()
-            if ext == 'pdf':
-                content.append({"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": base64.b64encode(data).decode()}})
-            elif ext in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
-                mt = f"image/{'jpeg' if ext == 'jpg' else ext}"
-                content.append({"type": "image", "source": {"type": "base64", "media_type": mt, "data": base64.b64encode(data).decode()}})
-            else:
-                content.append({"type": "text", "text": f"<doc name='{filename}'>\n{data.decode('utf-8', errors='ignore')}\n</doc>"})
-    else:
-        return "Write in a professional, engaging tone with clear structure."
+Return ONLY valid JSON array, no other text:
+[{{"title": "...", "url": "https://...", "summary": "2-3 sentence summary"}}]
 
-    content.append({"type": "text", "text": """You are a world-class ghostwriter. Analyze these writing samples to deeply understand this author's voice.
+Only include articles with real URLs. If you can't find 3, return fewer."""}]}
+
+# --- Prompt caching ---
+# The long, unchanging part of a prompt (instructions, and for articles the
+# style guide shared by every post in a request) goes first, in a system block
+# marked cache_control; the per-call part follows in the user turn. Anthropic
+# bills cached prefix reads at 0.1x input. Prefixes under the model's minimum
+# are silently not cached, so the marker only goes on blocks estimated to clear
+# it (the style call's instructions alone don't).
+PROMPT_CACHE = os.getenv('AIA_PROMPT_CACHE', '1') not in ('0', 'false', 'no')
+# Minimum cacheable prefix in tokens, by model family; 1024 for the rest
+_CACHE_MIN_TOKENS = (('opus-4-5', 4096), ('opus-4-6', 4096), ('haiku-4-5', 4096), ('haiku', 2048))
+
+def _cache_min_tokens(model):
+    return next((n for key, n in _CACHE_MIN_TOKENS if key in model), 1024)
+
+def _cacheable(text, model, prefix_tokens=0):
+    return PROMPT_CACHE and prefix_tokens + estimate_tokens(text) >= _cache_min_tokens(model)
+
+def _prompt_block(text, model, prefix_tokens=0, cache=True):
+    """System block, marked for caching when it (plus prefix_tokens of tools
+    ahead of it) is long enough for model to cache"""
+    block = {"type": "text", "text": text}
+    if cache and _cacheable(text, model, prefix_tokens):
+        block["cache_control"] = {"type": "ephemeral"}
+    return block
+
+# A cache entry is only readable once the response that writes it has
+# started, so article calls sent side by side on a new style would each pay
+# the 1.25x write. The pipelines send the first call alone and release the
+# rest on its message_start, unless the prefix is known to be cached already:
+# written or read here within the last 4 minutes (entries live 5 minutes
+# from last use).
+_warm_article_prefixes = TTLCache(maxsize=256, ttl=240)
+
+def _article_prefix_key(style):
+    return hashlib.sha256(f"{STAGE_MODELS['article']}\0{style}".encode()).hexdigest()
+
+def article_prefix_state(style):
+    """'uncached' (too short to cache, or caching off), 'warm' or 'cold'"""
+    if not _cacheable(ARTICLE_INSTRUCTIONS + style, STAGE_MODELS['article']):
+        return 'uncached'
+    return 'warm' if _warm_article_prefixes.get(_article_prefix_key(style)) else 'cold'
+
+def mark_article_prefix_warm(style):
+    _warm_article_prefixes.set(_article_prefix_key(style), True)
+
+STYLE_INSTRUCTIONS = """You are a world-class ghostwriter. Analyze these writing samples to deeply understand this author's voice.
 
 Extract the ESSENCE of how they think and communicate:
 
@@ -163,10 +388,108 @@ Extract the ESSENCE of how they think and communicate:
    - Tone markers - humor, directness, self-deprecation?
    - What they explicitly avoid
 
-Output a style guide that captures the SPIRIT of this writer, not just surface patterns. A good ghostwriter channels the author's thinking, not just their verbal tics."""})
+Output a style guide that captures the SPIRIT of this writer, not just surface patterns. A good ghostwriter channels the author's thinking, not just their verbal tics."""
+
+# --- Style guide cache ---
+# Keyed on the prompt version, model and sample settings plus a hash of the
+# normalized samples, so the same uploads (and every "use sample style"
+# request) skip the call. Bump STYLE_PROMPT_VERSION whenever the analysis
+# prompt or the sample preprocessing changes.
+STYLE_PROMPT_VERSION = '3'
+_BINARY_EXTS = ('pdf', 'docx', *IMAGE_EXTS)
+_style_cache = TieredCache(
+    TTLCache(maxsize=int(os.getenv('AIA_STYLE_CACHE_SIZE', '256')),
+             ttl=int(os.getenv('AIA_STYLE_CACHE_TTL', '86400'))),
+    SQLiteCache(os.environ['AIA_STYLE_CACHE_DB'], ttl=int(os.getenv('AIA_STYLE_CACHE_TTL', '86400')),
+                table='style_cache') if os.getenv('AIA_STYLE_CACHE_DB') else None,
+    name='style_cache')
+
+def _normalize_sample(filename, data):
+    """Text samples hash the same regardless of line endings or trailing whitespace"""
+    if filename.split('.')[-1].lower() in _BINARY_EXTS: return data
+    return read_data(data).decode('utf-8', errors='ignore').replace('\r\n', '\n').replace('\r', '\n').strip().encode()
+
+def _style_cache_key(file_contents=None, sample_content=None):
+    h = hashlib.sha256(f"style:v{STYLE_PROMPT_VERSION}:{STAGE_MODELS['style']}:"
+                       f"{STYLE_EXTRACT}:{STYLE_SAMPLE_TOKENS}".encode())
+    # The sample path renders exactly like an uploaded sample.txt, so key it the same way
+    files = [{'filename': 'sample.txt', 'data': sample_content.encode()}] if sample_content else file_contents
+    for f in files:
+        data = _normalize_sample(f['filename'], f['data'])
+        h.update(f"\0{f['filename'].lower()}\0{data_size(data)}\0".encode())
+        for chunk in iter_data(data): h.update(chunk)
+    return h.hexdigest()
+
+def style_cache_stats():
+    return _style_cache.stats()
+
+# Used when there's nothing to learn a voice from
+DEFAULT_STYLE = "Write in a professional, engaging tone with clear structure."
+
+def analyze_style(file_contents=None, sample_content=None, tally=None):
+    """Analyze writing style from file contents or sample content
+
+    file_contents: list of dicts with 'filename' and 'data' (bytes, or a
+        seekable file such as an uploads.CappedSpool)
+    sample_content: string of sample text
+
+    Results are cached by content hash (see _style_cache_key), unless the
+    output failed _check_style on every model or there was nothing readable.
+    """
+    if not sample_content and not file_contents:
+        return DEFAULT_STYLE
+
+    key = _style_cache_key(file_contents, sample_content)
+    style = _style_cache.get(key)
+    if style is None:
+        style, ok = _analyze_style_uncached(file_contents, sample_content, tally)
+        if ok: _style_cache.set(key, style)
+    return style
+
+def _analyze_style_uncached(file_contents=None, sample_content=None, tally=None):
+    """(style, ok): not ok means don't cache it"""
+    body = _style_body(file_contents, sample_content)
+    if body is None:
+        return DEFAULT_STYLE, False
+    style, ok = _call_routed('style', body, _check_style, tally=tally)
+    if not ok:
+        logger.warning("Style analysis failed its check on every model; using it uncached")
+    return style, ok
+
+def _style_body(file_contents=None, sample_content=None):
+    """Text is extracted, deduplicated and sampled locally (style_samples.py);
+    only images and PDFs without usable text go in as image/document blocks.
+    None when no sample had anything readable: the model would only make a
+    voice up, so the caller uses DEFAULT_STYLE instead."""
+    content = []
 
-    data = _call_claude({'model': "claude-sonnet-4-20250514", 'max_tokens': 1500, 'messages': [{"role": "user", "content": content}]})
-    return data['content'][0]['text']
+    samples = prepare_samples(file_contents, sample_content)
+    if not samples:
+        logger.warning("No readable writing samples; using the default style")
+        return None
+    for f in samples:
+        filename = f['filename']
+        ext = filename.split('.')[-1].lower()
+        if 'text' in f:
+            content.append({"type": "text", "text": f"<doc name='{filename}'>\n{f['text']}\n</doc>"})
+        elif ext == 'pdf':
+            content.append({"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": Base64Upload(f['data'])}})
+        elif ext in IMAGE_EXTS:
+            mt = f"image/{'jpeg' if ext == 'jpg' else ext}"
+            content.append({"type": "image", "source": {"type": "base64", "media_type": mt, "data": Base64Upload(f['data'])}})
+        else:
+            # Raw upload; only with AIA_STYLE_EXTRACT=0
+            content.append({"type": "text", "text": f"<doc name='{filename}'>\n{read_data(f['data']).decode('utf-8', errors='ignore')}\n</doc>"})
+
+    content.append({"type": "text", "text": "Write the style guide for the author of these samples."})
+
+    return {'max_tokens': 1500,
+            'system': [_prompt_block(STYLE_INSTRUCTIONS, STAGE_MODELS['style'])],
+            'messages': [{"role": "user", "content": content}]}
+
+def _check_style(data):
+    text = ''.join(b.get('text', '') for b in data['content'] if b.get('type') == 'text').strip()
+    return text, len(text) >= STYLE_MIN_CHARS
 
 ARTICLE_ANGLES = [
     "Lead with the most surprising or counterintuitive insight. Challenge conventional thinking.",
@@ -174,24 +497,7 @@ ARTICLE_ANGLES = [
     "Open with your honest reaction - what made you stop and think? Be genuinely reflective."
 ]
 
-def generate_single_article(source, style, index):
-    """Generate a single article for one source"""
-    angle = ARTICLE_ANGLES[index % len(ARTICLE_ANGLES)]
-
-    data = _call_claude({
-        'model': "claude-sonnet-4-20250514", 'max_tokens': 1500,
-        'messages': [{"role": "user", "content": f"""You are ghostwriting a LinkedIn post for a specific author. Your job is to channel their THINKING and PERSPECTIVE, not just mimic their phrases.
-
-ARTICLE TO WRITE ABOUT:
-Title: {source['title']}
-URL: {source['url']}
-Summary: {source['summary']}
-
-THE AUTHOR'S VOICE (channel the spirit, not just the words):
-{style}
-
-YOUR ANGLE FOR THIS PIECE:
-{angle}
+ARTICLE_INSTRUCTIONS = """You are ghostwriting a LinkedIn post for a specific author. Your job is to channel their THINKING and PERSPECTIVE, not just mimic their phrases.
 
 GUIDELINES:
 - 150-300 words
@@ -204,6 +510,106 @@ GUIDELINES:
 
 The goal: if the author read this, they'd think "I wish I'd written that" - not "that sounds like a template."
 
-Output ONLY the post text."""}]})
+THE AUTHOR'S VOICE (channel the spirit, not just the words):
+"""
+
+def _article_body(source, style, index, cache=True):
+    angle = ARTICLE_ANGLES[index % len(ARTICLE_ANGLES)]
+
+    # Instructions + style are identical for every post in a request (and for
+    # every request on the same style), so they form the cached prefix
+    return {
+        'model': STAGE_MODELS['article'], 'max_tokens': 1500,
+        'system': [_prompt_block(ARTICLE_INSTRUCTIONS + style, STAGE_MODELS['article'], cache=cache)],
+        'messages': [{"role": "user", "content": f"""ARTICLE TO WRITE ABOUT:
+Title: {source['title']}
+URL: {source['url']}
+Summary: {source['summary']}
+
+YOUR ANGLE FOR THIS PIECE:
+{angle}
+
+Output ONLY the post text."""}]}
+
+def generate_single_article(source, style, index, tally=None, cache=True):
+    """Generate a single article for one source; cache=False leaves the
+    prefix unmarked (see _warm_article_prefixes)"""
+    data = _call_claude(_article_body(source, style, index, cache), tally=tally, stage='article')
 
     return {"content": data['content'][0]['text'], "source": source}
+
+def generate_single_article_stream(source, style, index, tally=None, on_start=None):
+    """Streaming generate_single_article: yields the post text as it's written"""
+    yield from _stream_claude(_article_body(source, style, index), tally=tally, stage='article', on_start=on_start)
+
+# --- Batched article generation ---
+# One call writes every post: the style guide is sent once instead of once per
+# source. Posts come back through a forced tool call so they arrive as
+# structured JSON; the pipeline regenerates any post that can't be parsed.
+BATCHED_FEATURE = 'generate_batched'
+_WRITE_POSTS_TOOL = {
+    "name": "write_posts",
+    "description": "Submit the finished posts, one per source.",
+    "input_schema": {
+        "type": "object",
+        "properties": {"posts": {"type": "array", "items": {
+            "type": "object",
+            "properties": {"source": {"type": "integer", "description": "Number of the source the post is about"},
+                           "content": {"type": "string", "description": "The post text only"}},
+            "required": ["source", "content"]}}},
+        "required": ["posts"]}}
+
+def _batched_articles_body(sources, style):
+    parts = []
+    for n, src in enumerate(sources, 1):
+        parts.append(f"""SOURCE {n}:
+Title: {src['title']}
+URL: {src['url']}
+Summary: {src['summary']}
+Angle: {ARTICLE_ANGLES[(n - 1) % len(ARTICLE_ANGLES)]}""")
+    return {
+        'model': STAGE_MODELS['article'], 'max_tokens': min(1500 * len(sources), 8000),
+        'system': [_prompt_block(ARTICLE_INSTRUCTIONS + style, STAGE_MODELS['article'],
+                                 prefix_tokens=estimate_tokens(json.dumps(_WRITE_POSTS_TOOL)))],
+        'tools': [_WRITE_POSTS_TOOL], 'tool_choice': {"type": "tool", "name": "write_posts"},
+        'messages': [{"role": "user", "content": f"""Write one separate post for each of these {len(sources)} articles, each from its own angle. Don't reuse openings or closings across posts.
+
+""" + "\n\n".join(parts) + "\n\nSubmit all posts with write_posts."}]}
+
+def _parse_batched_articles(data, count):
+    """{source_index: text} from a write_posts response. Tolerates the posts
+    arriving as a JSON string, 0-based numbering, or as plain-text JSON."""
+    posts = None
+    for block in data.get('content', []):
+        if block.get('type') == 'tool_use' and block.get('name') == 'write_posts':
+            posts = (block.get('input') or {}).get('posts')
+            break
+    if posts is None:
+        text = ''.join(b.get('text', '') for b in data.get('content', []) if b.get('type') == 'text')
+        match = re.search(r'\[.*\]', text, re.DOTALL)
+        posts = match.group() if match else None
+    if isinstance(posts, str):
+        try: posts = json.loads(posts)
+        except ValueError: posts = None
+    if not isinstance(posts, list): return {}
+
+    numbered = [p for p in posts if isinstance(p, dict) and isinstance(p.get('content'), str) and p['content'].strip()]
+    try: nums = [int(p.get('source')) for p in numbered]
+    except (TypeError, ValueError): nums = None
+    if nums and min(nums) == 0: offset = 0
+    elif nums: offset = 1
+    else:
+        # No usable numbering: trust the order if the count matches
+        return {i: p['content'].strip() for i, p in enumerate(numbered)} if len(numbered) == count else {}
+    out = {}
+    for n, p in zip(nums, numbered):
+        if 0 <= n - offset < count: out.setdefault(n - offset, p['content'].strip())
+    return out
+
+def generate_articles_batched(sources, style, tally=None):
+    """Every article in one call. Returns {index: {"content", "source"}} for
+    the posts that came back usable; the caller fills in any that didn't."""
+    data = _call_claude(_batched_articles_body(sources, style), timeout=120, tally=tally, feature=BATCHED_FEATURE,
+                        stage='article')
+    posts = _parse_batched_articles(data, len(sources))
+    return {i: {"content": text, "source": sources[i]} for i, text in posts.items()}
@@ -0,0 +1,250 @@
+"""Small caching primitives shared by the LLM pipeline stages.
+
+TTLCache is the in-process tier: a thread-safe LRU with per-entry expiry.
+SQLiteCache is an optional shared tier so several workers/instances pointed at
+the same file see each other's entries. TieredCache puts the two together and
+keeps hit/miss counters. Shared-tier failures are logged and treated as misses;
+a cache problem should never fail a request. SingleFlight collapses concurrent
+misses for the same key into one upstream call. StaleWhileRevalidate holds a
+single slow-to-load value and refreshes it off the caller's thread.
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Thread-safe LRU with a per-entry TTL."""
+
+    def __init__(self, maxsize=128, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """JSON values in a SQLite file, shared by every process that opens it."""
+
+    def __init__(self, path, ttl=3600, table='cache'):
+        self.path = path
+        self.ttl = ttl
+        self.table = table
+        self._local = threading.local()
+        self._conn().execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self._conn().execute(
+            f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                     (key, json.dumps(value), now + (ttl or self.ttl)))
+        conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+
+
+class TieredCache:
+    """In-process TTLCache in front of an optional shared backend."""
+
+    def __init__(self, local, shared=None, name='cache'):
+        self.local = local
+        self.shared = shared
+        self.name = name
+        self._counts = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            self._count('hits')
+            return value
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                logger.warning(f"{self.name}: shared cache read failed: {e}")
+                value = None
+            if value is not None:
+                self.local.set(key, value)
+                self._count('shared_hits')
+                return value
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value)
+            except Exception as e:
+                logger.warning(f"{self.name}: shared cache write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+        stats['size'] = len(self.local)
+        return stats
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Concurrent callers for the same key share one in-flight call."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Run fn() unless a call for key is already running, in which case
+        wait for and return that call's result. Returns (value, shared)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value, False
+
+
+class StaleWhileRevalidate:
+    """A single value that's reloaded in the background once it goes stale.
+
+    get() never waits on the loader: it returns the current value and, if that
+    value is older than ttl, starts one background refresh (a lock keeps
+    concurrent callers from stampeding the loader). A failed refresh keeps the
+    old value and isn't retried for retry_after seconds.
+    """
+
+    def __init__(self, loader, ttl, initial=None, retry_after=60, name='value'):
+        self.loader = loader
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.name = name
+        self.value = initial
+        self.loaded_at = 0.0   # wall clock of the last successful load; 0 = never
+        self._next_attempt = 0.0
+        self._refreshing = threading.Lock()
+        self._counts = {'refreshes': 0, 'failures': 0}
+        self._last_error = None
+        self._last_duration_ms = None
+
+    def get(self):
+        now = time.time()
+        if now - self.loaded_at >= self.ttl and now >= self._next_attempt:
+            self.refresh_async()
+        return self.value
+
+    def refresh_async(self):
+        """Start a background refresh unless one is already running."""
+        if not self._refreshing.acquire(blocking=False):
+            return False
+        threading.Thread(target=self._refresh_locked, name=f'refresh-{self.name}', daemon=True).start()
+        return True
+
+    def refresh(self):
+        """Reload synchronously (startup, CLI). Returns True on success."""
+        with self._refreshing:
+            return self._do_refresh()
+
+    def _refresh_locked(self):
+        try:
+            self._do_refresh()
+        finally:
+            self._refreshing.release()
+
+    def _do_refresh(self):
+        start = time.time()
+        try:
+            value = self.loader()
+        except Exception as e:
+            self._counts['failures'] += 1
+            self._last_error = str(e)
+            self._next_attempt = time.time() + self.retry_after
+            logger.warning(f"{self.name}: background refresh failed, serving stale value: {e}")
+            return False
+        finally:
+            self._last_duration_ms = int((time.time() - start) * 1000)
+        self.value = value
+        self.loaded_at = time.time()
+        self._counts['refreshes'] += 1
+        self._last_error = None
+        return True
+
+    def stats(self):
+        stats = dict(self._counts)
+        stats['age_sec'] = round(time.time() - self.loaded_at, 1) if self.loaded_at else None
+        stats['last_refresh_ms'] = self._last_duration_ms
+        stats['last_error'] = self._last_error
+        stats['refreshing'] = self._refreshing.locked()
+        return stats
@@ -1,50 +1,165 @@
 import os
-import time
+import sys
 import logging
-import requests
+from collections import deque
+
+from .cache import StaleWhileRevalidate
 
 logger = logging.getLogger(__name__)
 
-# Cache for blocked words (refreshed periodically)
-_blocked_words_cache = None
-_blocked_words_cache_time = None
+# TinyURL redirects to LDNOOBW repository on GitHub
+LDNOOBW_URL = "https://tinyurl.com/35wba3d6"
 
+# Vendored copy of the list, loaded at startup so no request ever waits on
+# the network. Refresh it with: python -m utilities.content_filter --update-snapshot
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), 'data', 'blocked_words.txt')
+# Last successfully fetched list, so a restarted worker starts from the newest
+# copy it has. /tmp is the only writable path on App Engine.
+RUNTIME_SNAPSHOT_PATH = os.getenv('CONTENT_FILTER_CACHE_PATH', '/tmp/aia_blocked_words.txt')
 
-def get_blocked_words():
+# Match whole words only ("ass" no longer blocks "class"). Off by default to
+# keep the original substring behaviour.
+WORD_BOUNDARY = os.getenv('CONTENT_FILTER_WORD_BOUNDARY', '').lower() in ('1', 'true', 'yes')
+
+
+class PhraseMatcher:
     """
-    Get blocked words from LDNOOBW repository (Shutterstock's list).
-    Caches the result for 1 hour.
+    Aho-Corasick automaton over the blocked phrases.
+
+    Built once per word list; each check is a single pass over the message,
+    so its cost depends on message length, not on how many phrases there are.
     """
-    global _blocked_words_cache, _blocked_words_cache_time
 
-    # Check cache (1 hour TTL)
-    if _blocked_words_cache and _blocked_words_cache_time:
-        if time.time() - _blocked_words_cache_time < 3600:
-            return _blocked_words_cache
+    def __init__(self, phrases):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]  # lengths of phrases ending at each state
+
+        for phrase in phrases:
+            if not phrase:
+                continue
+            state = 0
+            for ch in phrase:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            self._out[state] += (len(phrase),)
+
+        # Breadth-first pass to wire up failure links
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def search(self, text, word_boundary=False):
+        """True if any phrase occurs in text (as a whole word if word_boundary)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length in out[state]:
+                if not word_boundary:
+                    return True
+                start = i - length + 1
+                if (start == 0 or not text[start - 1].isalnum()) and \
+                        (i + 1 == len(text) or not text[i + 1].isalnum()):
+                    return True
+        return False
 
+
+_matcher = None
+_matcher_words = None
+
+
+def get_matcher():
+    """Matcher for the current word list, rebuilt only when the list changes."""
+    global _matcher, _matcher_words
+    words = get_blocked_words()
+    if words is not _matcher_words:
+        _matcher = PhraseMatcher(words)
+        _matcher_words = words
+    return _matcher
+
+
+def _custom_words():
     # Get any custom words from environment
     env_words = os.getenv('CUSTOM_BLOCKED_WORDS', '')
-    custom_words = [word.strip().lower() for word in env_words.split(',') if word.strip()]
+    return [word.strip().lower() for word in env_words.split(',') if word.strip()]
+
+
+def _parse_words(text):
+    # One word per line; '#' lines are comments in our snapshot files
+    return [word.strip().lower() for word in text.split('\n') if word.strip() and not word.startswith('#')]
+
 
+def _load_snapshot():
+    """Startup word list: the runtime snapshot if there is one, else the vendored copy."""
+    for path in (RUNTIME_SNAPSHOT_PATH, SNAPSHOT_PATH):
+        try:
+            with open(path, 'r') as f:
+                words = _parse_words(f.read())
+            logger.info(f"Loaded {len(words)} blocked words from {path}")
+            return list(set(_custom_words() + words))
+        except OSError:
+            continue
+    logger.warning("No blocked word snapshot found; content filter starts with custom words only")
+    return _custom_words()
+
+
+def _fetch_blocked_words():
+    """Fetch the LDNOOBW list (Shutterstock's list). Runs off the request path."""
+    import requests
+    response = requests.get(LDNOOBW_URL, timeout=5, allow_redirects=True)
+    response.raise_for_status()
+    ldnoobw_words = _parse_words(response.text)
+    if not ldnoobw_words:
+        raise ValueError("LDNOOBW word list was empty")
     try:
-        # TinyURL redirects to LDNOOBW repository on GitHub
-        url = "https://tinyurl.com/35wba3d6"
-        response = requests.get(url, timeout=5, allow_redirects=True)
-        if response.status_code == 200:
-            # Parse the word list (one word per line)
-            ldnoobw_words = [word.strip().lower() for word in response.text.split('\n') if word.strip()]
-            combined = list(set(custom_words + ldnoobw_words))
-            _blocked_words_cache = combined
-            _blocked_words_cache_time = time.time()
-            logger.info(f"Loaded {len(combined)} blocked words for content filter")
-            return combined
-    except Exception as e:
-        logger.warning(f"Failed to fetch LDNOOBW word list: {e}")
+        with open(RUNTIME_SNAPSHOT_PATH, 'w') as f:
+            f.write('\n'.join(sorted(ldnoobw_words)) + '\n')
+    except OSError as e:
+        logger.warning(f"Could not write blocked word snapshot: {e}")
+    combined = list(set(_custom_words() + ldnoobw_words))
+    logger.info(f"Loaded {len(combined)} blocked words for content filter")
+    return combined
+
+
+# Served stale-while-revalidate: the snapshot is marked stale from the start,
+# so the first check kicks off a background fetch, then hourly after that.
+_blocked_words = StaleWhileRevalidate(_fetch_blocked_words, ttl=3600, initial=_load_snapshot(),
+                                      retry_after=300, name='blocked_words')
+
+
+def get_blocked_words():
+    """
+    Get the current blocked word list. Never blocks on the network; a stale
+    list is returned while a background refresh runs.
+    """
+    return _blocked_words.get()
+
+
+def start_background_refresh():
+    """Fetch a fresh list now, in the background (called at worker start)."""
+    _blocked_words.refresh_async()
 
-    # Fallback to custom words only
-    _blocked_words_cache = custom_words if custom_words else []
-    _blocked_words_cache_time = time.time()
-    return _blocked_words_cache
+
+def blocked_words_stats():
+    stats = _blocked_words.stats()
+    stats['words'] = len(_blocked_words.value or [])
+    return stats
 
 
 def check_content_filter(message):
@@ -55,19 +170,30 @@ def check_content_filter(message):
         (is_allowed, error_message) - If allowed, error_message is None
     """
     try:
-        blocked_phrases = get_blocked_words()
-        if not blocked_phrases:
-            return True, None
-
-        message_lower = message.lower()
+        matcher = get_matcher()
 
         # Check for blocked words
-        for phrase in blocked_phrases:
-            if phrase and phrase in message_lower:
-                logger.info(f"[FILTER] BLOCKED message containing blocked content")
-                return False, "Please keep your topic professional. Try a different subject."
+        if matcher.search(message.lower(), word_boundary=WORD_BOUNDARY):
+            logger.info(f"[FILTER] BLOCKED message containing blocked content")
+            return False, "Please keep your topic professional. Try a different subject."
 
         return True, None
     except Exception as e:
         logger.error(f"Content filter error: {e}")
         return True, None  # Fail open
+
+
+if __name__ == '__main__':
+    # Regenerate the vendored snapshot from upstream
+    if '--update-snapshot' not in sys.argv:
+        print("Usage: python -m utilities.content_filter --update-snapshot")
+        sys.exit(1)
+    import requests
+    response = requests.get(LDNOOBW_URL, timeout=10, allow_redirects=True)
+    response.raise_for_status()
+    words = sorted(set(_parse_words(response.text)))
+    with open(SNAPSHOT_PATH, 'w') as f:
+        f.write("# Snapshot of the LDNOOBW English list (https://github.com/LDNOOBW).\n")
+        f.write("# Regenerate with: python -m utilities.content_filter --update-snapshot\n")
+        f.write('\n'.join(words) + '\n')
+    print(f"Wrote {len(words)} words to {SNAPSHOT_PATH}")
@@ -0,0 +1,84 @@
+"""Connections to the shared kumori Postgres (usage logging).
+
+On App Engine the DB is reached over the Cloud SQL unix socket, locally over
+TCP to KUMORI_POSTGRES_IP. get_pool() hands out a small per-process pool so
+background writers reuse connections instead of opening one per row.
+"""
+import os
+import logging
+import threading
+
+from .google_secret_utils import get_secrets
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_SIZE = int(os.getenv('AIA_DB_POOL_SIZE', '2'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+DB_SECRETS = {
+    'host': 'KUMORI_POSTGRES_IP',
+    'dbname': 'KUMORI_POSTGRES_DB_NAME',
+    'user': 'KUMORI_POSTGRES_USERNAME',
+    'password': 'KUMORI_POSTGRES_PASSWORD',
+    'connection_name': 'KUMORI_POSTGRES_CONNECTION_NAME',
+}
+
+
+def get_db_creds():
+    secrets = get_secrets(DB_SECRETS.values())
+    return {key: secrets[name] for key, name in DB_SECRETS.items()}
+
+
+def _connect_kwargs():
+    creds = get_db_creds()
+    is_gcp = os.environ.get('GAE_ENV', '').startswith('standard') or os.path.exists('/cloudsql')
+    if is_gcp:
+        host = f"{os.environ.get('DB_SOCKET_DIR', '/cloudsql')}/{creds['connection_name']}"
+    else:
+        host = creds['host']
+    return dict(host=host, dbname=creds['dbname'], user=creds['user'], password=creds['password'],
+                connect_timeout=5, options='-c statement_timeout=10000')
+
+
+def connect():
+    """A fresh, unpooled connection. Caller closes it."""
+    import psycopg2
+    return psycopg2.connect(**_connect_kwargs())
+
+
+def get_pool():
+    """The per-process connection pool, created on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # psycopg2 loads with the first DB write, not at import
+                from psycopg2.pool import ThreadedConnectionPool
+                _pool = ThreadedConnectionPool(0, DB_POOL_SIZE, **_connect_kwargs())
+    return _pool
+
+
+class pooled_connection:
+    """Context manager: borrow a pooled connection, discarding it on error."""
+
+    def __enter__(self):
+        self._pool = get_pool()
+        self.conn = self._pool.getconn()
+        if self.conn.closed:
+            self._pool.putconn(self.conn, close=True)
+            self.conn = self._pool.getconn()
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+        # Broken connections (server restart, idle timeout) are dropped
+        # rather than handed to the next caller
+        self._pool.putconn(self.conn, close=exc_type is not None or bool(self.conn.closed))
+        return False
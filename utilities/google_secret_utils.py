@@ -1,15 +1,120 @@
-from google.cloud import secretmanager
+"""Secret Manager access, cached per process.
 
-_cache = {}
+Every secret the app reads goes through get_secret(): one lazily created,
+shared client; concurrent first reads of the same secret collapse into one
+fetch; values are re-read in the background once they are AIA_SECRET_TTL
+seconds old (0 = keep for the life of the worker) so rotated secrets are picked
+up without a request ever waiting on Secret Manager. prefetch_secrets() warms
+the cache in parallel at worker start.
+
+Offline/local stand-ins, checked before Secret Manager: an AIA_SECRET_<NAME>
+env var, or a JSON object of {name: value} in the file named by
+AIA_SECRETS_FILE.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROJECT = 'kumori-404602'
+SECRET_TTL = float(os.getenv('AIA_SECRET_TTL', '3600'))
+SECRETS_FILE = os.getenv('AIA_SECRETS_FILE')
+
+_cache = {}  # "project:name" -> (fetched_at, value)
+_flight = SingleFlight()
 _client = None
+_client_lock = threading.Lock()
+_local_secrets = None
 
-def get_secret(name, project='kumori-404602'):
-    cache_key = f"{project}:{name}"
-    if cache_key in _cache:
-        return _cache[cache_key]
+
+def _get_client():
     global _client
     if _client is None:
-        _client = secretmanager.SecretManagerServiceClient()
-    val = _client.access_secret_version(request={"name": f"projects/{project}/secrets/{name}/versions/latest"}).payload.data.decode('UTF-8')
-    _cache[cache_key] = val
+        with _client_lock:
+            if _client is None:
+                from google.cloud import secretmanager
+                _client = secretmanager.SecretManagerServiceClient()
+    return _client
+
+
+def _local_secret(name):
+    global _local_secrets
+    val = os.environ.get(f'AIA_SECRET_{name}')
+    if val is not None:
+        return val
+    if SECRETS_FILE:
+        if _local_secrets is None:
+            with open(SECRETS_FILE) as f:
+                _local_secrets = json.load(f)
+        return _local_secrets.get(name)
+    return None
+
+
+def _fetch(name, project):
+    val = _local_secret(name)
+    if val is None:
+        path = f"projects/{project}/secrets/{name}/versions/latest"
+        val = _get_client().access_secret_version(request={"name": path}).payload.data.decode('UTF-8')
+    _cache[f"{project}:{name}"] = (time.monotonic(), val)
     return val
+
+
+def _refresh(name, project):
+    try:
+        _flight.do(f"{project}:{name}", lambda: _fetch(name, project))
+    except Exception as e:
+        logger.warning(f"Secret refresh failed for {name}, keeping cached value: {e}")
+
+
+def get_secret(name, project=DEFAULT_PROJECT):
+    cache_key = f"{project}:{name}"
+    cached = _cache.get(cache_key)
+    if cached is not None:
+        fetched_at, val = cached
+        if SECRET_TTL and time.monotonic() - fetched_at >= SECRET_TTL and not sys.is_finalizing():
+            # Rotate in the background; this caller gets the current value
+            _cache[cache_key] = (time.monotonic(), val)
+            threading.Thread(target=_refresh, args=(name, project), daemon=True).start()
+        return val
+    val, _ = _flight.do(cache_key, lambda: _fetch(name, project))
+    return val
+
+
+def get_secrets(names, project=DEFAULT_PROJECT):
+    """{name: value} for several secrets, fetching any uncached ones in parallel.
+    One at a time when only one is missing, or once the interpreter is shutting
+    down (e.g. an atexit flush) and no new threads can be started."""
+    missing = [n for n in names if f"{project}:{n}" not in _cache]
+    if len(missing) > 1 and not sys.is_finalizing():
+        prefetch_secrets(missing, project)
+    return {n: get_secret(n, project) for n in names}
+
+
+def prefetch_secrets(names, project=DEFAULT_PROJECT):
+    """Load secrets into the cache concurrently. Failures are logged, not raised;
+    get_secret() retries them on first use."""
+    def load(name):
+        try:
+            get_secret(name, project)
+            return True
+        except Exception as e:
+            logger.warning(f"Secret prefetch failed for {name}: {e}")
+            return False
+
+    if sys.is_finalizing():
+        return sum(map(load, names))
+    try:
+        with ThreadPoolExecutor(max_workers=len(names) or 1) as executor:
+            return sum(executor.map(load, names))
+    except RuntimeError:
+        # concurrent.futures stops taking work before atexit handlers (e.g. a
+        # final usage flush) run: "cannot schedule new futures after
+        # interpreter shutdown". load() never raises, so this is that.
+        return sum(map(load, names))
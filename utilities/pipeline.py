@@ -0,0 +1,195 @@
+"""Concurrency helpers for the /generate pipeline.
+
+Source search and style analysis don't depend on each other, so they run side
+by side. Each article is an independent Sonnet call, so they're fanned out over
+a small bounded thread pool and handed back in completion order (or, with
+AIA_ARTICLE_MODE=batched, written together in one call). Callers get
+the source index alongside each result so the client can slot it into place.
+With streaming on, article text is forwarded token by token as it's written.
+"""
+import os
+import queue
+import logging
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .anthropic_utils import (search_sources, analyze_style, generate_single_article,
+                              generate_single_article_stream, generate_articles_batched,
+                              article_prefix_state, mark_article_prefix_warm)
+from .uploads import close_uploads
+
+logger = logging.getLogger(__name__)
+
+# Run search_sources and analyze_style at the same time. 0 = one after the other.
+PIPELINE_STAGES = os.getenv('AIA_PIPELINE_STAGES', '1') not in ('0', 'false', 'no')
+# Per-request cap on concurrent article calls. 1 = the old one-at-a-time path.
+ARTICLE_WORKERS = int(os.getenv('AIA_ARTICLE_WORKERS', '3'))
+# Forward article text as it's generated rather than one finished post at a time.
+STREAM_ARTICLES = os.getenv('AIA_STREAM_ARTICLES', '1') not in ('0', 'false', 'no')
+# 'fanout': one call per source. 'batched': one call writes every post (not
+# streamed; logged as feature generate_batched so the two can be compared).
+ARTICLE_MODE = os.getenv('AIA_ARTICLE_MODE', 'fanout')
+
+
+def _style_stage(file_contents, sample_content, tally):
+    # The uploads are only needed for the style call; free them as soon as it's done
+    try:
+        return analyze_style(file_contents, sample_content, tally)
+    finally:
+        close_uploads(file_contents)
+
+
+def iter_prep_stages(topic, file_contents=None, sample_content=None, pipelined=None, tally=None):
+    """Yield ('sources', list) and ('style', str) as each stage finishes.
+
+    Pipelined, both calls start at once and whichever lands first comes out
+    first. The caller may stop early (e.g. no sources found); the other call
+    is left to finish in the background rather than blocking the response.
+    Token usage of any calls made is added to tally (a UsageTally).
+    """
+    if not (PIPELINE_STAGES if pipelined is None else pipelined):
+        yield 'sources', search_sources(topic, tally=tally)
+        yield 'style', _style_stage(file_contents, sample_content, tally)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='aia-stage')
+    futures = {
+        executor.submit(search_sources, topic, tally=tally): 'sources',
+        executor.submit(_style_stage, file_contents, sample_content, tally): 'style',
+    }
+    try:
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_articles(sources, style, max_workers=None, tally=None, mode=None):
+    """Yield (index, article) for each source as soon as its article is done.
+
+    Closing the generator early (e.g. the SSE client went away) cancels any
+    articles that haven't started yet. Calls already in flight run to
+    completion in the background so their usage still gets logged.
+    """
+    if (mode or ARTICLE_MODE) == 'batched':
+        yield from _iter_batched(sources, style, max_workers, tally)
+        return
+    yield from _iter_fanout(list(enumerate(sources)), style, max_workers, tally)
+
+
+def _iter_fanout(indexed_sources, style, max_workers, tally):
+    workers = ARTICLE_WORKERS if max_workers is None else max_workers
+    workers = max(1, min(workers, len(indexed_sources)))
+
+    if workers == 1:
+        # One at a time, each call reads what the one before it wrote
+        cacheable = article_prefix_state(style) != 'uncached'
+        for i, src in indexed_sources:
+            article = generate_single_article(src, style, i, tally)
+            if cacheable:
+                mark_article_prefix_warm(style)
+            yield i, article
+        return
+
+    # Calls sent together can't read each other's cache writes, and a whole
+    # response is needed to know one has started. On a cold prefix only the
+    # first call is marked (one write, for later requests on this style)
+    # rather than paying the write premium on every call.
+    state = article_prefix_state(style)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aia-article')
+    futures = {executor.submit(generate_single_article, src, style, i, tally, state == 'warm' or n == 0): i
+               for n, (i, src) in enumerate(indexed_sources)}
+    try:
+        for fut in as_completed(futures):
+            article = fut.result()
+            if state != 'uncached':
+                mark_article_prefix_warm(style)
+            yield futures[fut], article
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _iter_batched(sources, style, max_workers, tally):
+    """One call for every post; any the response didn't deliver (bad JSON,
+    missing or empty posts, or the call itself failing) are written per
+    source as in fan-out mode."""
+    import requests
+    try:
+        articles = generate_articles_batched(sources, style, tally)
+    except (ValueError, requests.RequestException) as e:
+        logger.warning(f"Batched article call failed, falling back to fan-out: {e}")
+        articles = {}
+    for i in sorted(articles):
+        yield i, articles[i]
+    missing = [(i, src) for i, src in enumerate(sources) if i not in articles]
+    if missing:
+        logger.warning(f"Batched article call missing {len(missing)} of {len(sources)} posts, writing them individually")
+        yield from _iter_fanout(missing, style, max_workers, tally)
+
+
+def iter_article_events(sources, style, max_workers=None, tally=None, mode=None):
+    """Streaming iter_articles.
+
+    Yields ('delta', index, text) as tokens arrive and ('done', index, article)
+    once each post is complete. Workers push into one queue, so deltas from
+    concurrent articles interleave. Closing the generator tells every worker to
+    drop its upstream stream, which ends generation and logs partial usage.
+    Batched mode isn't streamed: it yields only the 'done' events.
+    """
+    if (mode or ARTICLE_MODE) == 'batched':
+        for i, article in _iter_batched(sources, style, max_workers, tally):
+            yield 'done', i, article
+        return
+
+    workers = ARTICLE_WORKERS if max_workers is None else max_workers
+    workers = max(1, min(workers, len(sources)))
+    events = queue.Queue()
+    cancelled = threading.Event()
+    # On a new cacheable prefix the first call goes alone; the rest start once
+    # its response has begun and they can read what it wrote
+    prefix_written = threading.Event()
+    prefix_state = article_prefix_state(style)
+    if prefix_state != 'cold':
+        prefix_written.set()
+
+    def on_start():
+        if prefix_state != 'uncached':
+            mark_article_prefix_warm(style)
+        prefix_written.set()
+
+    def run(i, src):
+        parts = []
+        try:
+            if i:
+                prefix_written.wait()
+            if cancelled.is_set():
+                return
+            with closing(generate_single_article_stream(src, style, i, tally, on_start=on_start)) as stream:
+                for text in stream:
+                    if cancelled.is_set():
+                        return
+                    parts.append(text)
+                    events.put(('delta', i, text))
+            events.put(('done', i, {"content": ''.join(parts), "source": src}))
+        except Exception as e:
+            events.put(('error', i, e))
+        finally:
+            if i == 0:
+                prefix_written.set()  # however the first call ended
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aia-article')
+    for i, src in enumerate(sources):
+        executor.submit(run, i, src)
+    try:
+        remaining = len(sources)
+        while remaining:
+            kind, i, payload = events.get()
+            if kind == 'error':
+                raise payload
+            if kind == 'done':
+                remaining -= 1
+            yield kind, i, payload
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,139 @@
+"""asyncio counterparts of the pipeline helpers, for asgi.py.
+
+Same shape as pipeline.py: search and style side by side, then every article
+at once (at most AIA_ARTICLE_WORKERS per request), handed back in completion
+order with the source index. Tasks replace the thread pools, so the limit on
+concurrent requests is memory and the API, not threads.
+"""
+import asyncio
+import logging
+from contextlib import aclosing
+
+from .anthropic_async import (asearch_sources, aanalyze_style, agenerate_single_article,
+                              agenerate_single_article_stream, agenerate_articles_batched)
+from .anthropic_utils import article_prefix_state, mark_article_prefix_warm
+from .pipeline import PIPELINE_STAGES, ARTICLE_WORKERS, ARTICLE_MODE
+from .uploads import close_uploads
+
+logger = logging.getLogger(__name__)
+
+# Prep calls left running when a request ends early; held so they aren't
+# garbage collected before they finish and log their usage
+_background = set()
+
+
+def _detach(tasks):
+    for task in tasks:
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+async def _style_stage(file_contents, sample_content, tally):
+    try:
+        return await aanalyze_style(file_contents, sample_content, tally)
+    finally:
+        close_uploads(file_contents)
+
+
+async def aiter_prep_stages(topic, file_contents=None, sample_content=None, tally=None):
+    """Yield ('sources', list) and ('style', str) as each stage finishes.
+    If the caller stops early the other stage finishes in the background."""
+    if not PIPELINE_STAGES:
+        yield 'sources', await asearch_sources(topic, tally=tally)
+        yield 'style', await _style_stage(file_contents, sample_content, tally)
+        return
+
+    tasks = {
+        asyncio.ensure_future(asearch_sources(topic, tally=tally)): 'sources',
+        asyncio.ensure_future(_style_stage(file_contents, sample_content, tally)): 'style',
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield tasks[task], task.result()
+    finally:
+        _detach(pending)
+
+
+async def aiter_article_events(sources, style, tally=None, mode=None, stream=True):
+    """Async iter_article_events. Yields ('delta', index, text) as tokens
+    arrive (stream=True only) and ('done', index, article) per finished post.
+    Closing the generator cancels the article streams still running."""
+    articles = {}
+    if (mode or ARTICLE_MODE) == 'batched':
+        import httpx
+        try:
+            articles = await agenerate_articles_batched(sources, style, tally)
+        except (ValueError, httpx.HTTPError) as e:
+            logger.warning(f"Batched article call failed, falling back to fan-out: {e}")
+        for i in sorted(articles):
+            yield 'done', i, articles[i]
+        if len(articles) < len(sources):
+            logger.warning(f"Batched article call missing {len(sources) - len(articles)} of {len(sources)} posts, "
+                           f"writing them individually")
+        stream = False  # batched mode isn't streamed; neither are its retries
+
+    events = asyncio.Queue()
+    limit = asyncio.Semaphore(max(1, ARTICLE_WORKERS))
+    started = set()
+    # As in pipeline.py: streamed, the first call on a new cacheable prefix
+    # goes alone and the rest start on its message_start; unstreamed calls
+    # can't see that, so on a cold prefix only the first one is marked
+    prefix_state = article_prefix_state(style)
+    prefix_written = asyncio.Event()
+    if prefix_state != 'cold':
+        prefix_written.set()
+    cache = prefix_state == 'warm' or ARTICLE_WORKERS <= 1
+    first = min((i for i in range(len(sources)) if i not in articles), default=None)
+
+    def on_start():
+        if prefix_state != 'uncached':
+            mark_article_prefix_warm(style)
+        prefix_written.set()
+
+    async def run(i, src):
+        try:
+            if stream and i != first:
+                await prefix_written.wait()
+            async with limit:
+                started.add(i)
+                if stream:
+                    parts = []
+                    async with aclosing(agenerate_single_article_stream(src, style, i, tally,
+                                                                        on_start=on_start)) as text_stream:
+                        async for text in text_stream:
+                            parts.append(text)
+                            events.put_nowait(('delta', i, text))
+                    article = {"content": ''.join(parts), "source": src}
+                else:
+                    article = await agenerate_single_article(src, style, i, tally, cache or i == first)
+                    if prefix_state != 'uncached':
+                        mark_article_prefix_warm(style)
+            events.put_nowait(('done', i, article))
+        except Exception as e:
+            events.put_nowait(('error', i, e))
+        finally:
+            if i == first:
+                prefix_written.set()  # however the first call ended
+
+    tasks = {i: asyncio.ensure_future(run(i, src)) for i, src in enumerate(sources) if i not in articles}
+    try:
+        remaining = len(tasks)
+        while remaining:
+            kind, i, payload = await events.get()
+            if kind == 'error':
+                raise payload
+            if kind == 'done':
+                remaining -= 1
+            yield kind, i, payload
+    finally:
+        # Cancelling a stream ends generation upstream and logs partial usage;
+        # a plain call already sent is billed either way, so let it finish
+        # and log. Calls not yet started are dropped.
+        for i, task in tasks.items():
+            if stream or i not in started:
+                task.cancel()
+            else:
+                _detach([task])
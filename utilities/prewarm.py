@@ -0,0 +1,115 @@
+"""Background pre-warming of source searches for the preset topics.
+
+Most traffic is one of the preset topic buttons, so a single daemon thread
+per worker re-runs search_sources for each of them on an interval, keeping the
+search cache warm and letting those requests skip straight to generation.
+
+Guard rails, since every refresh is a paid web_search call:
+  - jitter on every cycle so instances don't refresh in lockstep
+  - a cap on concurrent searches
+  - a rolling 24h cap on searches; cycles over budget are skipped
+Keep the interval below AIA_SEARCH_CACHE_TTL or entries expire between runs.
+"""
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .anthropic_utils import search_sources
+
+logger = logging.getLogger(__name__)
+
+PREWARM_INTERVAL = int(os.getenv('AIA_PREWARM_INTERVAL', '0'))  # seconds; 0 = off
+PREWARM_JITTER = float(os.getenv('AIA_PREWARM_JITTER', '0.1'))  # fraction of interval
+PREWARM_CONCURRENCY = int(os.getenv('AIA_PREWARM_CONCURRENCY', '2'))
+PREWARM_MAX_SEARCHES_PER_DAY = int(os.getenv('AIA_PREWARM_MAX_SEARCHES_PER_DAY', '300'))
+
+
+class SearchPrewarmer:
+    def __init__(self, topics, interval=PREWARM_INTERVAL, jitter=PREWARM_JITTER,
+                 max_concurrency=PREWARM_CONCURRENCY, max_searches_per_day=PREWARM_MAX_SEARCHES_PER_DAY):
+        self.topics = list(topics)
+        self.interval = interval
+        self.jitter = jitter
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_searches_per_day = max_searches_per_day
+        self._recent = deque()  # timestamps of searches in the last 24h
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._counts = {'cycles': 0, 'searches': 0, 'failures': 0, 'skipped_budget': 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._counts[key] += n
+
+    def _take_budget(self):
+        """Reserve one search against the rolling 24h cap."""
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0] <= now - 86400:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_searches_per_day:
+                return False
+            self._recent.append(now)
+            return True
+
+    def _refresh(self, topic):
+        try:
+            sources = search_sources(topic, refresh=True)
+            self._count('searches')
+            if not sources:
+                logger.info(f"Prewarm: no sources for {topic!r}, keeping previous entry")
+        except Exception as e:
+            self._count('failures')
+            logger.warning(f"Prewarm: search for {topic!r} failed: {e}")
+
+    def run_once(self):
+        topics = self.topics[:]
+        random.shuffle(topics)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='aia-prewarm') as pool:
+            for topic in topics:
+                if not self._take_budget():
+                    self._count('skipped_budget', len(topics) - topics.index(topic))
+                    logger.warning("Prewarm: daily search budget reached, skipping rest of cycle")
+                    break
+                pool.submit(self._refresh, topic)
+        self._count('cycles')
+
+    def _next_delay(self):
+        return max(1.0, self.interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def _loop(self):
+        # Stagger the first run too, so a fleet of fresh workers doesn't
+        # fire all at once
+        if self._stop.wait(random.uniform(0, self.interval * self.jitter)):
+            return
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning(f"Prewarm cycle failed: {e}")
+            if self._stop.wait(self._next_delay()):
+                return
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return False
+        self._thread = threading.Thread(target=self._loop, name='aia-prewarm', daemon=True)
+        self._thread.start()
+        logger.info(f"Prewarm: refreshing {len(self.topics)} topics every ~{self.interval}s")
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats['searches_last_24h'] = len(self._recent)
+        stats['enabled'] = self._thread is not None
+        stats['interval'] = self.interval
+        return stats
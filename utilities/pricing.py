@@ -0,0 +1,186 @@
+"""Per-token model pricing for kumori_api_usage cost estimates.
+
+The one rate table for both logging paths (anthropic_utils.log_api_usage and
+anthropic_logger). Static rates below are overlaid by the kumori_model_pricing
+table, which kumori's /cron/anthropic-pricing-refresh keeps in sync with
+LiteLLM upstream.
+
+Both are folded into a PricingIndex keyed by canonical model id once per
+refresh. Refreshes run in the background (stale-while-revalidate), so pricing
+a call never waits on Postgres. A model id resolves to its longest matching
+key on '-' boundaries (claude-sonnet-4-20250514 -> claude-sonnet-4,
+claude-opus-4-1-x -> claude-opus-4-1) and the answer is memoized, so pricing
+a call is a dict lookup instead of a scan over every known model.
+"""
+import os
+import re
+import logging
+
+from .cache import StaleWhileRevalidate
+
+logger = logging.getLogger(__name__)
+
+# Update here when rates change or new models ship.
+MODEL_PRICING = {
+    # Claude 4.7 / 4.6 flagship Opus — $5/$25 per 1M (verified 2026-05-07
+    # against LiteLLM upstream; was incorrectly $15/$75 prior to that, which
+    # is what caused the kumori_api_usage drift on opus-4-7 traffic).
+    'claude-opus-4-7':         {'input': 0.000005,    'output': 0.000025},
+    'claude-opus-4-6':         {'input': 0.000005,    'output': 0.000025},
+    'claude-sonnet-4-6':       {'input': 0.000003,    'output': 0.000015},    # $3  / $15
+
+    # Claude 4.5
+    'claude-sonnet-4-5':       {'input': 0.000003,    'output': 0.000015},
+    'claude-haiku-4-5':        {'input': 0.0000010,   'output': 0.000005},    # $1  / $5  per 1M
+
+    # Claude 4.1 / 4
+    'claude-opus-4-1':         {'input': 0.000020,    'output': 0.000080},
+    'claude-opus-4':           {'input': 0.000015,    'output': 0.000075},
+    'claude-sonnet-4':         {'input': 0.000003,    'output': 0.000015},
+
+    # Claude 3.x
+    'claude-3-7-sonnet':       {'input': 0.000003,    'output': 0.000015},
+    'claude-3-5-sonnet':       {'input': 0.000003,    'output': 0.000015},
+    'claude-3-5-haiku':        {'input': 0.00000025,  'output': 0.00000125},
+    'claude-3-haiku':          {'input': 0.00000025,  'output': 0.00000125},
+
+    # Fallback (Sonnet-tier pricing)
+    'default':                 {'input': 0.000003,    'output': 0.000015},
+}
+
+CACHE_WRITE_MULT = 1.25  # cache creation costs 1.25x input rate
+CACHE_READ_MULT  = 0.10  # cache read costs 0.10x input rate
+WEB_SEARCH_COST  = 0.01  # flat per web search request
+BATCH_MULT       = 0.50  # Message Batches API bills tokens at half rate
+
+DB_PRICING_TTL = int(os.getenv('AIA_PRICING_TTL', '300'))
+_MEMO_MAX = 256  # distinct model ids; callers pass a handful
+
+_DATED_MODEL_RE = re.compile(r'-(\d{8})$')
+
+
+def canonical_model_id(model):
+    """Strip Anthropic dated suffix (-YYYYMMDD) so e.g.
+    claude-haiku-4-5-20251001 → claude-haiku-4-5. Anthropic's admin usage_report
+    always returns the dated form; the API accepts both. If we let the dated
+    form into kumori_api_usage, the hourly reconciler sees the same hour's
+    traffic split across two model rows and fires a false-positive leak alert.
+    Apply this at the write boundary so the column is always canonical."""
+    if not model:
+        return model
+    return _DATED_MODEL_RE.sub('', model)
+
+
+class PricingIndex:
+    """Canonical model id -> rates, with memoized longest-prefix lookup."""
+
+    def __init__(self, static, db=None):
+        self.default = static['default']
+        self._table = {canonical_model_id(k.lower()): v for k, v in static.items() if k != 'default'}
+        # DB rows win over the static table for the same model
+        for k, v in (db or {}).items():
+            self._table[canonical_model_id(k.lower())] = v
+        self.db_models = len(db or ())
+        self._memo = {}
+
+    def __len__(self):
+        return len(self._table)
+
+    def lookup(self, model):
+        p = self._memo.get(model)
+        if p is None:
+            p = self._resolve(model)
+            if len(self._memo) < _MEMO_MAX:
+                self._memo[model] = p
+        return p
+
+    def _resolve(self, model):
+        m = canonical_model_id((model or '').lower())
+        # Provider-prefixed ids (us.anthropic.claude-..., anthropic/claude-...)
+        at = m.find('claude')
+        for key in ((m, m[at:]) if at > 0 else (m,)):
+            while key:
+                p = self._table.get(key)
+                if p is not None:
+                    return p
+                cut = key.rfind('-')
+                if cut <= 0:
+                    break
+                key = key[:cut]
+        return self.default
+
+
+def load_db_pricing():
+    """Return {model_id: {input, output, cache_write_abs, cache_read_abs}}
+    from kumori_model_pricing. Raises on any DB error; runs off the request path."""
+    from .db import connect
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT model_id,
+                   input_cost_per_token::float,
+                   output_cost_per_token::float,
+                   cache_write_cost_per_token::float,
+                   cache_read_cost_per_token::float
+            FROM kumori_model_pricing
+        """)
+        out = {}
+        for mid, inp, outp, cw, cr in cur.fetchall():
+            d = {'input': float(inp or 0), 'output': float(outp or 0)}
+            if cw is not None:
+                d['cache_write_abs'] = float(cw)
+            if cr is not None:
+                d['cache_read_abs'] = float(cr)
+            out[mid.lower()] = d
+        return out
+    finally:
+        conn.close()
+
+
+def _build_index():
+    return PricingIndex(MODEL_PRICING, load_db_pricing())
+
+
+# Lookups never touch the DB: a stale index is served while one background
+# refresh runs, and a failed refresh keeps the last good index.
+_index = StaleWhileRevalidate(_build_index, ttl=DB_PRICING_TTL, initial=PricingIndex(MODEL_PRICING),
+                              retry_after=60, name='model_pricing')
+
+
+def get_index():
+    return _index.get()
+
+
+def start_pricing_refresh():
+    """Load DB pricing now, in the background (called at worker start)."""
+    _index.refresh_async()
+
+
+def pricing_stats():
+    stats = _index.stats()
+    index = _index.value
+    stats['models'] = len(index)
+    stats['db_models'] = index.db_models
+    return stats
+
+
+def pricing_for(model):
+    return get_index().lookup(model)
+
+
+def compute_cost(model, input_tokens=0, output_tokens=0, cache_creation_tokens=0,
+                 cache_read_tokens=0, thinking_tokens=0, web_search_requests=0, batch=False):
+    """Estimated USD for one call. Thinking tokens bill at the output rate;
+    batch=True applies the Message Batches discount to the token charges."""
+    p = pricing_for(model)
+    cache_write_rate = p.get('cache_write_abs', p['input'] * CACHE_WRITE_MULT)
+    cache_read_rate = p.get('cache_read_abs', p['input'] * CACHE_READ_MULT)
+    tokens = (
+        input_tokens * p['input']
+        + output_tokens * p['output']
+        + cache_creation_tokens * cache_write_rate
+        + cache_read_tokens * cache_read_rate
+        + thinking_tokens * p['output']
+    )
+    return tokens * (BATCH_MULT if batch else 1) + web_search_requests * WEB_SEARCH_COST
@@ -0,0 +1,158 @@
+"""Shared rate-limit counters for Flask-Limiter.
+
+With storage_uri="memory://" every gunicorn worker kept its own counters, so
+"10 per hour" was really 10 per hour per process. SQLiteStorage keeps them in
+one WAL-mode SQLite file that every worker on an instance shares. A hit is a
+single atomic UPSERT ... RETURNING, and a sliding-window hit reads both windows
+and increments inside one BEGIN IMMEDIATE, so two workers can never both take
+the last slot.
+
+Importing this module registers the sqlite:// scheme with `limits`.
+AIA_RATELIMIT_STORAGE_URI picks the backend:
+    sqlite:///tmp/aia_ratelimit.sqlite  default; shared by all workers on an instance
+    redis://host:6379                   shared across instances too (e.g. Memorystore; needs `redis`)
+    memory://                           per process, the old behaviour
+
+The file lives in /tmp (the only writable path on App Engine), so counters
+survive worker restarts but not instance teardown.
+"""
+import os
+import time
+import sqlite3
+import threading
+from urllib.parse import urlparse
+
+from limits.storage import Storage, SlidingWindowCounterSupport
+from limits.storage.base import TimestampedSlidingWindow
+
+RATELIMIT_STORAGE_URI = os.getenv('AIA_RATELIMIT_STORAGE_URI', 'sqlite:///tmp/aia_ratelimit.sqlite')
+RATELIMIT_STRATEGY = os.getenv('AIA_RATELIMIT_STRATEGY', 'sliding-window-counter')
+
+_PURGE_EVERY = 1000  # hits between sweeps of expired counters
+
+_INCR_SQL = """
+    INSERT INTO ratelimit (key, value, expires_at) VALUES (:key, :amount, :expires_at)
+    ON CONFLICT(key) DO UPDATE SET
+        value = CASE WHEN expires_at <= :now THEN :amount ELSE value + :amount END,
+        expires_at = CASE WHEN expires_at <= :now THEN :expires_at ELSE expires_at END
+    RETURNING value
+"""
+
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """`limits` storage over a SQLite file: sqlite:///path/to/file.sqlite"""
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=None, wrap_exceptions=False, **options):
+        self.path = urlparse(uri).path if uri else '/tmp/aia_ratelimit.sqlite'
+        self.timeout = float(options.get('timeout', 5))
+        self._local = threading.local()
+        self._hits = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        # Workers starting together all race to create the file, and switching
+        # it to WAL takes a lock the busy timeout doesn't cover. WAL sticks to
+        # the file, so this only has to win once.
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                conn = self._conn()
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS ratelimit (
+                        key TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL,
+                        expires_at REAL NOT NULL
+                    )
+                """)
+                break
+            except sqlite3.OperationalError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # Counters are cheap to lose on an OS crash; don't fsync every hit
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _incr(self, conn, key, expiry, amount, now):
+        self._hits += 1
+        if self._hits % _PURGE_EVERY == 0:
+            conn.execute("DELETE FROM ratelimit WHERE expires_at <= ?", (now,))
+        return conn.execute(_INCR_SQL, {'key': key, 'amount': amount, 'now': now,
+                                        'expires_at': now + expiry}).fetchone()[0]
+
+    def _get(self, conn, key, now):
+        row = conn.execute("SELECT value FROM ratelimit WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, key, expiry, amount=1):
+        return self._incr(self._conn(), key, expiry, amount, time.time())
+
+    def get(self, key):
+        return self._get(self._conn(), key, time.time())
+
+    def get_expiry(self, key):
+        row = self._conn().execute("SELECT expires_at FROM ratelimit WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self._conn().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        return self._conn().execute("DELETE FROM ratelimit").rowcount
+
+    def clear(self, key):
+        self._conn().execute("DELETE FROM ratelimit WHERE key = ?", (key,))
+
+    # --- Sliding window counter ---
+
+    def _sliding_window(self, conn, key, expiry, now):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count = self._get(conn, previous_key, now)
+        current_count = self._get(conn, current_key, now)
+        previous_ttl = 0.0 if previous_count == 0 else (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return current_key, previous_count, previous_ttl, current_count, current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        conn = self._conn()
+        now = time.time()
+        # Read-check-increment under the write lock, so it's exact across processes
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current_key, previous_count, previous_ttl, current_count, _ = self._sliding_window(
+                conn, key, expiry, now)
+            if int(previous_count * previous_ttl / expiry + current_count) + amount > limit:
+                conn.execute('COMMIT')
+                return False
+            # The current window's counter is read as the previous one next window
+            self._incr(conn, current_key, 2 * expiry, amount, now)
+            conn.execute('COMMIT')
+            return True
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def get_sliding_window(self, key, expiry):
+        _, *window = self._sliding_window(self._conn(), key, expiry, time.time())
+        return tuple(window)
+
+    def clear_sliding_window(self, key, expiry):
+        for k in self.sliding_window_keys(key, expiry, time.time()):
+            self.clear(k)
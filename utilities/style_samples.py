@@ -0,0 +1,306 @@
+"""Local preprocessing of writing samples before the style call.
+
+Whole PDFs used to go to the API as base64 document blocks and text files
+went in verbatim, so a long upload cost thousands of input tokens (and
+seconds) for a voice profile that a few pages pin down. Instead:
+
+1. Text is extracted locally: PDFs with pypdf (optional; imported on first
+   use), .docx from its document.xml, .txt/.md/.html decoded as UTF-8.
+2. Boilerplate is dropped: lines that recur on most pages of a document
+   (running headers, footers, page numbers), and paragraphs repeated within
+   or across samples (signatures, "subscribe" blurbs).
+3. If what's left is over AIA_STYLE_SAMPLE_TOKENS, each document gets a
+   share of the budget and keeps paragraphs spread evenly from start to
+   end, in their original order, with [...] marking the gaps.
+
+The image/document path is only used for images and for PDFs with no
+extractable text (scanned pages) or when pypdf isn't installed. Any other file
+with no text to extract (a .doc, a corrupt .docx) is skipped with a warning.
+AIA_STYLE_EXTRACT=0 turns all of this off.
+"""
+import io
+import os
+import re
+import logging
+import zipfile
+import threading
+from xml.etree import ElementTree
+
+logger = logging.getLogger(__name__)
+
+STYLE_EXTRACT = os.getenv('AIA_STYLE_EXTRACT', '1') not in ('0', 'false', 'no')
+# Approximate input tokens of sample text sent to the style call; 0 = no limit
+STYLE_SAMPLE_TOKENS = int(os.getenv('AIA_STYLE_SAMPLE_TOKENS', '6000'))
+
+IMAGE_EXTS = ('jpg', 'jpeg', 'png', 'gif', 'webp')
+TEXT_EXTS = ('txt', 'md', 'html')
+# Less extracted text than this and the PDF is treated as scanned
+_MIN_EXTRACTED_CHARS = 200
+# Stop extracting past this much text; sampling only needs a fraction of it
+_MAX_EXTRACTED_CHARS = 2_000_000
+_MAX_PDF_PAGES = 300
+# A line on at least this share of a document's pages (and on 3 or more) is boilerplate
+_BOILERPLATE_PAGE_SHARE = 0.5
+_GAP = '[...]'
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+_stats = {'files': 0, 'extracted': 0, 'fallbacks': 0, 'skipped': 0, 'boilerplate_lines': 0,
+          'duplicate_paragraphs': 0, 'tokens_in': 0, 'tokens_sent': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for key, n in deltas.items():
+            _stats[key] += n
+
+
+def sample_stats():
+    with _stats_lock:
+        return {**_stats, 'token_budget': STYLE_SAMPLE_TOKENS, 'extract': STYLE_EXTRACT}
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters a token for English prose)"""
+    return len(text) // 4 + 1
+
+
+def _ext(filename):
+    return filename.split('.')[-1].lower()
+
+
+def _stream(data):
+    if isinstance(data, (bytes, bytearray)):
+        return io.BytesIO(data)
+    data.seek(0)
+    return data
+
+
+def _read_text(data):
+    raw = bytes(data) if isinstance(data, (bytes, bytearray)) else _stream(data).read()
+    return raw.decode('utf-8', errors='ignore')
+
+
+# --- Extraction: each returns a list of page texts, or None if it can't ---
+
+def _pdf_pages(data):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    pages, chars = [], 0
+    try:
+        for page in PdfReader(_stream(data)).pages[:_MAX_PDF_PAGES]:
+            text = page.extract_text() or ''
+            pages.append(text)
+            chars += len(text)
+            if chars > _MAX_EXTRACTED_CHARS:
+                break
+    except Exception as e:
+        logger.warning(f"PDF text extraction failed: {e}")
+        return None
+    return pages if chars >= _MIN_EXTRACTED_CHARS else None
+
+
+def _docx_pages(data):
+    paragraphs, chars = [], 0
+    try:
+        with zipfile.ZipFile(_stream(data)) as z, z.open('word/document.xml') as doc:
+            for _, el in ElementTree.iterparse(doc):
+                if el.tag == f'{_WORD_NS}p':
+                    text = ''.join(t.text or '' for t in el.iter(f'{_WORD_NS}t'))
+                    paragraphs.append(text)
+                    chars += len(text)
+                    el.clear()
+                    if chars > _MAX_EXTRACTED_CHARS:
+                        break
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        logger.warning(f"DOCX text extraction failed: {e}")
+        return None
+    # Word paragraphs are already paragraphs; blank lines keep them apart
+    return ['\n\n'.join(paragraphs)]
+
+
+def _extract(filename, data):
+    ext = _ext(filename)
+    if ext == 'pdf':
+        return _pdf_pages(data)
+    if ext == 'docx':
+        return _docx_pages(data)
+    if ext in TEXT_EXTS:
+        return [_read_text(data)[:_MAX_EXTRACTED_CHARS]]
+    return None
+
+
+# --- Boilerplate and paragraphs ---
+
+def _norm(text):
+    # Case, spacing and numbers don't distinguish a repeat ("Page 3 of 12")
+    return re.sub(r'\d+', '#', ' '.join(text.lower().split()))
+
+
+def _boilerplate_lines(pages):
+    """Normalized lines that recur across most of a document's pages"""
+    if len(pages) < 3:
+        return set()
+    seen = {}
+    for page in pages:
+        for line in {_norm(line) for line in page.splitlines() if line.strip()}:
+            seen[line] = seen.get(line, 0) + 1
+    threshold = max(3, len(pages) * _BOILERPLATE_PAGE_SHARE)
+    return {line for line, n in seen.items() if n >= threshold}
+
+
+def _pdf_paragraphs(page):
+    """PDF text comes as wrapped lines with no blank lines between
+    paragraphs: a paragraph ends at a short line closing a sentence."""
+    lines = [line.strip() for line in page.splitlines() if line.strip()]
+    if not lines:
+        return []
+    width = sorted(len(line) for line in lines)[len(lines) // 2]
+    paragraphs, current = [], ''
+    for line in lines:
+        if current.endswith('-') and line[:1].islower():
+            current = current[:-1] + line  # re-join a hyphenated word
+        else:
+            current = f"{current} {line}" if current else line
+        if line[-1] in '.!?:"”' and len(line) < 0.8 * width:
+            paragraphs.append(current)
+            current = ''
+    if current:
+        paragraphs.append(current)
+    return paragraphs
+
+
+def _text_paragraphs(page):
+    # Keep line breaks inside a paragraph; in short-form posts they're part of the voice
+    return [block.strip() for block in re.split(r'\n\s*\n', page.replace('\r\n', '\n').replace('\r', '\n'))
+            if block.strip()]
+
+
+def _paragraphs(filename, pages):
+    """Paragraphs of one document with its boilerplate lines removed.
+    Returns (paragraphs, boilerplate lines dropped)."""
+    boilerplate = _boilerplate_lines(pages)
+    split = _pdf_paragraphs if _ext(filename) == 'pdf' else _text_paragraphs
+    paragraphs, dropped = [], 0
+    for page in pages:
+        if boilerplate:
+            kept = [line for line in page.splitlines() if _norm(line) not in boilerplate]
+            dropped += sum(1 for line in page.splitlines() if line.strip()) - sum(1 for line in kept if line.strip())
+            page = '\n'.join(kept)
+        paragraphs.extend(split(page))
+    return paragraphs, dropped
+
+
+# --- Sampling ---
+
+def _spread_order(n):
+    """Indexes 0..n-1 ordered so any prefix covers the range evenly: first,
+    last, middle, quarters, eighths..."""
+    order, seen, parts = [], set(), 1
+    while len(order) < n:
+        for j in range(parts + 1):
+            i = round(j * (n - 1) / parts)
+            if i not in seen:
+                seen.add(i)
+                order.append(i)
+        parts *= 2
+    return order
+
+
+def _sample(paragraphs, budget):
+    """Paragraphs spread across the document, within budget tokens, joined
+    in their original order with [...] where some were left out"""
+    chosen, left = set(), budget
+    for i in _spread_order(len(paragraphs)):
+        # plus the blank line after it and a possible [...] marker
+        cost = estimate_tokens(paragraphs[i]) + 2
+        if cost <= left:
+            chosen.add(i)
+            left -= cost
+    if not chosen:
+        # Every paragraph is over budget on its own: cut the first one down
+        return paragraphs[0][:budget * 4].rsplit(' ', 1)[0] + f" {_GAP}"
+    parts, last = [], -1
+    for i in sorted(chosen):
+        if i != last + 1:
+            parts.append(_GAP)
+        parts.append(paragraphs[i])
+        last = i
+    if last != len(paragraphs) - 1:
+        parts.append(_GAP)
+    return '\n\n'.join(parts)
+
+
+def _shares(sizes, budget):
+    """Split budget across documents ({key: tokens}): ones smaller than an
+    even share are kept whole and the rest divide what's left equally"""
+    shares, left = {}, budget
+    for k, key in enumerate(sorted(sizes, key=sizes.get)):
+        shares[key] = min(sizes[key], left // (len(sizes) - k))
+        left -= shares[key]
+    return shares
+
+
+def prepare_samples(file_contents=None, sample_content=None):
+    """The writing samples for the style call, in upload order. Text samples
+    come back as {'filename', 'text'} (extracted, deduplicated and sampled);
+    images and PDFs with no usable text come back unchanged, for the
+    image/document path. Other files with no usable text are left out."""
+    files = [{'filename': 'sample.txt', 'text': sample_content}] if sample_content else list(file_contents or ())
+    if not STYLE_EXTRACT:
+        return files
+
+    docs, skipped, seen, duplicates, boilerplate, fallbacks = {}, set(), set(), 0, 0, 0
+    for n, f in enumerate(files):
+        if 'text' in f:
+            pages = [f['text']]
+        elif _ext(f['filename']) in IMAGE_EXTS:
+            continue
+        else:
+            pages = _extract(f['filename'], f['data'])
+            if pages is None and _ext(f['filename']) == 'pdf':
+                fallbacks += 1
+                continue
+            if pages is None:
+                logger.warning(f"Skipping writing sample {f['filename']!r}: no text could be extracted")
+                skipped.add(n)
+                continue
+        paragraphs, dropped = _paragraphs(f['filename'], pages)
+        unique = []
+        for paragraph in paragraphs:
+            key = _norm(paragraph)
+            if key not in seen:
+                seen.add(key)
+                unique.append(paragraph)
+        boilerplate += dropped
+        duplicates += len(paragraphs) - len(unique)
+        # A plain text sample with nothing removed goes in exactly as written
+        verbatim = (len(pages) == 1 and _ext(f['filename']) not in ('pdf', 'docx') and not dropped
+                    and len(unique) == len(paragraphs))
+        docs[n] = (unique, pages[0].strip() if verbatim else '\n\n'.join(unique))
+
+    sizes = {n: sum(estimate_tokens(p) for p in unique) for n, (unique, _) in docs.items()}
+    shares = {}
+    if STYLE_SAMPLE_TOKENS and sum(sizes.values()) > STYLE_SAMPLE_TOKENS:
+        shares = _shares(sizes, STYLE_SAMPLE_TOKENS)
+
+    out = []
+    for n, f in enumerate(files):
+        if n in skipped:
+            continue
+        if n not in docs:
+            out.append(f)
+            continue
+        unique, text = docs[n]
+        if not unique:
+            continue
+        if n in shares and shares[n] < sizes[n]:
+            text = _sample(unique, max(1, shares[n]))
+        out.append({'filename': f['filename'], 'text': text})
+
+    _count(files=len(files), extracted=len(docs), fallbacks=fallbacks, skipped=len(skipped),
+           boilerplate_lines=boilerplate, duplicate_paragraphs=duplicates, tokens_in=sum(sizes.values()),
+           tokens_sent=sum(estimate_tokens(f['text']) for f in out if 'text' in f))
+    return out
@@ -0,0 +1,161 @@
+"""Bounded, spooled handling of /generate uploads.
+
+Uploads are never held in memory whole. The form parser writes each file into
+a CappedSpool, which keeps the first AIA_UPLOAD_SPOOL_BYTES in memory, rolls
+over to a temp file after that, and refuses to grow past
+AIA_UPLOAD_MAX_FILE_BYTES. The request as a whole is capped at
+AIA_UPLOAD_MAX_BYTES as it's read (MAX_CONTENT_LENGTH in app.py, the capped
+stream in asgi.py). Either cap raises UploadTooLarge (a 413).
+
+The spooled file object then travels as the upload's 'data' in place of its
+bytes. PDFs and images go into the style call's body as Base64Upload
+placeholders; encode_body turns that body into a StreamedBody, which
+base64-encodes each file chunk by chunk while the request is being sent. It
+has an exact Content-Length, so nothing is buffered whole. The files are
+closed as soon as the style call returns (close_uploads in the pipelines).
+"""
+import os
+import re
+import json
+import base64
+import secrets
+from tempfile import SpooledTemporaryFile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+UPLOAD_MAX_FILE_BYTES = int(os.getenv('AIA_UPLOAD_MAX_FILE_BYTES', str(10 * 1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv('AIA_UPLOAD_MAX_BYTES', str(25 * 1024 * 1024)))
+UPLOAD_MAX_FILES = int(os.getenv('AIA_UPLOAD_MAX_FILES', '10'))
+# Per file: kept in memory up to this size, then spooled to a temp file
+UPLOAD_SPOOL_BYTES = int(os.getenv('AIA_UPLOAD_SPOOL_BYTES', str(256 * 1024)))
+
+# A multiple of 3, so each chunk base64-encodes on its own with no padding
+# until the last one
+CHUNK_BYTES = 48 * 1024
+
+
+def _mb(n):
+    return f"{n / (1024 * 1024):g} MB"
+
+
+LIMIT_MESSAGE = (f"Uploads are limited to {_mb(UPLOAD_MAX_FILE_BYTES)} per file "
+                 f"and {_mb(UPLOAD_MAX_BYTES)} in total.")
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    """A file or the request went over its cap while being read."""
+
+    description = LIMIT_MESSAGE
+
+
+class CappedSpool(SpooledTemporaryFile):
+    """SpooledTemporaryFile that raises UploadTooLarge past max_bytes."""
+
+    def __init__(self, max_bytes=UPLOAD_MAX_FILE_BYTES, spool_bytes=UPLOAD_SPOOL_BYTES):
+        super().__init__(max_size=spool_bytes, mode='w+b')
+        self.max_bytes = max_bytes
+
+    def write(self, s):
+        if self.tell() + len(s) > self.max_bytes:
+            raise UploadTooLarge()
+        return super().write(s)
+
+
+def data_size(data):
+    """Byte length of an upload's data: bytes or a seekable file."""
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    data.seek(0, os.SEEK_END)
+    return data.tell()
+
+
+def iter_data(data, chunk_bytes=CHUNK_BYTES):
+    """Yield an upload's bytes chunk by chunk, from the start."""
+    if isinstance(data, (bytes, bytearray)):
+        view = memoryview(data)
+        for i in range(0, len(view), chunk_bytes):
+            yield view[i:i + chunk_bytes]
+        return
+    data.seek(0)
+    while chunk := data.read(chunk_bytes):
+        yield chunk
+
+
+def read_data(data):
+    """All of an upload's bytes. Only for text samples, which go into the
+    prompt as text anyway."""
+    if isinstance(data, (bytes, bytearray)):
+        return bytes(data)
+    data.seek(0)
+    return data.read()
+
+
+def close_uploads(file_contents):
+    """Close the spooled files behind file_contents (bytes are left alone)."""
+    for f in file_contents or ():
+        close = getattr(f.get('data'), 'close', None)
+        if close is not None:
+            close()
+
+
+class Base64Upload:
+    """Stands in for a base64 string in a request body; the data is encoded
+    as the body is sent (see encode_body)."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return 4 * ((data_size(self.data) + 2) // 3)
+
+    def chunks(self):
+        for chunk in iter_data(self.data):
+            yield base64.b64encode(chunk)
+
+
+class StreamedBody:
+    """A JSON request body sent in pieces: literal JSON between the
+    Base64Upload values, each encoded as it's sent. len() is the exact
+    Content-Length, so requests and httpx don't fall back to chunked
+    transfer encoding. Iterable more than once, e.g. for a retry."""
+
+    def __init__(self, parts, uploads):
+        self.parts = [part.encode() for part in parts]
+        self.uploads = uploads
+
+    def __len__(self):
+        return sum(map(len, self.parts)) + sum(len(u) + 2 for u in self.uploads)
+
+    def __iter__(self):
+        for part, upload in zip(self.parts, self.uploads):
+            yield part
+            yield b'"'
+            yield from upload.chunks()
+            yield b'"'
+        yield self.parts[-1]
+
+    async def aiter(self):
+        # The reads are from a spool (memory or a local temp file), small
+        # enough to do on the event loop
+        for chunk in self:
+            yield chunk
+
+
+def encode_body(body):
+    """JSON-encode a request body: bytes, or a StreamedBody when it holds
+    Base64Upload values."""
+    uploads = []
+    token = f"aia-upload-{secrets.token_hex(8)}-"
+
+    def placeholder(o):
+        if not isinstance(o, Base64Upload):
+            raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+        uploads.append(o)
+        return f"{token}{len(uploads) - 1}"
+
+    text = json.dumps(body, default=placeholder)
+    if not uploads:
+        return text.encode()
+    # re.split with a group alternates literal JSON and placeholder indexes
+    pieces = re.split(f'"{re.escape(token)}(\\d+)"', text)
+    return StreamedBody(pieces[::2], [uploads[int(i)] for i in pieces[1::2]])
@@ -0,0 +1,105 @@
+"""Durable local spool for kumori_api_usage rows that couldn't be written.
+
+When Postgres is unreachable (or the writer queue is backed up) rows go into
+an append-only SQLite file instead of being dropped, and the usage writer's
+drainer replays them later. Every row carries an idempotency key, so a row
+that's replayed after it actually landed is ignored by the INSERT rather than
+counted twice.
+
+The file lives in /tmp by default (the only writable path on App Engine), so
+it survives worker restarts on the same instance but not instance teardown.
+
+Rows Postgres rejects for their data (a value out of range, a violated
+constraint) would never drain; the writer moves them to a dead-letter table
+in the same file, with the error, for someone to look at.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SPOOL_PATH = os.getenv('AIA_USAGE_SPOOL_PATH', '/tmp/aia_usage_spool.sqlite')
+
+
+class UsageSpool:
+    def __init__(self, path=SPOOL_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS usage_spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT UNIQUE NOT NULL,
+                row TEXT NOT NULL,
+                spooled_at REAL NOT NULL
+            )
+        """)
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS usage_dead_letter (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT UNIQUE NOT NULL,
+                row TEXT NOT NULL,
+                spooled_at REAL NOT NULL,
+                failed_at REAL NOT NULL,
+                error TEXT
+            )
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Survive a process crash; an OS crash may lose the last moments
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def append(self, rows):
+        """Spool rows (tuples ending in their idempotency key)."""
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO usage_spool (idempotency_key, row, spooled_at) VALUES (?, ?, ?)",
+                [(row[-1], json.dumps(list(row)), now) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def peek(self, limit):
+        """Oldest spooled rows as [(spool_id, row_tuple)]."""
+        cur = self._conn().execute(
+            "SELECT id, row FROM usage_spool ORDER BY id LIMIT ?", (limit,))
+        return [(sid, tuple(json.loads(row))) for sid, row in cur.fetchall()]
+
+    def delete(self, spool_ids):
+        self._conn().executemany("DELETE FROM usage_spool WHERE id = ?", [(i,) for i in spool_ids])
+
+    def dead_letter(self, spool_ids, error):
+        """Move spooled rows to the dead-letter table."""
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for sid in spool_ids:
+                conn.execute(
+                    "INSERT OR IGNORE INTO usage_dead_letter (idempotency_key, row, spooled_at, failed_at, error) "
+                    "SELECT idempotency_key, row, spooled_at, ?, ? FROM usage_spool WHERE id = ?",
+                    (now, error, sid))
+                conn.execute("DELETE FROM usage_spool WHERE id = ?", (sid,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM usage_spool").fetchone()[0]
+
+    def dead_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM usage_dead_letter").fetchone()[0]
@@ -0,0 +1,345 @@
+"""Batched, pooled writer for kumori_api_usage rows.
+
+One writer per process. Callers hand it a finished row and return at once;
+a single daemon thread drains a bounded queue and INSERTs rows in multi-row
+batches over a small connection pool (utilities.db). A batch is written when
+it reaches AIA_USAGE_BATCH_SIZE rows or AIA_USAGE_FLUSH_INTERVAL seconds after
+its first row, whichever comes first, and everything still queued is flushed
+at shutdown (atexit, plus gunicorn's worker_exit hook in gunicorn.conf.py).
+
+Never raises into the caller and never blocks it. Rows that can't be written
+(Postgres unreachable) or queued (queue full) go to a durable local spool
+(utilities.usage_spool) instead of being dropped; a second daemon thread
+replays the spool in batches with exponential backoff. A batch Postgres
+rejects for its data rather than its connection is split until the bad rows
+are found; those go to the spool's dead-letter table so the rest drain.
+
+Each row gets an idempotency key when it's submitted and the INSERT skips
+keys it has already seen, so a replay never double-counts. That needs a column and unique index
+the deploy step adds (python -m utilities.usage_writer --migrate); until
+they exist the writer only checks for them and uses plain inserts.
+"""
+import os
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+
+from .db import pooled_connection
+from .usage_spool import UsageSpool
+
+logger = logging.getLogger(__name__)
+
+USAGE_COLUMNS = (
+    'app_name', 'feature', 'model', 'input_tokens', 'output_tokens',
+    'cache_creation_tokens', 'cache_read_tokens', 'thinking_tokens',
+    'web_search_requests', 'web_fetch_requests', 'code_execution_requests',
+    'image_count', 'estimated_cost_usd', 'streaming', 'user_id', 'duration_ms',
+)
+
+BATCH_SIZE = int(os.getenv('AIA_USAGE_BATCH_SIZE', '50'))
+FLUSH_INTERVAL = float(os.getenv('AIA_USAGE_FLUSH_INTERVAL', '2.0'))
+MAX_QUEUE = int(os.getenv('AIA_USAGE_MAX_QUEUE', '10000'))
+SPOOL_ENABLED = os.getenv('AIA_USAGE_SPOOL', '1') not in ('0', 'false', 'no')
+DRAIN_IDLE = 30.0          # seconds between spool checks when it's empty
+DRAIN_MIN_BACKOFF = 5.0
+DRAIN_MAX_BACKOFF = 300.0
+
+SCHEMA_RECHECK = 300.0     # seconds between schema checks while idempotent inserts are off
+_INDEX_NAME = 'idx_kumori_api_usage_idempotency_key'
+
+# Run once per database by the deploy step (python -m utilities.usage_writer
+# --migrate), never by a serving process: ADD COLUMN takes an ACCESS EXCLUSIVE
+# lock and the index build can outlive the pool's statement_timeout.
+_MIGRATION_SQL = (
+    "ALTER TABLE kumori_api_usage ADD COLUMN IF NOT EXISTS idempotency_key TEXT",
+    f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {_INDEX_NAME} "
+    "ON kumori_api_usage (idempotency_key) WHERE idempotency_key IS NOT NULL",
+)
+# (column exists, index exists, index is valid)
+_SCHEMA_CHECK_SQL = f"""
+SELECT EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'kumori_api_usage' AND column_name = 'idempotency_key'),
+       EXISTS (SELECT 1 FROM pg_class WHERE relname = '{_INDEX_NAME}' AND relkind = 'i'),
+       EXISTS (SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+               WHERE c.relname = '{_INDEX_NAME}' AND i.indisunique AND i.indisvalid AND i.indisready)
+"""
+
+
+class _Flush:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class UsageWriter:
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, max_queue=MAX_QUEUE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._counts = {'submitted': 0, 'inserted': 0, 'batches': 0, 'failed': 0, 'dropped': 0,
+                        'spooled': 0, 'replayed': 0, 'dead_lettered': 0}
+        self._counts_lock = threading.Lock()
+        self._idempotent = None  # None until the schema check has run
+        self._schema_checked = 0.0
+        self._drain_wake = threading.Event()
+        self._spool = None
+        if SPOOL_ENABLED:
+            try:
+                self._spool = UsageSpool()
+            except Exception as e:
+                logger.warning(f"usage_writer: spool unavailable, failed rows will be dropped: {e}")
+
+    def _count(self, key, n=1):
+        with self._counts_lock:
+            self._counts[key] += n
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='aia-usage-writer', daemon=True)
+                self._thread.start()
+                if self._spool is not None:
+                    # Also picks up rows a previous worker left behind
+                    threading.Thread(target=self._drain, name='aia-usage-drainer', daemon=True).start()
+                atexit.register(self.close)
+
+    def submit(self, row):
+        """Queue one row (a tuple in USAGE_COLUMNS order). Never blocks."""
+        self._ensure_started()
+        row = tuple(row) + (uuid.uuid4().hex,)
+        self._count('submitted')
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            logger.warning("usage_writer: queue full, spooling kumori_api_usage row")
+            self._spool_rows([row])
+            return False
+
+    def flush(self, timeout=10.0):
+        """Block until everything queued so far has been written (or failed)."""
+        if self._thread is None:
+            return True
+        marker = _Flush()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def close(self, timeout=10.0):
+        self.flush(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, _Flush):
+                self._write(batch)
+                batch, deadline = [], None
+                item.done.set()
+                continue
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _check_schema(self, conn):
+        """Use idempotent inserts only if the migration has run: the
+        idempotency_key column and a valid unique index on it both exist.
+        Otherwise (or if the check itself fails) fall back to plain,
+        at-least-once inserts and look again every SCHEMA_RECHECK seconds."""
+        if self._idempotent or (self._idempotent is False
+                                and time.monotonic() - self._schema_checked < SCHEMA_RECHECK):
+            return
+        import psycopg2
+        self._schema_checked = time.monotonic()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(_SCHEMA_CHECK_SQL)
+                has_column, _, index_valid = cur.fetchone()
+            conn.rollback()
+            self._idempotent = has_column and index_valid
+        except psycopg2.Error as e:
+            self._idempotent = False
+            logger.warning(f"usage_writer: idempotency_key schema check failed, using plain inserts: {e}")
+            conn.rollback()  # a dead connection raises here and the batch is spooled
+            return
+        if not self._idempotent:
+            logger.warning("usage_writer: kumori_api_usage has no valid idempotency_key index "
+                           "(run python -m utilities.usage_writer --migrate), replays may double-count")
+
+    def _insert(self, rows):
+        """INSERT rows in one statement. Raises on failure."""
+        from psycopg2.extras import execute_values
+        with pooled_connection() as conn:
+            self._check_schema(conn)
+            with conn.cursor() as cur:
+                if self._idempotent:
+                    execute_values(
+                        cur,
+                        f"INSERT INTO kumori_api_usage ({', '.join(USAGE_COLUMNS)}, idempotency_key) "
+                        f"VALUES %s ON CONFLICT (idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING",
+                        rows, page_size=len(rows))
+                else:
+                    execute_values(
+                        cur,
+                        f"INSERT INTO kumori_api_usage ({', '.join(USAGE_COLUMNS)}) VALUES %s",
+                        [row[:-1] for row in rows], page_size=len(rows))
+            conn.commit()
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            self._insert(rows)
+            self._count('inserted', len(rows))
+            self._count('batches')
+            logger.info(f"usage_writer: logged {len(rows)} rows to kumori_api_usage")
+        except Exception as e:
+            self._count('failed', len(rows))
+            logger.warning(f"usage_writer: kumori_api_usage batch INSERT failed, spooling {len(rows)} rows: {e}")
+            self._spool_rows(rows)
+
+    def _spool_rows(self, rows):
+        if self._spool is None:
+            self._count('dropped', len(rows))
+            return
+        try:
+            self._spool.append(rows)
+            self._count('spooled', len(rows))
+            self._drain_wake.set()
+        except Exception as e:
+            self._count('dropped', len(rows))
+            logger.warning(f"usage_writer: spool write failed, dropping {len(rows)} rows: {e}")
+
+    def _drain(self):
+        """Replay spooled rows oldest-first, backing off while the DB is down."""
+        backoff = DRAIN_MIN_BACKOFF
+        while True:
+            try:
+                pending = self._spool.peek(self.batch_size)
+            except Exception as e:
+                logger.warning(f"usage_writer: spool read failed: {e}")
+                pending = []
+            if not pending:
+                self._drain_wake.wait(DRAIN_IDLE)
+                self._drain_wake.clear()
+                continue
+            try:
+                self._replay(pending)
+                backoff = DRAIN_MIN_BACKOFF
+            except Exception as e:
+                delay = backoff * random.uniform(0.8, 1.2)
+                logger.warning(f"usage_writer: spool replay failed, retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+                backoff = min(backoff * 2, DRAIN_MAX_BACKOFF)
+
+    def _replay(self, pending):
+        """INSERT spooled rows and remove them from the spool. A data error
+        (bad value, violated constraint) is the rows' fault and retrying won't
+        fix it: halve the batch until the rows that fail alone are found and
+        dead-letter those. Anything else (connection, schema) is raised for
+        the drainer to back off on."""
+        import psycopg2
+        try:
+            self._insert([row for _, row in pending])
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            if len(pending) > 1:
+                mid = len(pending) // 2
+                self._replay(pending[:mid])
+                self._replay(pending[mid:])
+                return
+            self._spool.dead_letter([pending[0][0]], str(e).strip())
+            self._count('dead_lettered')
+            logger.error(f"usage_writer: kumori_api_usage rejected a spooled row, moved to dead letter: {e}")
+            return
+        self._spool.delete([sid for sid, _ in pending])
+        self._count('replayed', len(pending))
+        self._count('inserted', len(pending))
+        logger.info(f"usage_writer: replayed {len(pending)} spooled rows")
+
+    def stats(self):
+        with self._counts_lock:
+            stats = dict(self._counts)
+        stats['queued'] = self._queue.qsize()
+        try:
+            stats['spool_pending'] = self._spool.count() if self._spool is not None else None
+            stats['dead_letter'] = self._spool.dead_count() if self._spool is not None else None
+        except Exception:
+            stats['spool_pending'] = stats['dead_letter'] = None
+        return stats
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_usage_writer():
+    """The process-wide writer."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = UsageWriter()
+    return _writer
+
+
+def shutdown_usage_writer(timeout=10.0):
+    """Flush pending rows; safe to call when nothing was ever logged."""
+    if _writer is not None:
+        _writer.close(timeout)
+
+
+def migrate_schema():
+    """Add kumori_api_usage.idempotency_key and its unique index. A deploy
+    step, safe to re-run: an INVALID index left by an interrupted build is
+    dropped and rebuilt. Returns True once the index is valid."""
+    from .db import connect
+    conn = connect()
+    try:
+        conn.autocommit = True  # CREATE INDEX CONCURRENTLY can't run in a transaction
+        with conn.cursor() as cur:
+            # No statement_timeout for the build; a short lock_timeout so the
+            # ALTER gives up rather than queueing live inserts behind it
+            cur.execute("SET statement_timeout = 0")
+            cur.execute("SET lock_timeout = '5s'")
+            cur.execute(_MIGRATION_SQL[0])
+            cur.execute(_SCHEMA_CHECK_SQL)
+            _, index_exists, index_valid = cur.fetchone()
+            if index_exists and not index_valid:
+                logger.warning(f"usage_writer: dropping invalid index {_INDEX_NAME}")
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {_INDEX_NAME}")
+            cur.execute("SET lock_timeout = 0")
+            cur.execute(_MIGRATION_SQL[1])
+            cur.execute(_SCHEMA_CHECK_SQL)
+            return all(cur.fetchone())
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if '--migrate' not in sys.argv:
+        print("Usage: python -m utilities.usage_writer --migrate")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    ok = migrate_schema()
+    print(f"kumori_api_usage.idempotency_key index {'is valid' if ok else 'is NOT valid'}")
+    sys.exit(0 if ok else 1)